@@ -0,0 +1 @@
+"""Benchmark suite for trivia app."""
@@ -0,0 +1,262 @@
+"""
+Command line entry point for benchmarks.
+
+Usage::
+
+    python -m benchmarks seed --database-url sqlite:////tmp/bench.db
+    python -m benchmarks run --database-url sqlite:////tmp/bench.db
+    python -m benchmarks compare old.json new.json
+    python -m benchmarks replay traffic.jsonl --url http://127.0.0.1:5000
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_DATABASE_URL = 'sqlite:////tmp/trivia_bench.db'
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def git_commit():
+    """
+    Get current git commit of the repository.
+
+    :return:
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def seed(args):
+    """
+    Seed benchmark database.
+
+    :param args:
+    :return:
+    """
+    from benchmarks.seed import seed_database
+
+    start = time.perf_counter()
+    seed_database(args.database_url, args.questions, args.categories)
+    print(f'Seeded {args.questions} questions and {args.categories} '
+          f'categories in {time.perf_counter() - start:.1f}s')
+
+
+def run(args):
+    """
+    Run benchmarks and save results as json.
+
+    :param args:
+    :return:
+    """
+    env = {
+        'DATABASE_URL': args.database_url,
+        # Servers started below load the same key file to verify tokens.
+        'AUTH_KEY_PROVIDER': 'local',
+        'AUTH_PRIVATE_KEY_PATH': os.path.join(tempfile.mkdtemp(), 'key.pem'),
+        'RATE_LIMIT_ENABLED': 'true' if args.rate_limit else 'false',
+        'GROUP_COMMIT_ENABLED': 'true' if args.group_commit else 'false',
+    }
+    # Config is read when constants, models and the app are imported, so it
+    # has to be in place before any of them is.
+    os.environ.update(env)
+
+    from constants import ROLE_PERMISSIONS
+    from flaskr.keys import key_provider
+
+    if not args.skip_seed:
+        seed(args)
+
+    from benchmarks import runner
+
+    def scenarios(delete_offset):
+        # Targets share the database, so each one deletes its own id range.
+        return [
+            scenario for scenario in runner.build_scenarios(
+                args.questions, args.categories,
+                key_provider.mint(ROLE_PERMISSIONS['admin']),
+                key_provider.mint(ROLE_PERMISSIONS['user']),
+                delete_offset)
+            if not args.routes or scenario['name'] in args.routes
+        ]
+
+    results = {}
+    if 'client' in args.target:
+        from flaskr import app
+        results['client'] = runner.run_all(
+            runner.TestClientTarget(app), scenarios(0), args.requests)
+
+    servers = {
+        'gunicorn': lambda port: runner.gunicorn_command(
+            port, args.workers, args.threads),
+        'asgi': lambda port: runner.asgi_command(port, args.workers),
+    }
+    for offset, name in enumerate(args.target, start=1):
+        if name not in servers:
+            continue
+        port = runner.free_port()
+        process = runner.start_server(servers[name](port), env, port)
+        try:
+            results[name] = runner.run_all(
+                runner.HTTPTarget(f'http://127.0.0.1:{port}', name),
+                scenarios(offset * args.requests),
+                args.requests, args.concurrency)
+        finally:
+            process.terminate()
+            process.wait()
+
+    commit = git_commit()
+    output = args.output or os.path.join(
+        RESULTS_DIR, f'{commit}-{int(time.time())}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump({
+            'meta': {
+                'commit': commit,
+                'timestamp': int(time.time()),
+                'python': platform.python_version(),
+                'database': args.database_url.split(':', 1)[0],
+                'questions': args.questions,
+                'categories': args.categories,
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'workers': args.workers,
+                'threads': args.threads,
+                'group_commit': args.group_commit,
+            },
+            'results': results,
+        }, output_file, indent=2)
+    print(f'Saved results to {output}')
+
+
+def compare(args):
+    """
+    Print route by route comparison of two saved results.
+
+    :param args:
+    :return:
+    """
+    from benchmarks.stats import compare as compare_results
+
+    with open(args.baseline) as baseline, open(args.current) as current:
+        rows = compare_results(json.load(baseline), json.load(current))
+
+    for row in rows:
+        cells = ' '.join(
+            f'{key}={row[key][0]}->{row[key][1]} ({row[key][2]}%)'
+            for key in ('rps', 'p50', 'p95', 'p99'))
+        print(f"{row['target']:>8} {row['route']:<28} {cells}")
+
+
+def replay(args):
+    """
+    Replay a recorded request log and print latencies per route.
+
+    :param args:
+    :return:
+    """
+    from benchmarks.replay import replay_log
+
+    report = replay_log(
+        args.log, args.url, concurrency=args.concurrency, rate=args.rate,
+        speed=args.speed, authorization=args.authorization,
+        timeout=args.timeout)
+
+    for route, stats in sorted(report.items()):
+        print(f"{route:<36} {stats['requests']:>7} req "
+              f"{stats['errors']:>5} err p50={stats['p50']}ms "
+              f"p95={stats['p95']}ms p99={stats['p99']}ms "
+              f"{stats['statuses']}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'meta': {
+                    'commit': git_commit(),
+                    'timestamp': int(time.time()),
+                    'log': args.log,
+                    'concurrency': args.concurrency,
+                    'rate': args.rate,
+                    'speed': args.speed,
+                },
+                'results': {'replay': report},
+            }, output_file, indent=2)
+        print(f'Saved results to {args.output}')
+
+
+def main(argv=None):
+    """
+    Parse command line and dispatch to sub command.
+
+    :param argv:
+    :return:
+    """
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    for name, handler in (('seed', seed), ('run', run)):
+        command = commands.add_parser(name)
+        command.set_defaults(handler=handler)
+        command.add_argument(
+            '--database-url', default=os.environ.get(
+                'BENCH_DATABASE_URL', DEFAULT_DATABASE_URL))
+        command.add_argument('--questions', type=int, default=1000,
+                             help='1k to 1M questions')
+        command.add_argument('--categories', type=int, default=10,
+                             help='10 to 10k categories')
+
+    run_command = commands.choices['run']
+    run_command.add_argument(
+        '--target', nargs='+', choices=('client', 'gunicorn', 'asgi'),
+        default=['client', 'gunicorn'])
+    run_command.add_argument('--routes', nargs='*')
+    run_command.add_argument('--requests', type=int, default=200)
+    run_command.add_argument('--concurrency', type=int, default=8)
+    run_command.add_argument('--workers', type=int, default=2)
+    run_command.add_argument('--threads', type=int, default=1)
+    run_command.add_argument('--skip-seed', action='store_true')
+    run_command.add_argument(
+        '--rate-limit', action='store_true',
+        help='keep rate limits on, which sheds most benchmark load')
+    run_command.add_argument(
+        '--group-commit', action='store_true',
+        help='commit question writes of concurrent requests together')
+    run_command.add_argument('--output')
+
+    compare_command = commands.add_parser('compare')
+    compare_command.set_defaults(handler=compare)
+    compare_command.add_argument('baseline')
+    compare_command.add_argument('current')
+
+    replay_command = commands.add_parser('replay')
+    replay_command.set_defaults(handler=replay)
+    replay_command.add_argument('log', help='JSON-lines request log')
+    replay_command.add_argument('--url', default='http://127.0.0.1:5000')
+    replay_command.add_argument('--concurrency', type=int, default=32)
+    replay_command.add_argument(
+        '--rate', type=float, help='fixed requests per second')
+    replay_command.add_argument(
+        '--speed', type=float,
+        help='replay recorded timestamps this many times faster')
+    replay_command.add_argument(
+        '--authorization',
+        help='replace Authorization header of authenticated entries')
+    replay_command.add_argument('--timeout', type=float, default=30)
+    replay_command.add_argument('--output')
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,184 @@
+"""
+Replay a JSON-lines request log against a running server.
+
+Each line of the log is an object such as::
+
+    {"ts": 1632000000.25, "method": "POST", "path": "/quizzes",
+     "headers": {"Authorization": "Bearer ..."},
+     "body": {"quiz_category": {"id": 1}, "previous_questions": []}}
+
+Only ``path`` is required. ``ts`` (seconds) is used to reproduce the
+original pacing, optionally compressed by a speed factor.
+"""
+
+import asyncio
+import json
+import re
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+from benchmarks.stats import summarize
+
+ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def route_name(method, path):
+    """
+    Group a request under its route, e.g. ``DELETE /questions/<int>``.
+
+    :param method:
+    :param path:
+    :return:
+    """
+    return f"{method} {ID_SEGMENT.sub('/<int>', path.split('?', 1)[0])}"
+
+
+def read_log(path):
+    """
+    Stream entries of a JSON-lines request log.
+
+    Blank lines and lines without a ``path`` are skipped.
+
+    :param path:
+    :return:
+    """
+    with open(path) as log_file:
+        for line in log_file:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry.get('path'):
+                yield entry
+
+
+async def send(host, port, method, path, headers, body, timeout):
+    """
+    Send a single HTTP/1.1 request and return its status code.
+
+    :param host:
+    :param port:
+    :param method:
+    :param path:
+    :param headers:
+    :param body:
+    :param timeout:
+    :return:
+    """
+    payload = b''
+    headers = dict(headers or {})
+    if body is not None:
+        payload = (body if isinstance(body, str)
+                   else json.dumps(body)).encode('utf-8')
+        headers.setdefault('Content-Type', 'application/json')
+    headers.update({
+        'Host': f'{host}:{port}',
+        'Content-Length': str(len(payload)),
+        'Connection': 'close',
+    })
+    head = f'{method} {path} HTTP/1.1\r\n' + ''.join(
+        f'{name}: {value}\r\n' for name, value in headers.items())
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(head.encode('latin-1') + b'\r\n' + payload)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        # The server closes the connection, so draining to EOF reads the
+        # whole response regardless of its framing.
+        await asyncio.wait_for(reader.read(), timeout)
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def replay(entries, base_url, concurrency=32, rate=None, speed=None,
+                 authorization=None, timeout=30):
+    """
+    Replay log entries and collect latencies per route.
+
+    Pacing is taken from ``rate`` (requests per second) when given,
+    otherwise from the entries' ``ts`` divided by ``speed``, otherwise
+    requests are sent as fast as ``concurrency`` allows.
+
+    :param entries:
+    :param base_url:
+    :param concurrency:
+    :param rate:
+    :param speed:
+    :param authorization:
+    :param timeout:
+    :return:
+    """
+    url = urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    pending = set()
+    first_ts = None
+    start = time.perf_counter()
+
+    async def run(entry):
+        method = entry.get('method', 'GET').upper()
+        headers = {
+            name: authorization if authorization and
+            name.lower() == 'authorization' else value
+            for name, value in (entry.get('headers') or {}).items()}
+        route = route_name(method, entry['path'])
+        sent = time.perf_counter()
+        try:
+            status = await send(host, port, method, entry['path'], headers,
+                                entry.get('body'), timeout)
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+            status = 'failed'
+        finally:
+            semaphore.release()
+        latencies[route].append(time.perf_counter() - sent)
+        statuses[route][status] += 1
+
+    for index, entry in enumerate(entries):
+        if rate:
+            delay = index / rate
+        elif speed and 'ts' in entry:
+            if first_ts is None:
+                first_ts = entry['ts']
+            delay = (entry['ts'] - first_ts) / speed
+        else:
+            delay = 0
+        wait = start + delay - time.perf_counter()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await semaphore.acquire()
+        task = asyncio.ensure_future(run(entry))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    if pending:
+        await asyncio.wait(pending)
+    elapsed = time.perf_counter() - start
+
+    report = {}
+    for route, values in latencies.items():
+        codes = statuses[route]
+        errors = sum(
+            count for status, count in codes.items()
+            if status == 'failed' or status >= 400)
+        report[route] = summarize(values, errors, elapsed)
+        report[route]['statuses'] = {
+            str(status): count for status, count in codes.items()}
+    return report
+
+
+def replay_log(path, base_url, **options):
+    """
+    Replay a JSON-lines log file and return the per route report.
+
+    :param path:
+    :param base_url:
+    :param options:
+    :return:
+    """
+    return asyncio.run(replay(read_log(path), base_url, **options))
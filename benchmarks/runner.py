@@ -0,0 +1,266 @@
+"""Run benchmark scenarios against the trivia app."""
+
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from benchmarks.stats import summarize
+
+
+def build_scenarios(questions, categories, admin_token, user_token,
+                    delete_offset=0):
+    """
+    Build one scenario per route of the app.
+
+    Each scenario is a dict with a ``request`` callable that takes the
+    iteration number and returns ``(method, path, json_body, headers)``.
+
+    :param questions:
+    :param categories:
+    :param admin_token:
+    :param user_token:
+    :param delete_offset:
+    :return:
+    """
+    admin = {'Authorization': f'Bearer {admin_token}'}
+    user = {'Authorization': f'Bearer {user_token}'}
+    pages = max(questions // 10, 1)
+    # Deleted ids are taken from the top of the seeded range, shared by
+    # every thread so each id is deleted exactly once.
+    delete_ids = itertools.count(questions - delete_offset, -1)
+    new_question = {
+        'question': 'Benchmark question?', 'answer': 'Benchmark answer',
+        'category': '1', 'difficulty': 1,
+    }
+
+    def category(i):
+        return i % categories + 1
+
+    return [
+        {'name': 'get_categories', 'request': lambda i: (
+            'GET', '/categories', None, {})},
+        {'name': 'get_questions', 'request': lambda i: (
+            'GET', f'/questions?page={i % pages + 1}', None, {})},
+        {'name': 'search_questions', 'request': lambda i: (
+            'POST', '/questions/search', {'searchTerm': 'capital'}, {})},
+        {'name': 'get_questions_by_category', 'request': lambda i: (
+            'GET', f'/categories/{category(i)}/questions', None, {})},
+        {'name': 'play_quiz', 'request': lambda i: (
+            'POST', '/quizzes', {
+                'quiz_category': {'id': category(i)},
+                'previous_questions': [],
+            }, user)},
+        {'name': 'add_question', 'request': lambda i: (
+            'POST', '/questions', new_question, admin)},
+        {'name': 'edit_question', 'request': lambda i: (
+            'PATCH', f'/questions/{i % questions + 1}',
+            dict(new_question, category=str(category(i))), admin)},
+        {'name': 'delete_question', 'request': lambda i: (
+            'DELETE', f'/questions/{next(delete_ids)}', None, admin)},
+    ]
+
+
+class TestClientTarget:
+    """Send requests through the Flask test client."""
+
+    name = 'client'
+
+    def __init__(self, app):
+        """
+        Init method.
+
+        :param app:
+        """
+        self.app = app
+
+    def send(self, method, path, json_body, headers):
+        """
+        Send request and return status code.
+
+        :param method:
+        :param path:
+        :param json_body:
+        :param headers:
+        :return:
+        """
+        response = self.app.test_client().open(
+            path, method=method, json=json_body, headers=headers)
+        return response.status_code
+
+
+class HTTPTarget:
+    """Send requests to a running server over HTTP."""
+
+    def __init__(self, base_url, name='gunicorn'):
+        """
+        Init method.
+
+        :param base_url:
+        :param name:
+        """
+        self.base_url = base_url
+        self.name = name
+
+    def send(self, method, path, json_body, headers):
+        """
+        Send request and return status code.
+
+        :param method:
+        :param path:
+        :param json_body:
+        :param headers:
+        :return:
+        """
+        data = None
+        headers = dict(headers)
+        if json_body is not None:
+            data = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        request = Request(
+            self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with urlopen(request) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            return error.code
+
+
+def run_scenario(target, scenario, requests, concurrency=1):
+    """
+    Run a scenario and summarize its latencies.
+
+    :param target:
+    :param scenario:
+    :param requests:
+    :param concurrency:
+    :return:
+    """
+    iterations = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        local_latencies, local_errors = [], 0
+        for i in iterations:
+            if i >= requests:
+                break
+            method, path, json_body, headers = scenario['request'](i)
+            start = time.perf_counter()
+            try:
+                status = target.send(method, path, json_body, headers)
+            except OSError:
+                status = None
+            local_latencies.append(time.perf_counter() - start)
+            if status is None or status >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, sum(errors), time.perf_counter() - start)
+
+
+def run_all(target, scenarios, requests, concurrency=1):
+    """
+    Run every scenario against a target.
+
+    :param target:
+    :param scenarios:
+    :param requests:
+    :param concurrency:
+    :return:
+    """
+    results = {}
+    for scenario in scenarios:
+        results[scenario['name']] = run_scenario(
+            target, scenario, requests, concurrency)
+        print(f"{target.name:>8} {scenario['name']:<28} "
+              f"{results[scenario['name']]['rps']:>10} req/s "
+              f"p50={results[scenario['name']]['p50']}ms "
+              f"p99={results[scenario['name']]['p99']}ms")
+    return results
+
+
+def free_port():
+    """
+    Get a free local tcp port.
+
+    :return:
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(command, env, port, timeout=30):
+    """
+    Start a server process and wait until it accepts connections.
+
+    :param command:
+    :param env:
+    :param port:
+    :param timeout:
+    :return:
+    """
+    process = subprocess.Popen(command, env=dict(os.environ, **env))
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(
+                f'{command[0]} exited with {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'{command[0]} did not start within {timeout}s')
+
+
+def gunicorn_command(port, workers, threads):
+    """
+    Build the gunicorn command line used by the Procfile.
+
+    :param port:
+    :param workers:
+    :param threads:
+    :return:
+    """
+    return [
+        sys.executable, '-m', 'gunicorn', 'flaskr:app',
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', str(workers), '--threads', str(threads),
+        '--log-level', 'warning',
+    ]
+
+
+def asgi_command(port, workers):
+    """
+    Build the gunicorn command line for the ASGI serving mode.
+
+    :param port:
+    :param workers:
+    :return:
+    """
+    return [
+        sys.executable, '-m', 'gunicorn', 'flaskr.asgi:app',
+        '--worker-class', 'uvicorn.workers.UvicornWorker',
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', str(workers),
+        '--log-level', 'warning',
+    ]
@@ -0,0 +1,74 @@
+"""Seed a database with synthetic trivia data for benchmarks."""
+
+import random
+
+from sqlalchemy import create_engine
+
+from models import db, Question, Category
+
+WORDS = (
+    'capital', 'river', 'painter', 'planet', 'element', 'battle', 'novel',
+    'composer', 'mountain', 'ocean', 'empire', 'inventor', 'festival',
+    'language', 'island', 'treaty', 'symphony', 'desert', 'athlete', 'film',
+)
+
+
+def seed_database(database_url, questions=1000, categories=10,
+                  batch_size=10000, seed=0):
+    """
+    Recreate the trivia tables and fill them with synthetic rows.
+
+    Rows get explicit ids starting at 1 so benchmark scenarios can address
+    existing questions and categories without querying for them first.
+
+    :param database_url:
+    :param questions:
+    :param categories:
+    :param batch_size:
+    :param seed:
+    :return:
+    """
+    rand = random.Random(seed)
+    engine = create_engine(database_url)
+    db.Model.metadata.drop_all(engine)
+    db.Model.metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        connection.execute(Category.__table__.insert(), [
+            {'id': category_id, 'type': f'Category {category_id}'}
+            for category_id in range(1, categories + 1)
+        ])
+
+        for start in range(1, questions + 1, batch_size):
+            stop = min(start + batch_size, questions + 1)
+            connection.execute(Question.__table__.insert(), [
+                _question_row(rand, question_id, categories)
+                for question_id in range(start, stop)
+            ])
+
+        if engine.dialect.name == 'postgresql':
+            for table in ('questions', 'categories'):
+                connection.execute(
+                    f"SELECT setval('{table}_id_seq', "
+                    f"(SELECT MAX(id) FROM {table}))")
+
+    engine.dispose()
+
+
+def _question_row(rand, question_id, categories):
+    """
+    Build a synthetic question row.
+
+    :param rand:
+    :param question_id:
+    :param categories:
+    :return:
+    """
+    first, second = rand.choice(WORDS), rand.choice(WORDS)
+    return {
+        'id': question_id,
+        'question': f'What is the {first} of the {second} #{question_id}?',
+        'answer': f'{second.title()} {question_id}',
+        'category': str(rand.randint(1, categories)),
+        'difficulty': rand.randint(1, 5),
+    }
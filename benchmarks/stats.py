@@ -0,0 +1,83 @@
+"""Latency statistics helpers for benchmarks."""
+
+import math
+
+
+def percentile(sorted_values, pct):
+    """
+    Get nearest-rank percentile of already sorted values.
+
+    :param sorted_values:
+    :param pct:
+    :return:
+    """
+    if not sorted_values:
+        return None
+    rank = max(int(math.ceil(pct / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Summarize latencies (in seconds) of a benchmark run.
+
+    Latencies are reported in milliseconds.
+
+    :param latencies:
+    :param errors:
+    :param elapsed:
+    :return:
+    """
+    values = sorted(latencies)
+    total = len(values)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'requests': total,
+        'errors': errors,
+        'elapsed': round(elapsed, 3),
+        'rps': round(total / elapsed, 2) if elapsed else None,
+        'mean': ms(sum(values) / total) if total else None,
+        'p50': ms(percentile(values, 50)),
+        'p95': ms(percentile(values, 95)),
+        'p99': ms(percentile(values, 99)),
+        'max': ms(values[-1]) if values else None,
+    }
+
+
+def compare(baseline, current):
+    """
+    Compare two saved benchmark results route by route.
+
+    :param baseline:
+    :param current:
+    :return:
+    """
+    rows = []
+    for target, routes in current.get('results', {}).items():
+        base_routes = baseline.get('results', {}).get(target, {})
+        for route, stats in routes.items():
+            base = base_routes.get(route)
+            if not base:
+                continue
+            row = {'target': target, 'route': route}
+            for key in ('rps', 'p50', 'p95', 'p99'):
+                old, new = base.get(key), stats.get(key)
+                row[key] = (old, new, _change(old, new))
+            rows.append(row)
+    return rows
+
+
+def _change(old, new):
+    """
+    Get relative change in percent between two values.
+
+    :param old:
+    :param new:
+    :return:
+    """
+    if not old or new is None:
+        return None
+    return round((new - old) / old * 100, 1)
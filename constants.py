@@ -1,11 +1,186 @@
 """Constants module for trivia app."""
 
+import os
+
 AUTH0_DOMAIN = 'fsnd-bilal.eu.auth0.com'
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstone-trivia'
+# remote: keys fetched from JWKS_URL. file: keys read from JWKS_PATH.
+# local: RSA key of AUTH_PRIVATE_KEY_PATH (or a throwaway one), which can
+# also mint tokens, for tests, benchmarks and air-gapped deploys.
+AUTH_KEY_PROVIDER = os.environ.get('AUTH_KEY_PROVIDER', 'remote')
+JWKS_PATH = os.environ.get('JWKS_PATH')
+JWKS_CACHE_SECONDS = float(os.environ.get('JWKS_CACHE_SECONDS', 600))
+AUTH_PRIVATE_KEY_PATH = os.environ.get('AUTH_PRIVATE_KEY_PATH')
+ROLE_PERMISSIONS = {
+    'admin': ('add-question', 'edit-question', 'delete-question',
+              'play-quiz', 'host-quiz', 'profile-worker'),
+    'user': ('play-quiz',),
+}
 
 QUESTIONS_PER_PAGE = 10
 
+# Group commit: question writes of concurrent requests are committed
+# together, up to GROUP_COMMIT_BATCH_SIZE of them or GROUP_COMMIT_WINDOW
+# seconds after the first, trading that much latency for fewer commits.
+GROUP_COMMIT_ENABLED = os.environ.get('GROUP_COMMIT_ENABLED') == 'true'
+GROUP_COMMIT_BATCH_SIZE = int(os.environ.get('GROUP_COMMIT_BATCH_SIZE', 64))
+GROUP_COMMIT_WINDOW = float(os.environ.get('GROUP_COMMIT_WINDOW', 0.002))
+
+# Question shards: with QUESTION_SHARDS set to comma separated database
+# URLs, questions of category c are stored in shard c % len(shards), and
+# DATABASE_URL keeps every other table plus the directory of question ids.
+# Group commit does not apply to sharded question writes.
+QUESTION_SHARDS = [
+    url.strip() for url in os.environ.get('QUESTION_SHARDS', '').split(',')
+    if url.strip()
+]
+
+ASGI_DB_POOL_SIZE = int(os.environ.get('ASGI_DB_POOL_SIZE', 10))
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_CACHE_BYTES = int(
+    os.environ.get('COMPRESSION_CACHE_BYTES', 16 * 1024 * 1024))
+# (gzip level, brotli quality) per endpoint. Search responses are never
+# cached, so they trade ratio for cheaper per request compression.
+DEFAULT_COMPRESSION_LEVEL = (6, 5)
+COMPRESSION_LEVELS = {
+    'get_questions': (6, 5),
+    'get_questions_by_category': (6, 5),
+    'search_questions': (4, 3),
+}
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true') == 'true'
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL')
+# Number of proxies in front of the app appending to X-Forwarded-For, e.g.
+# 1 behind the Heroku router. Anonymous clients are keyed by the address
+# the outermost of them saw, by the socket peer address with 0.
+RATE_LIMIT_TRUSTED_PROXIES = int(
+    os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', 0))
+# (requests per second, burst, concurrent requests per worker) per route.
+RATE_LIMITS = {
+    'play_quiz': (5, 20, 8),
+    'search_questions': (2, 10, 4),
+}
+
+ROOM_HEARTBEAT_SECONDS = 15
+ROOM_PLAYER_BACKLOG = 16
+# Rooms nobody joined and no question was asked in for ROOM_IDLE_SECONDS
+# are closed, checked every ROOM_EXPIRY_SECONDS.
+ROOM_IDLE_SECONDS = float(os.environ.get('ROOM_IDLE_SECONDS', 1800))
+ROOM_EXPIRY_SECONDS = float(os.environ.get('ROOM_EXPIRY_SECONDS', 60))
+
+ANSWER_BATCH_SIZE = int(os.environ.get('ANSWER_BATCH_SIZE', 100))
+ANSWER_FLUSH_SECONDS = float(os.environ.get('ANSWER_FLUSH_SECONDS', 5))
+LEADERBOARD_DEFAULT_LIMIT = 10
+LEADERBOARD_MAX_LIMIT = 100
+
+QUESTION_INDEX_CHECK_SECONDS = float(
+    os.environ.get('QUESTION_INDEX_CHECK_SECONDS', 60))
+
+QUESTION_CACHE_ENTRIES = int(os.environ.get('QUESTION_CACHE_ENTRIES', 10000))
+QUESTION_CACHE_BYTES = int(
+    os.environ.get('QUESTION_CACHE_BYTES', 8 * 1024 * 1024))
+# Without QUESTION_CACHE_REDIS_URL, changes made by other workers are only
+# seen once cached entries expire. With it, the TTL still bounds staleness
+# when evictions are missed. A lost redis connection is retried after 1s,
+# doubling up to QUESTION_CACHE_RETRY_SECONDS.
+QUESTION_CACHE_TTL = float(os.environ.get('QUESTION_CACHE_TTL', 60))
+QUESTION_CACHE_REDIS_URL = os.environ.get('QUESTION_CACHE_REDIS_URL')
+QUESTION_CACHE_RETRY_SECONDS = float(
+    os.environ.get('QUESTION_CACHE_RETRY_SECONDS', 30))
+
+# Catalog snapshot file memory-mapped by every worker, unset to disable.
+# Workers publish their question changes and map newer snapshots every
+# CATALOG_SYNC_SECONDS.
+CATALOG_SNAPSHOT_PATH = os.environ.get('CATALOG_SNAPSHOT_PATH')
+CATALOG_SYNC_SECONDS = float(os.environ.get('CATALOG_SYNC_SECONDS', 30))
+
+# Quiz packs written to PACKS_DIR, unset to disable. Packs left out of the
+# manifest are removed after PACK_RETENTION_SECONDS.
+PACKS_DIR = os.environ.get('PACKS_DIR')
+PACK_BUILD_SECONDS = float(os.environ.get('PACK_BUILD_SECONDS', 60))
+PACK_RETENTION_SECONDS = float(
+    os.environ.get('PACK_RETENTION_SECONDS', 24 * 60 * 60))
+# (gzip level, brotli quality); packs are compressed once per change.
+# Brotli quality 11 is ~40x slower than 9 on large packs for ~20% less.
+PACK_COMPRESSION_LEVEL = (
+    int(os.environ.get('PACK_GZIP_LEVEL', 9)),
+    int(os.environ.get('PACK_BROTLI_QUALITY', 9)))
+
+CHANGES_DEFAULT_LIMIT = 100
+CHANGES_MAX_LIMIT = 1000
+
+SUGGEST_DEFAULT_LIMIT = 5
+SUGGEST_MAX_LIMIT = 20
+SUGGEST_SNIPPET_LENGTH = 80
+SUGGEST_SCAN_LIMIT = 1000
+SUGGEST_REBUILD_SECONDS = float(os.environ.get('SUGGEST_REBUILD_SECONDS', 300))
+
+# Audit trail of question writes: events are queued, up to
+# AUDIT_QUEUE_SIZE, and written by a background thread in batches of up to
+# AUDIT_BATCH_SIZE, to the audit_events table or, with AUDIT_SINK=file, as
+# JSON lines appended to AUDIT_LOG_PATH. When the queue is full, recording
+# waits up to AUDIT_FULL_TIMEOUT seconds, then drops the event.
+AUDIT_SINK = os.environ.get('AUDIT_SINK', 'database')
+AUDIT_LOG_PATH = os.environ.get('AUDIT_LOG_PATH', 'audit.jsonl')
+AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+AUDIT_WINDOW = float(os.environ.get('AUDIT_WINDOW', 0.5))
+AUDIT_FULL_TIMEOUT = float(os.environ.get('AUDIT_FULL_TIMEOUT', 0))
+AUDIT_RETRY_SECONDS = 1
+
+# Question counts per category are reloaded by every worker, and checked
+# against the questions, every CATEGORY_STATS_REFRESH_SECONDS.
+CATEGORY_STATS_REFRESH_SECONDS = float(
+    os.environ.get('CATEGORY_STATS_REFRESH_SECONDS', 30))
+
+# Near-duplicate questions: texts are compared as sets of
+# DEDUPE_SHINGLE_SIZE character shingles, and new questions at least
+# DEDUPE_THRESHOLD similar (Jaccard) to one are flagged in the response,
+# or rejected with DEDUPE_MODE=reject. Candidates come from an LSH index
+# of DEDUPE_SIGNATURE_SIZE MinHash values in DEDUPE_BANDS bands, which
+# every worker syncs with the change log every DEDUPE_SYNC_SECONDS.
+DEDUPE_MODE = os.environ.get('DEDUPE_MODE', 'flag')
+DEDUPE_THRESHOLD = float(os.environ.get('DEDUPE_THRESHOLD', 0.8))
+DEDUPE_SHINGLE_SIZE = 4
+DEDUPE_SIGNATURE_SIZE = 32
+DEDUPE_BANDS = 8
+DEDUPE_MAX_CANDIDATES = 20
+DEDUPE_MAX_BUCKET = 100
+DEDUPE_SYNC_SECONDS = float(os.environ.get('DEDUPE_SYNC_SECONDS', 10))
+
+# Sampling profiler: stacks of request threads are sampled every
+# PROFILE_INTERVAL seconds while a profile is captured, and all the time
+# when PROFILE_SLOW_SECONDS is set, to keep profiles of slower requests.
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.01))
+PROFILE_DEFAULT_SECONDS = 10
+# Gunicorn kills a sync worker busy with one request for longer than its
+# --timeout (default 30); set WORKER_TIMEOUT when changing it, so captures
+# end before the worker is killed.
+WORKER_TIMEOUT = float(os.environ.get('WORKER_TIMEOUT', 30))
+PROFILE_MAX_SECONDS = max(WORKER_TIMEOUT - 5, 1)
+PROFILE_SLOW_SECONDS = float(os.environ['PROFILE_SLOW_SECONDS']) \
+    if os.environ.get('PROFILE_SLOW_SECONDS') else None
+PROFILE_MAX_STACKS = 5000
+# Sending PROFILE_SIGNAL to a worker writes a PROFILE_SIGNAL_SECONDS profile
+# and its slow request profiles to PROFILE_DIR.
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_SIGNAL = os.environ.get('PROFILE_SIGNAL', 'SIGUSR2')
+PROFILE_SIGNAL_SECONDS = float(os.environ.get('PROFILE_SIGNAL_SECONDS', 30))
+# Samples are attributed to the innermost frame of one of these packages
+# or modules, matched against the path of its file.
+PROFILE_GROUPS = (
+    ('jwt', ('/jose/', '/Crypto/', '/rsa/', '/ecdsa/')),
+    ('sqlalchemy', ('/sqlalchemy/', '/flask_sqlalchemy/', '/psycopg2/',
+                    '/sqlite3/')),
+    ('json', ('/json/', '/simplejson/')),
+    ('compression', ('/flaskr/compression.py', '/gzip.py', '/brotli')),
+    ('wait', ('/threading.py', '/queue.py', '/selectors.py')),
+)
+
 
 class HTTP_STATUS:
     """HTTP Status codes."""
@@ -15,21 +190,27 @@ class HTTP_STATUS:
     BAD_REQUEST = 400
     CREATED = 201
     UNPROCESSABLE_ENTITY = 422
+    CONFLICT = 409
     INTERNAL_SERVER_ERROR = 500
     METHOD_NOT_ALLOWED = 405
     OK = 200
     UNAUTHORIZED = 401
     FORBIDDEN = 403
+    TOO_MANY_REQUESTS = 429
+    SERVICE_UNAVAILABLE = 503
 
 
 ERROR_MESSAGES = {
     HTTP_STATUS.NOT_FOUND: 'Resource Not Found',
     HTTP_STATUS.BAD_REQUEST: 'Bad Request',
     HTTP_STATUS.UNPROCESSABLE_ENTITY: 'Unprocessable Entity',
+    HTTP_STATUS.CONFLICT: 'Conflict',
     HTTP_STATUS.INTERNAL_SERVER_ERROR: 'Internal Server Error',
     HTTP_STATUS.METHOD_NOT_ALLOWED: 'Method Not Allowed',
     HTTP_STATUS.FORBIDDEN: 'Forbidden Request',
-    HTTP_STATUS.UNAUTHORIZED: 'Unauthorized Request'
+    HTTP_STATUS.UNAUTHORIZED: 'Unauthorized Request',
+    HTTP_STATUS.TOO_MANY_REQUESTS: 'Too Many Requests',
+    HTTP_STATUS.SERVICE_UNAVAILABLE: 'Service Unavailable'
 }
 
 
@@ -0,0 +1,247 @@
+"""Test fixtures: seed data loaded once, each test rolled back."""
+
+import os
+import re
+import tempfile
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL') or 'sqlite://'
+# The app reads its config when it is imported, so import fixtures first.
+os.environ.setdefault('DATABASE_URL', TEST_DATABASE_URL)
+os.environ.setdefault('AUTH_KEY_PROVIDER', 'local')
+# The audit writer thread would write outside the transaction of a test.
+os.environ.setdefault('AUDIT_SINK', 'file')
+os.environ.setdefault(
+    'AUDIT_LOG_PATH', os.path.join(tempfile.mkdtemp(), 'audit.jsonl'))
+# Tests sync the duplicate index themselves, in their transaction.
+os.environ.setdefault('DEDUPE_SYNC_SECONDS', '3600')
+
+from sqlalchemy import event  # noqa: E402
+
+from models import db, setup_db, Category  # noqa: E402
+from constants import ROLE_PERMISSIONS  # noqa: E402
+from flaskr.audit import audit_log  # noqa: E402
+from flaskr.category_stats import category_stats  # noqa: E402
+from flaskr.dedupe import duplicate_index  # noqa: E402
+from flaskr.keys import key_provider  # noqa: E402
+from flaskr.leaderboard import scoreboard  # noqa: E402
+from flaskr.metrics import metrics  # noqa: E402
+from flaskr.profiler import profiler  # noqa: E402
+from flaskr.question_cache import question_cache  # noqa: E402
+from flaskr.question_index import question_index  # noqa: E402
+from flaskr.ratelimit import rate_limiter  # noqa: E402
+from flaskr.suggest import suggest_index  # noqa: E402
+
+SEED_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'trivia.psql')
+COPY_STATEMENT = re.compile(r'^COPY public\.(\w+) \(([^)]*)\) FROM stdin;$')
+COPY_ESCAPE = re.compile(r'\\(.)')
+COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+                'v': '\v'}
+
+_database_ready = False
+
+
+def read_seed(path=SEED_PATH):
+    """
+    Read rows of the COPY blocks of a pg_dump file.
+
+    :param path:
+    :return: table name -> list of rows as dicts
+    """
+    tables = {}
+    rows = None
+    with open(path, encoding='utf-8') as dump:
+        for line in dump:
+            line = line.rstrip('\n')
+            if rows is None:
+                match = COPY_STATEMENT.match(line)
+                if match:
+                    columns = [name.strip() for name in
+                               match.group(2).split(',')]
+                    rows = tables.setdefault(match.group(1), [])
+            elif line == '\\.':
+                rows = None
+            else:
+                rows.append(dict(zip(columns, (
+                    None if value == '\\N' else COPY_ESCAPE.sub(
+                        lambda escape: COPY_ESCAPES.get(
+                            escape.group(1), escape.group(1)), value)
+                    for value in line.split('\t')))))
+    return tables
+
+
+def load_seed(tables):
+    """
+    Insert seed rows, converting values to the types of the model columns.
+
+    :param tables:
+    :return:
+    """
+    metadata = db.Model.metadata
+    with db.engine.begin() as connection:
+        for name, rows in tables.items():
+            table = metadata.tables[name]
+            connection.execute(table.insert(), [
+                {column: value if value is None
+                 else table.c[column].type.python_type(value)
+                 for column, value in row.items()}
+                for row in rows
+            ])
+            if db.engine.dialect.name == 'postgresql':
+                connection.execute(
+                    f"SELECT setval('{name}_id_seq', "
+                    f"(SELECT MAX(id) FROM {name}))")
+
+
+def enable_sqlite_savepoints(engine):
+    """
+    Let pysqlite emit SAVEPOINT by taking over BEGIN from the driver.
+
+    :param engine:
+    :return:
+    """
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(connection):
+        connection.execute('BEGIN')
+
+    # Reconnect so connections opened so far get the setting as well.
+    engine.dispose()
+
+
+def setup_database(app):
+    """
+    Bind app to the test database and load seed data, once per process.
+
+    Tests use TEST_DATABASE_URL, in-memory SQLite by default. Every process
+    gets its own in-memory database, so tests can be spread over worker
+    processes. Seed data is only loaded into an empty database, so a
+    persistent TEST_DATABASE_URL is loaded by the first run and reused.
+
+    :param app:
+    :return:
+    """
+    global _database_ready
+    if _database_ready:
+        return
+
+    setup_db(app, TEST_DATABASE_URL)
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            enable_sqlite_savepoints(db.engine)
+            db.create_all()
+        seeded = db.session.query(Category.query.exists()).scalar()
+        db.session.remove()
+        if not seeded:
+            load_seed(read_seed())
+    _database_ready = True
+
+
+def auth_header(role, sub=None):
+    """
+    Get Authorization header with a token minted for role.
+
+    :param role:
+    :param sub:
+    :return:
+    """
+    token = key_provider.mint(
+        ROLE_PERMISSIONS[role], sub=sub or f'test|{role}')
+    return {'Authorization': f'Bearer {token}'}
+
+
+def reset_app_state():
+    """
+    Reset in-process state of the app, so tests do not see each other.
+
+    Indexes are rebuilt from the database on next use.
+
+    :return:
+    """
+    audit_log.flush()
+    rate_limiter.reset()
+    metrics.reset()
+    profiler.reset()
+    scoreboard.reset()
+    question_cache.cache.clear()
+    question_index.built = False
+    category_stats.loaded = False
+    duplicate_index.built = False
+    suggest_index.built = False
+
+
+class TransactionFixture:
+    """
+    Run a test inside a transaction rolled back when it ends.
+
+    The app session is bound to a connection holding the outer transaction
+    and works in a SAVEPOINT, restarted whenever the app commits or rolls
+    back, so nothing a test writes is ever committed.
+    """
+
+    def __init__(self, app):
+        """
+        Init method.
+
+        :param app:
+        """
+        self.app = app
+        self.connection = None
+        self.transaction = None
+        self.session = None
+
+    def begin(self):
+        """
+        Begin transaction and bind the app session to it.
+
+        :return:
+        """
+        with self.app.app_context():
+            self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.session
+        db.session = db.create_scoped_session(
+            options={'bind': self.connection, 'binds': {}})
+        event.listen(db.session, 'after_begin', self._start_savepoint)
+        event.listen(
+            db.session, 'after_transaction_end', self._restart_savepoint)
+
+    def rollback(self):
+        """
+        Roll back everything done by the test and restore the app session.
+
+        :return:
+        """
+        db.session.remove()
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
+
+    @staticmethod
+    def _start_savepoint(session, transaction, connection):
+        """
+        Open a SAVEPOINT when a new session starts using the connection.
+
+        :param session:
+        :param transaction:
+        :param connection:
+        :return:
+        """
+        if not transaction.nested and session.transaction is transaction:
+            session.begin_nested()
+
+    @staticmethod
+    def _restart_savepoint(session, transaction):
+        """
+        Open a new SAVEPOINT when the app ended the previous one.
+
+        :param session:
+        :param transaction:
+        :return:
+        """
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
@@ -1,18 +1,47 @@
 """Init module for trivia app."""
 
 import os
-from flask import Flask, json, request, abort, jsonify
+import math
+from flask import Flask, json, request, abort, jsonify, Response
 from sqlalchemy.orm import query
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 
+from .audit import audit_log
 from .auth import AuthError, requires_auth
-from models import setup_db, Question, Category
+from .compression import compress_response
+from .ratelimit import rate_limited
+from .singleflight import coalesced
+from .metrics import metrics
+from .rooms import rooms
+from .leaderboard import scoreboard
+from .background import PeriodicTask
+from .catalog import catalog
+from .category_stats import category_stats
+from .dedupe import duplicate_index
+from .packs import pack_builder
+from .profiler import profiler, collapse
+from .question_index import question_index
+from .question_cache import question_cache
+from .suggest import suggest_index
+from .quiz import draw_question, get_quiz_options
+from models import (
+  setup_db, Question, Category, QuestionChange, group_committer,
+  shard_router
+)
 from utils import (
-  paginated_data, get_formatted_categories, error_response
+  paginated_data, get_formatted_categories, error_response,
+  get_requested_fields, get_requested_includes, query_questions
+)
+from constants import (
+  QUESTIONS_PER_PAGE, HTTP_STATUS, ANSWER_BATCH_SIZE, ANSWER_FLUSH_SECONDS,
+  LEADERBOARD_DEFAULT_LIMIT, LEADERBOARD_MAX_LIMIT,
+  QUESTION_INDEX_CHECK_SECONDS, SUGGEST_DEFAULT_LIMIT, SUGGEST_MAX_LIMIT,
+  SUGGEST_REBUILD_SECONDS, CATALOG_SYNC_SECONDS, CHANGES_DEFAULT_LIMIT,
+  CHANGES_MAX_LIMIT, PACK_BUILD_SECONDS, PROFILE_DEFAULT_SECONDS,
+  PROFILE_MAX_SECONDS, PROFILE_DIR, CATEGORY_STATS_REFRESH_SECONDS,
+  DEDUPE_SYNC_SECONDS, ROOM_EXPIRY_SECONDS
 )
-from constants import QUESTIONS_PER_PAGE, HTTP_STATUS
 
 
 app = Flask(__name__)
@@ -20,6 +49,77 @@ setup_db(app)
 
 CORS(app, resources={r'*': {'origins': '*'}})
 
+scoreboard_flush = PeriodicTask(
+    app, 'scoreboard-flush', ANSWER_FLUSH_SECONDS, scoreboard.flush,
+    run_on_stop=True)
+question_index_check = PeriodicTask(
+    app, 'question-index-check', QUESTION_INDEX_CHECK_SECONDS,
+    question_index.verify)
+suggest_rebuild = PeriodicTask(
+    app, 'suggest-rebuild', SUGGEST_REBUILD_SECONDS,
+    lambda: suggest_index.build(catalog.snapshot))
+catalog_sync = PeriodicTask(
+    app, 'catalog-sync', CATALOG_SYNC_SECONDS, catalog.sync,
+    run_on_stop=True)
+pack_build = PeriodicTask(
+    app, 'quiz-packs', PACK_BUILD_SECONDS, pack_builder.build)
+category_stats_refresh = PeriodicTask(
+    app, 'category-stats', CATEGORY_STATS_REFRESH_SECONDS,
+    category_stats.refresh)
+duplicate_sync = PeriodicTask(
+    app, 'duplicate-index', DEDUPE_SYNC_SECONDS, duplicate_index.sync)
+room_expiry = PeriodicTask(
+    app, 'room-expiry', ROOM_EXPIRY_SECONDS, rooms.expire)
+metrics.gauge('group_commit.mean_size', group_committer.mean_group_size)
+if PROFILE_DIR:
+    profiler.install_signal_handler(PROFILE_DIR)
+
+
+@app.before_first_request
+def build_question_index():
+    """
+    Build question indexes when the worker starts serving.
+
+    With a catalog snapshot, indexes are built from it without querying
+    the database.
+
+    :return:
+    """
+    catalog.load()
+    if catalog.path:
+        catalog_sync.ensure_started()
+    if pack_builder.directory:
+        pack_build.ensure_started()
+    question_index.ensure_built(catalog.snapshot)
+    question_index_check.ensure_started()
+    suggest_index.ensure_built(catalog.snapshot)
+    suggest_rebuild.ensure_started()
+    category_stats.ensure_loaded()
+    category_stats_refresh.ensure_started()
+    if duplicate_index.mode != 'off':
+        duplicate_sync.ensure_started()
+
+
+@app.before_request
+def begin_request_profile():
+    """
+    Register request for the sampling profiler.
+
+    :return:
+    """
+    profiler.begin_request(f'{request.method} {request.endpoint}')
+
+
+@app.teardown_request
+def end_request_profile(error):
+    """
+    Unregister request from the sampling profiler.
+
+    :param error:
+    :return:
+    """
+    profiler.end_request()
+
 
 @app.after_request
 def after_request(response):
@@ -33,41 +133,245 @@ def after_request(response):
         'Access-Control-Allow-Headers', 'Content-Type, Authorization')
     response.headers.add(
         'Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, DELETE')
-    return response
+    return compress_response(response)
 
 
 @app.route('/categories')
+@coalesced
 def get_categories():
     """
     Return all categories.
 
+    With include=counts, also returns the number of questions of each
+    category, from the copy of category_stats held by the worker.
+
+    :return:
+    """
+    includes = get_requested_includes(request.args, allowed={'counts'})
+    categories = get_formatted_categories()
+    response = {
+        'success': True,
+        'categories': categories,
+    }
+    if 'counts' in includes:
+        category_stats.ensure_loaded()
+        counts = category_stats.counts()
+        response['counts'] = {
+            category_id: counts.get(category_id, 0)
+            for category_id in categories
+        }
+
+    return jsonify(response)
+
+
+@app.route('/categories/stats')
+def get_category_stats():
+    """
+    Return number of questions and difficulty histogram of all categories.
+
     :return:
     """
+    category_stats.ensure_loaded()
+    histograms = category_stats.histograms()
+
     return jsonify({
         'success': True,
-        'categories': get_formatted_categories(),
-        })
+        'categories': [
+            {
+                'id': category_id,
+                'type': category_type,
+                'questions': sum(histograms.get(category_id, {}).values()),
+                'difficulties': histograms.get(category_id, {}),
+            }
+            for category_id, category_type in
+            get_formatted_categories().items()
+        ],
+        'total_questions': sum(category_stats.counts().values())
+    })
 
 
 @app.route('/questions')
+@coalesced
 def get_questions():
     """
     Return paginated questions.
 
     :return:
     """
+    includes = get_requested_includes(
+        request.args, allowed={'categories'}, default={'categories'})
+    question_index.ensure_built()
     paginated_response, questions_count = paginated_data(
-        request, Question, Question.id, QUESTIONS_PER_PAGE)
+        request, Question, Question.id, QUESTIONS_PER_PAGE,
+        total=question_index.count())
 
     if not paginated_response:
         abort(HTTP_STATUS.NOT_FOUND)
 
-    return jsonify({
+    response = {
         'success': True,
         'questions': paginated_response,
         'total_questions': questions_count,
-        'categories': get_formatted_categories(),
         'current_category': None
+    }
+    if 'categories' in includes:
+        response['categories'] = get_formatted_categories()
+
+    return jsonify(response)
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    Return metrics of the worker serving the request.
+
+    :return:
+    """
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'metrics': metrics.snapshot(),
+    })
+
+
+@app.route('/admin/profile')
+@requires_auth('profile-worker')
+def profile_worker(token):
+    """
+    Sample stacks of the threads of this worker for some seconds.
+
+    Returns the share of samples of each group and the most sampled
+    stacks, or every stack in collapsed format with format=collapsed.
+
+    :param token:
+    :return:
+    """
+    try:
+        seconds = float(request.args.get('seconds', PROFILE_DEFAULT_SECONDS))
+    except ValueError:
+        abort(HTTP_STATUS.BAD_REQUEST)
+    threads = request.args.get('threads', 'requests')
+    output = request.args.get('format', 'json')
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or \
+            threads not in ('requests', 'all') or \
+            output not in ('json', 'collapsed'):
+        abort(HTTP_STATUS.BAD_REQUEST)
+
+    profile = profiler.capture(seconds, all_threads=threads == 'all')
+    warning = None
+    if not any(not stack.startswith('thread ') for stack in profile.stacks):
+        warning = ('No other request was sampled. A worker running a '
+                   'single thread cannot serve requests while it profiles; '
+                   'run it with --threads, or signal it with PROFILE_DIR '
+                   'set.')
+    if output == 'collapsed':
+        response = Response(collapse(profile.stacks), mimetype='text/plain')
+        if warning:
+            response.headers['Warning'] = f'199 - "{warning}"'
+        return response
+    payload = {
+        'success': True,
+        'pid': os.getpid(),
+        'seconds': seconds,
+        'interval': profiler.interval,
+        **profile.summary()
+    }
+    if warning:
+        payload['warning'] = warning
+    return jsonify(payload)
+
+
+@app.route('/admin/profile/slow')
+@requires_auth('profile-worker')
+def get_slow_request_profiles(token):
+    """
+    Get samples of requests slower than PROFILE_SLOW_SECONDS, by route.
+
+    :param token:
+    :return:
+    """
+    output = request.args.get('format', 'json')
+    if output not in ('json', 'collapsed'):
+        abort(HTTP_STATUS.BAD_REQUEST)
+    profiles = profiler.slow_profiles()
+    route = request.args.get('route')
+    if route is not None:
+        if route not in profiles:
+            abort(HTTP_STATUS.NOT_FOUND)
+        profiles = {route: profiles[route]}
+
+    if output == 'collapsed':
+        return Response(''.join(
+            collapse(profile.stacks) for profile in profiles.values()),
+            mimetype='text/plain')
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'slow_seconds': profiler.slow_seconds,
+        'routes': {
+            label: dict(profile.summary(), requests=profile.requests)
+            for label, profile in profiles.items()
+        }
+    })
+
+
+@app.route('/questions/changes')
+def get_question_changes():
+    """
+    Get question changes after a sequence number, oldest first.
+
+    Clients pass the ``next_since`` of the previous page as ``since``
+    until ``has_more`` is false, then keep it for their next sync.
+
+    :return:
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', CHANGES_DEFAULT_LIMIT))
+    except ValueError:
+        abort(HTTP_STATUS.BAD_REQUEST)
+    if since < 0 or limit < 1:
+        abort(HTTP_STATUS.BAD_REQUEST)
+    limit = min(limit, CHANGES_MAX_LIMIT)
+
+    changes = QuestionChange.query.filter(
+        QuestionChange.sequence > since).order_by(
+        QuestionChange.sequence).limit(limit + 1).all()
+
+    return jsonify({
+        'success': True,
+        'changes': [change.format() for change in changes[:limit]],
+        'next_since': changes[:limit][-1].sequence if changes else since,
+        'has_more': len(changes) > limit
+    })
+
+
+@app.route('/packs/<filename>')
+def get_pack(filename):
+    """
+    Get quiz pack manifest or file, for deploys without a static server.
+
+    :param filename:
+    :return:
+    """
+    return pack_builder.response(filename)
+
+
+@app.route('/questions/<int:question_id>')
+def get_question(question_id):
+    """
+    Get question.
+
+    :param question_id:
+    :return:
+    """
+    question = question_cache.get(question_id)
+    if not question:
+        abort(HTTP_STATUS.NOT_FOUND)
+
+    return jsonify({
+        'success': True,
+        'question': question
     })
 
 
@@ -80,11 +384,13 @@ def delete_question(token, question_id):
     :param question_id:
     :return:
     """
-    question = Question.query.get(question_id)
+    question = shard_router.get(question_id)
     if not question:
         abort(HTTP_STATUS.NOT_FOUND)
 
+    before = question.format()
     question.delete()
+    audit_log.record(token, 'delete', question_id, before=before)
 
     return jsonify({
         'success': True
@@ -104,12 +410,18 @@ def add_question(token):
     if not question:
         abort(HTTP_STATUS.BAD_REQUEST)
 
+    duplicates = duplicate_index.check(question.get('question'))
+    if duplicates and duplicate_index.mode == 'reject':
+        return error_response(HTTP_STATUS.CONFLICT, duplicates=duplicates)
+
     question = Question(**question)
     question.insert()
+    audit_log.record(token, 'insert', question.id, after=question.format())
 
     return jsonify({
         'success': True,
-        'id': question.id
+        'id': question.id,
+        'duplicates': duplicates
     }), HTTP_STATUS.CREATED
 
 
@@ -121,24 +433,28 @@ def edit_question(token, question_id):
 
     :return:
     """
-    question = Question.query.filter_by(id=question_id).first()
+    question = shard_router.get(question_id)
     if not question:
         abort(HTTP_STATUS.NOT_FOUND)
 
+    before = question.format()
     request_data = request.get_json()
     question.question = request_data.get('question')
     question.answer = request_data.get('answer')
     question.category = request_data.get('category')
     question.difficulty = request_data.get('difficulty')
     question.update()
+    after = question_cache.get(question_id)
+    audit_log.record(token, 'update', question_id, before=before, after=after)
 
     return jsonify({
         'success': True,
-        'question': question.format()
+        'question': after
     }), HTTP_STATUS.CREATED
 
 
 @app.route('/questions/search', methods=['POST'])
+@rate_limited('search_questions')
 def search_questions():
     """
     Search question.
@@ -147,14 +463,33 @@ def search_questions():
     :return:
     """
     search_term = request.get_json().get('searchTerm')
-    questions = [question.format() for question in Question.query.filter(
-        Question.question.ilike(f'%{search_term}%'))]
+    fields = get_requested_fields(request.args, Question)
+    questions = query_questions(
+        fields, Question.question.ilike(f'%{search_term}%'))
     return jsonify({
         'success': True,
         'questions': questions,
     })
 
 
+@app.route('/questions/suggest')
+def suggest_questions():
+    """
+    Suggest questions and categories for a partially typed search.
+
+    :return:
+    """
+    prefix = request.args.get('q', '').strip()
+    limit = request.args.get('limit', SUGGEST_DEFAULT_LIMIT, type=int)
+    if not prefix or limit < 1:
+        abort(HTTP_STATUS.BAD_REQUEST)
+
+    suggest_index.ensure_built()
+    suggestions = suggest_index.suggest(prefix, min(limit, SUGGEST_MAX_LIMIT))
+
+    return jsonify(dict(suggestions, success=True))
+
+
 @app.route('/categories/<int:category_id>/questions')
 def get_questions_by_category(category_id):
     """
@@ -167,9 +502,9 @@ def get_questions_by_category(category_id):
     if not category:
         abort(HTTP_STATUS.NOT_FOUND)
 
-    questions = [
-        question.format()
-        for question in Question.query.filter_by(category=category_id)]
+    fields = get_requested_fields(request.args, Question)
+    questions = query_questions(
+        fields, Question.category == category_id, category=category_id)
 
     return jsonify({
         'success': True,
@@ -181,6 +516,7 @@ def get_questions_by_category(category_id):
 
 @app.route('/quizzes', methods=['POST'])
 @requires_auth('play-quiz')
+@rate_limited('play_quiz')
 def play_quiz(token):
     """
     Play quiz.
@@ -189,25 +525,224 @@ def play_quiz(token):
     """
     request_data = request.get_json()
     category = request_data.get('quiz_category')
-    previous_questions = request_data.get('previous_questions', [])
+    previous_questions = request_data.get('previous_questions') or []
+
+    if not category:
+        abort(HTTP_STATUS.BAD_REQUEST)
+
+    try:
+        previous_questions = [int(id_) for id_ in previous_questions]
+    except (TypeError, ValueError):
+        abort(HTTP_STATUS.BAD_REQUEST)
+
+    options = get_quiz_options(request_data)
+
+    return jsonify({
+        'success': True,
+        'question': draw_question(
+            category.get('id'), previous_questions, **options)
+    })
 
+
+def normalize_answer(answer):
+    """
+    Normalize answer for comparison.
+
+    :param answer:
+    :return:
+    """
+    return ' '.join(str(answer).lower().split())
+
+
+@app.route('/answers', methods=['POST'])
+@requires_auth('play-quiz')
+def submit_answer(token):
+    """
+    Submit answer to a question and score it for the token subject.
+
+    Only the first answer of a user to a question is scored. Answers are
+    buffered and written in batches by a background thread, leaderboards
+    are updated in memory right away.
+
+    :return:
+    """
+    request_data = request.get_json()
+    if not request_data or 'question_id' not in request_data \
+            or 'answer' not in request_data:
+        abort(HTTP_STATUS.BAD_REQUEST)
+    question_id = request_data['question_id']
+    if not isinstance(question_id, int) or isinstance(question_id, bool):
+        abort(HTTP_STATUS.BAD_REQUEST)
+
+    question = shard_router.get(question_id)
+    if not question:
+        abort(HTTP_STATUS.NOT_FOUND)
+
+    correct = normalize_answer(request_data['answer']) == \
+        normalize_answer(question.answer)
+
+    scoreboard.ensure_loaded()
+    pending = scoreboard.record(token.get('sub'), question, correct)
+    if pending is None:
+        return error_response(HTTP_STATUS.CONFLICT)
+    scoreboard_flush.ensure_started()
+    if pending >= ANSWER_BATCH_SIZE:
+        scoreboard_flush.wake()
+
+    # A wrong answer does not reveal the expected one.
+    response = {
+        'success': True,
+        'correct': correct
+    }
+    if correct:
+        response['answer'] = question.answer
+    return jsonify(response), HTTP_STATUS.CREATED
+
+
+def get_leaderboard_limit():
+    """
+    Get number of leaderboard entries requested by the limit argument.
+
+    :return:
+    """
+    limit = request.args.get(
+        'limit', LEADERBOARD_DEFAULT_LIMIT, type=int)
+    if limit < 1:
+        abort(HTTP_STATUS.BAD_REQUEST)
+    return min(limit, LEADERBOARD_MAX_LIMIT)
+
+
+@app.route('/leaderboard')
+def get_leaderboard():
+    """
+    Get best scores over all categories.
+
+    :return:
+    """
+    limit = get_leaderboard_limit()
+    scoreboard.ensure_loaded()
+
+    return jsonify({
+        'success': True,
+        'leaderboard': scoreboard.top(limit)
+    })
+
+
+@app.route('/categories/<int:category_id>/leaderboard')
+def get_category_leaderboard(category_id):
+    """
+    Get best scores of a category.
+
+    :param category_id:
+    :return:
+    """
+    category = Category.query.get(category_id)
+    if not category:
+        abort(HTTP_STATUS.NOT_FOUND)
+
+    limit = get_leaderboard_limit()
+    scoreboard.ensure_loaded()
+
+    return jsonify({
+        'success': True,
+        'leaderboard': scoreboard.top(limit, category_id),
+        'current_category': category.format()
+    })
+
+
+def get_hosted_room(room_id, token):
+    """
+    Get room hosted by the token subject.
+
+    :param room_id:
+    :param token:
+    :return:
+    """
+    room = rooms.get(room_id)
+    if not room:
+        abort(HTTP_STATUS.NOT_FOUND)
+    if room.host != token.get('sub'):
+        abort(HTTP_STATUS.FORBIDDEN)
+    return room
+
+
+@app.route('/rooms', methods=['POST'])
+@requires_auth('host-quiz')
+def create_room(token):
+    """
+    Create live quiz room for a category.
+
+    :return:
+    """
+    request_data = request.get_json()
+    category = request_data.get('quiz_category') if request_data else None
     if not category:
         abort(HTTP_STATUS.BAD_REQUEST)
 
-    category_id = category.get('id')
-    filters = [Question.id.notin_(previous_questions)]
-    if category_id:
-        filters.append(Question.category == category_id)
-    questions = Question.query.filter(*filters)
+    room = rooms.create(token.get('sub'), category.get('id'))
+    room_expiry.ensure_started()
 
-    questions = [question.format() for question in questions]
-    random_question = random.choice(questions) if questions else None
     return jsonify({
         'success': True,
-        'question': random_question
+        'room': room.format()
+    }), HTTP_STATUS.CREATED
+
+
+@app.route('/rooms/<room_id>/events')
+@requires_auth('play-quiz')
+def join_room(token, room_id):
+    """
+    Join room and stream its questions as Server-Sent Events.
+
+    :param room_id:
+    :return:
+    """
+    room = rooms.get(room_id)
+    if not room:
+        abort(HTTP_STATUS.NOT_FOUND)
+
+    return Response(
+        room.stream(room.join()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/rooms/<room_id>/questions', methods=['POST'])
+@requires_auth('host-quiz')
+def next_room_question(token, room_id):
+    """
+    Draw next question of room once and push it to all players.
+
+    :param room_id:
+    :return:
+    """
+    room = get_hosted_room(room_id, token)
+
+    question = room.ask(
+        lambda asked: draw_question(room.category_id, asked))
+
+    return jsonify({
+        'success': True,
+        'question': question,
+        'players': room.players
     })
 
 
+@app.route('/rooms/<room_id>', methods=['DELETE'])
+@requires_auth('host-quiz')
+def close_room(token, room_id):
+    """
+    Close room and disconnect its players.
+
+    :param room_id:
+    :return:
+    """
+    rooms.close(get_hosted_room(room_id, token))
+
+    return jsonify({
+        'success': True
+    }), HTTP_STATUS.NO_CONTENT
+
+
 # Error Handling
 @app.errorhandler(AuthError)
 def auth_error(error):
@@ -283,6 +818,32 @@ def internal_server_error(error):
     return error_response(HTTP_STATUS.INTERNAL_SERVER_ERROR)
 
 
+@app.errorhandler(HTTP_STATUS.TOO_MANY_REQUESTS)
+def too_many_requests(error):
+    """
+    Error handler for status code 429.
+
+    :param error:
+    :return:
+    """
+    response, status = error_response(HTTP_STATUS.TOO_MANY_REQUESTS)
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after:
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response, status
+
+
+@app.errorhandler(HTTP_STATUS.SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """
+    Error handler for status code 503.
+
+    :param error:
+    :return:
+    """
+    return error_response(HTTP_STATUS.SERVICE_UNAVAILABLE)
+
+
 @app.errorhandler(HTTP_STATUS.METHOD_NOT_ALLOWED)
 def method_not_allowed(error):
     """
@@ -0,0 +1,520 @@
+"""
+ASGI serving mode for trivia app.
+
+Read routes are served natively with async database access (asyncpg for
+Postgres, aiosqlite for SQLite) and keep the URL and JSON contract of the
+Flask routes. Quiz draws run the in-process question index and cache of
+the Flask route in the default executor. Every other request is handed
+to the Flask app. Run it with::
+
+    gunicorn flaskr.asgi:app -k uvicorn.workers.UvicornWorker
+"""
+
+import asyncio
+import json
+import math
+import os
+import re
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+
+from models import Question
+from utils import get_requested_fields, get_requested_includes
+from constants import (
+    QUESTIONS_PER_PAGE, HTTP_STATUS, ERROR_MESSAGES, ASGI_DB_POOL_SIZE,
+    QUESTION_SHARDS
+)
+from . import app as flask_app
+from .auth import (
+    AuthError, parse_auth_header, verify_decode_jwt, check_permissions
+)
+from .quiz import draw_question, get_quiz_options
+from .ratelimit import rate_limiter, identify
+
+# questions.category is an integer once migrated, see migrations/.
+CATEGORY_MATCH = 'category = ?'
+RESPONSE_HEADERS = [
+    (b'content-type', b'application/json'),
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type, Authorization'),
+    (b'access-control-allow-methods', b'GET, POST, PUT, PATCH, DELETE'),
+]
+
+
+class HTTPError(Exception):
+    """Abort an async route with an http status."""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class Database:
+    """Async connection to the trivia database."""
+
+    def __init__(self, url):
+        """
+        Init method.
+
+        :param url:
+        """
+        self.url = url
+        self.pool = None
+        self.connection = None
+
+    async def connect(self):
+        """
+        Open connection pool for the configured database url.
+
+        :return:
+        """
+        if self.url.startswith(('postgres://', 'postgresql://')):
+            import asyncpg
+            self.pool = await asyncpg.create_pool(
+                self.url, min_size=1, max_size=ASGI_DB_POOL_SIZE)
+        elif self.url.startswith('sqlite'):
+            import aiosqlite
+            path = self.url.split(':///', 1)[1] \
+                if ':///' in self.url else ':memory:'
+            self.connection = await aiosqlite.connect(path)
+        else:
+            raise ValueError(f'Unsupported database url: {self.url}')
+
+    async def close(self):
+        """
+        Close connection pool.
+
+        :return:
+        """
+        if self.pool:
+            await self.pool.close()
+        if self.connection:
+            await self.connection.close()
+
+    async def fetch(self, query, *args):
+        """
+        Run query with ``?`` placeholders and return rows as tuples.
+
+        :param query:
+        :param args:
+        :return:
+        """
+        if self.pool:
+            index = iter(range(1, len(args) + 1))
+            query = re.sub(r'\?', lambda match: f'${next(index)}', query)
+            return [tuple(row) for row in await self.pool.fetch(query, *args)]
+
+        async with self.connection.execute(query, args) as cursor:
+            return await cursor.fetchall()
+
+
+database = Database(os.environ.get('DATABASE_URL', ''))
+
+
+def question_columns(fields):
+    """
+    Get select list of the requested question fields.
+
+    :param fields: None for all fields
+    :return:
+    """
+    return ', '.join(fields or Question.FIELDS)
+
+
+def format_questions(rows, fields):
+    """
+    Format question rows like Question.format(), or the requested fields.
+
+    :param rows:
+    :param fields: None for all fields
+    :return:
+    """
+    return [dict(zip(fields or Question.FIELDS, row)) for row in rows]
+
+
+def query_int(request, name, default):
+    """
+    Get integer query argument, falling back to default like Flask does.
+
+    :param request:
+    :param name:
+    :param default:
+    :return:
+    """
+    try:
+        return int(request['args'][name])
+    except (KeyError, ValueError):
+        return default
+
+
+async def authorize(request, permission):
+    """
+    Verify bearer token and permission of request.
+
+    Token verification blocks on the JWKS fetch, so it runs in the default
+    executor instead of the event loop.
+
+    :param request:
+    :param permission:
+    :return:
+    """
+    token = parse_auth_header(request['headers'].get('authorization'))
+    payload = await asyncio.get_running_loop().run_in_executor(
+        None, verify_decode_jwt, token)
+    check_permissions(permission, payload)
+    return payload
+
+
+@asynccontextmanager
+async def rate_limited(request, name, payload=None):
+    """
+    Apply the limits configured under name, like the Flask decorator.
+
+    The bucket may live in redis, so it is taken in the default executor.
+
+    :param request:
+    :param name:
+    :param payload: verified JWT payload, to key the client by subject
+    :return:
+    """
+    client = identify(payload, request['client'],
+                      request['headers'].get('x-forwarded-for'))
+    slot = await asyncio.get_running_loop().run_in_executor(
+        None, rate_limiter.admit, name, client)
+    try:
+        yield
+    finally:
+        if slot is not None:
+            slot.release()
+
+
+async def get_formatted_categories(request):
+    """
+    Get all categories formatted.
+
+    :param request:
+    :return:
+    """
+    rows = await request['database'].fetch(
+        'SELECT id, type FROM categories ORDER BY type')
+    return {category_id: category_type for category_id, category_type in rows}
+
+
+async def get_categories(request):
+    """
+    Return all categories.
+
+    :param request:
+    :return:
+    """
+    includes = get_requested_includes(request['args'], allowed={'counts'})
+    categories = await get_formatted_categories(request)
+    response = {
+        'success': True,
+        'categories': categories,
+    }
+    if 'counts' in includes:
+        counts = dict(await request['database'].fetch(
+            'SELECT category, SUM(questions) FROM category_stats '
+            'GROUP BY category'))
+        response['counts'] = {
+            category_id: counts.get(category_id, 0)
+            for category_id in categories
+        }
+    return response
+
+
+async def get_questions(request):
+    """
+    Return paginated questions.
+
+    :param request:
+    :return:
+    """
+    includes = get_requested_includes(
+        request['args'], allowed={'categories'}, default={'categories'})
+    fields = get_requested_fields(request['args'], Question)
+    page_limit = query_int(request, 'limit', QUESTIONS_PER_PAGE)
+    selected_page = query_int(request, 'page', 1)
+    if selected_page < 1 or page_limit < 1:
+        raise HTTPError(HTTP_STATUS.NOT_FOUND)
+
+    rows = await request['database'].fetch(
+        f'SELECT {question_columns(fields)} FROM questions ORDER BY id '
+        f'LIMIT ? OFFSET ?', page_limit, page_limit * (selected_page - 1))
+    if not rows:
+        raise HTTPError(HTTP_STATUS.NOT_FOUND)
+    (questions_count,), = await request['database'].fetch(
+        'SELECT COUNT(*) FROM questions')
+
+    response = {
+        'success': True,
+        'questions': format_questions(rows, fields),
+        'total_questions': questions_count,
+        'current_category': None
+    }
+    if 'categories' in includes:
+        response['categories'] = await get_formatted_categories(request)
+    return response
+
+
+async def search_questions(request):
+    """
+    Search question.
+
+    :param request:
+    :return:
+    """
+    async with rate_limited(request, 'search_questions'):
+        if not isinstance(request['json'], dict):
+            raise HTTPError(HTTP_STATUS.BAD_REQUEST)
+
+        search_term = request['json'].get('searchTerm')
+        fields = get_requested_fields(request['args'], Question)
+        rows = await request['database'].fetch(
+            f'SELECT {question_columns(fields)} FROM questions '
+            f'WHERE LOWER(question) LIKE LOWER(?) ORDER BY id',
+            f'%{search_term}%')
+    return {
+        'success': True,
+        'questions': format_questions(rows, fields),
+    }
+
+
+async def get_questions_by_category(request, category_id):
+    """
+    Get question by category.
+
+    :param request:
+    :param category_id:
+    :return:
+    """
+    categories = await request['database'].fetch(
+        'SELECT id, type FROM categories WHERE id = ?', int(category_id))
+    if not categories:
+        raise HTTPError(HTTP_STATUS.NOT_FOUND)
+
+    fields = get_requested_fields(request['args'], Question)
+    rows = await request['database'].fetch(
+        f'SELECT {question_columns(fields)} FROM questions '
+        f'WHERE {CATEGORY_MATCH} ORDER BY id', int(category_id))
+    (category_id, category_type), = categories
+
+    return {
+        'success': True,
+        'questions': format_questions(rows, fields),
+        'total_questions': len(rows),
+        'current_category': {'id': category_id, 'type': category_type}
+    }
+
+
+def draw(category_id, previous_questions, request_data):
+    """
+    Draw a quiz question like the Flask route, in an app context.
+
+    :param category_id:
+    :param previous_questions:
+    :param request_data: json body, holding the quiz options
+    :return:
+    """
+    with flask_app.app_context():
+        return draw_question(category_id, previous_questions,
+                             **get_quiz_options(request_data))
+
+
+async def play_quiz(request):
+    """
+    Play quiz.
+
+    Draws use the question index, difficulty options and question cache
+    of the Flask route, run in the default executor since a cache miss
+    queries the database.
+
+    :param request:
+    :return:
+    """
+    payload = await authorize(request, 'play-quiz')
+    async with rate_limited(request, 'play_quiz', payload):
+        request_data = request['json']
+        if not isinstance(request_data, dict):
+            raise HTTPError(HTTP_STATUS.BAD_REQUEST)
+
+        category = request_data.get('quiz_category')
+        previous_questions = request_data.get('previous_questions') or []
+        if not category:
+            raise HTTPError(HTTP_STATUS.BAD_REQUEST)
+
+        try:
+            previous_questions = [int(id_) for id_ in previous_questions]
+        except (TypeError, ValueError):
+            raise HTTPError(HTTP_STATUS.BAD_REQUEST)
+
+        question = await asyncio.get_running_loop().run_in_executor(
+            None, draw, category.get('id'), previous_questions,
+            request_data)
+    return {'success': True, 'question': question}
+
+
+ROUTES = [
+    ('GET', re.compile(r'^/categories$'), get_categories),
+    ('GET', re.compile(r'^/questions$'), get_questions),
+    ('POST', re.compile(r'^/questions/search$'), search_questions),
+    ('GET', re.compile(r'^/categories/(?P<category_id>\d+)/questions$'),
+     get_questions_by_category),
+    ('POST', re.compile(r'^/quizzes$'), play_quiz),
+]
+
+
+def error_payload(http_status):
+    """
+    Get error payload based on http status.
+
+    :param http_status:
+    :return:
+    """
+    return {
+        'success': False,
+        'error': http_status,
+        'message': ERROR_MESSAGES[http_status]
+    }
+
+
+class TriviaASGI:
+    """ASGI application serving async routes with Flask fallback."""
+
+    def __init__(self, db, wsgi_app):
+        """
+        Init method.
+
+        :param db:
+        :param wsgi_app:
+        """
+        self.db = db
+        self.fallback = WsgiToAsgi(wsgi_app)
+        self.connected = None
+
+    async def ensure_connected(self):
+        """
+        Connect database once per worker.
+
+        :return:
+        """
+        if QUESTION_SHARDS:
+            raise RuntimeError(
+                'Async routes read questions from DATABASE_URL only; serve '
+                'the WSGI app with QUESTION_SHARDS')
+        if self.connected is None:
+            self.connected = asyncio.ensure_future(self.db.connect())
+        await self.connected
+
+    async def __call__(self, scope, receive, send):
+        """
+        Handle ASGI connection.
+
+        :param scope:
+        :param receive:
+        :param send:
+        :return:
+        """
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        for method, pattern, handler in ROUTES:
+            match = pattern.match(scope['path'])
+            if match and scope['method'] == method:
+                return await self.dispatch(
+                    handler, match.groupdict(), scope, receive, send)
+
+        return await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """
+        Open and close the database with the worker.
+
+        :param receive:
+        :param send:
+        :return:
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.ensure_connected()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, handler, params, scope, receive, send):
+        """
+        Run async route and send its json response.
+
+        :param handler:
+        :param params:
+        :param scope:
+        :param receive:
+        :param send:
+        :return:
+        """
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        request = {
+            'database': self.db,
+            'client': (scope.get('client') or (None,))[0],
+            'args': {
+                name: values[0] for name, values in parse_qs(
+                    scope.get('query_string', b'').decode(),
+                    keep_blank_values=True).items()
+            },
+            'headers': {
+                name.decode('latin-1'): value.decode('latin-1')
+                for name, value in scope['headers']
+            },
+            'json': None,
+        }
+
+        status = HTTP_STATUS.OK
+        headers = RESPONSE_HEADERS
+        try:
+            if body:
+                try:
+                    request['json'] = json.loads(body)
+                except ValueError:
+                    raise HTTPError(HTTP_STATUS.BAD_REQUEST)
+            await self.ensure_connected()
+            payload = await handler(request, **params)
+        except HTTPError as error:
+            status, payload = error.status_code, error_payload(
+                error.status_code)
+        except HTTPException as error:
+            status, payload = error.code, error_payload(error.code)
+            retry_after = getattr(error, 'retry_after', None)
+            if retry_after:
+                headers = headers + [(
+                    b'retry-after', str(int(math.ceil(retry_after))).encode())]
+        except AuthError as error:
+            status, payload = error.status_code, error.error
+        except Exception:
+            flask_app.logger.exception(f"Exception on {scope['path']}")
+            status = HTTP_STATUS.INTERNAL_SERVER_ERROR
+            payload = error_payload(status)
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers,
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': json.dumps(payload, sort_keys=True).encode('utf-8'),
+        })
+
+
+app = TriviaASGI(database, flask_app)
@@ -0,0 +1,297 @@
+"""Audit trail of question writes, written by a background thread."""
+
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+from models import db, AuditEvent
+from constants import (
+    AUDIT_SINK, AUDIT_LOG_PATH, AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE,
+    AUDIT_WINDOW, AUDIT_FULL_TIMEOUT, AUDIT_RETRY_SECONDS
+)
+from .metrics import metrics
+
+# Queued by flush and stop, so the writer writes events queued before
+# without waiting for more, and by stop then exits.
+_FLUSH = object()
+_STOP = object()
+
+
+class DatabaseSink:
+    """Write audit events to the audit_events table."""
+
+    @staticmethod
+    def write(events):
+        """
+        Insert events in one transaction.
+
+        :param events:
+        :return:
+        """
+        with db.get_app().app_context():
+            try:
+                db.session.bulk_insert_mappings(AuditEvent, [
+                    dict(event, **{
+                        field: json.dumps(event[field])
+                        for field in ('before', 'after')
+                        if event[field] is not None
+                    })
+                    for event in events
+                ])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+
+class JsonLinesSink:
+    """Append audit events to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        """
+        Init method.
+
+        :param path:
+        """
+        self.path = path
+
+    def write(self, events):
+        """
+        Append events with a single write, so the lines of workers sharing
+        the file do not interleave.
+
+        :param events:
+        :return:
+        """
+        data = ''.join(
+            json.dumps(dict(event, created_at=event['created_at'].isoformat()),
+                       sort_keys=True) + '\n'
+            for event in events).encode('utf-8')
+        descriptor = os.open(
+            self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(descriptor, data[written:])
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+
+def create_audit_sink(name=AUDIT_SINK, path=AUDIT_LOG_PATH):
+    """
+    Create the audit sink configured by AUDIT_SINK.
+
+    :param name: database or file
+    :param path: file of the file sink
+    :return:
+    """
+    if name == 'database':
+        return DatabaseSink()
+    if name == 'file':
+        return JsonLinesSink(path)
+    raise ValueError(f'Unknown AUDIT_SINK {name!r}')
+
+
+class AuditLog:
+    """
+    Queue audit events of requests for a writer thread.
+
+    Recording an event only puts it in a bounded queue, so requests never
+    wait for the sink. The writer thread takes up to ``batch_size`` events,
+    waiting up to ``window`` seconds for more after the first, and writes
+    them in one go, retrying failed batches. When the queue is full, e.g.
+    while the sink is down, ``record`` waits up to ``full_timeout`` seconds
+    for room, then drops the event. Events still queued are written when
+    the process exits.
+    """
+
+    def __init__(self, sink, capacity, batch_size, window, full_timeout=0,
+                 retry_seconds=AUDIT_RETRY_SECONDS):
+        """
+        Init method.
+
+        :param sink: object with a write(events) method
+        :param capacity: maximum number of queued events
+        :param batch_size:
+        :param window:
+        :param full_timeout:
+        :param retry_seconds:
+        """
+        self.sink = sink
+        self.batch_size = batch_size
+        self.window = window
+        self.full_timeout = full_timeout
+        self.retry_seconds = retry_seconds
+        self.high_water = 0
+        self.batches = 0
+        self.written = 0
+        self._queue = queue.Queue(capacity)
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.stop)
+
+    def record(self, token, action, question_id, before=None, after=None):
+        """
+        Queue an audit event of a question write.
+
+        :param token: JWT payload of the user
+        :param action: insert, update or delete
+        :param question_id:
+        :param before: question values before the write
+        :param after: question values after the write
+        :return: whether the event was queued
+        """
+        self.ensure_started()
+        event = {
+            'user': token.get('sub'),
+            'action': action,
+            'question_id': question_id,
+            'before': before,
+            'after': after,
+            'created_at': datetime.datetime.utcnow(),
+        }
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            metrics.incr('audit.full')
+            try:
+                self._queue.put(event, timeout=max(self.full_timeout, 0))
+            except queue.Full:
+                metrics.incr('audit.dropped')
+                return False
+        metrics.incr('audit.recorded')
+        self.high_water = max(self.high_water, self._queue.qsize())
+        return True
+
+    def ensure_started(self):
+        """
+        Start the writer thread once per process.
+
+        :return:
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._loop, name='audit-writer', daemon=True)
+            self._thread.start()
+
+    def depth(self):
+        """
+        Get number of queued events.
+
+        :return:
+        """
+        return self._queue.qsize()
+
+    def mean_batch_size(self):
+        """
+        Get mean number of events per write.
+
+        :return:
+        """
+        return self.written / self.batches if self.batches else None
+
+    def flush(self):
+        """
+        Wait until every queued event is written or dropped.
+
+        :return:
+        """
+        if self._pid == os.getpid() and not self._stopping.is_set():
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    def stop(self, timeout=5):
+        """
+        Write queued events and stop the writer thread.
+
+        :param timeout:
+        :return:
+        """
+        if self._pid != os.getpid() or self._stopping.is_set():
+            return
+        self._stopping.set()
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def _collect(self):
+        """
+        Wait for an event, then collect a batch of them.
+
+        :return:
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + (
+            0 if self._stopping.is_set() else self.window)
+        while len(batch) < self.batch_size and \
+                batch[-1] not in (_FLUSH, _STOP):
+            try:
+                batch.append(self._queue.get(
+                    timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        """
+        Thread body.
+
+        :return:
+        """
+        while True:
+            batch = self._collect()
+            events = [event for event in batch
+                      if event is not _FLUSH and event is not _STOP]
+            if events:
+                self._write(events)
+            for _ in batch:
+                self._queue.task_done()
+            if batch[-1] is _STOP:
+                return
+
+    def _write(self, events):
+        """
+        Write a batch, retrying until it succeeds or the log is stopped.
+
+        :param events:
+        :return:
+        """
+        while True:
+            try:
+                self.sink.write(events)
+            except Exception:
+                metrics.incr('audit.write_errors')
+                db.get_app().logger.exception(
+                    f'Writing {len(events)} audit events failed')
+                if self._stopping.wait(self.retry_seconds):
+                    metrics.incr('audit.dropped', len(events))
+                    return
+                continue
+            self.batches += 1
+            self.written += len(events)
+            metrics.incr('audit.written', len(events))
+            return
+
+
+audit_log = AuditLog(
+    create_audit_sink(), AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_WINDOW,
+    AUDIT_FULL_TIMEOUT)
+metrics.gauge('audit.queue_depth', audit_log.depth)
+metrics.gauge('audit.queue_high_water', lambda: audit_log.high_water)
+metrics.gauge('audit.mean_batch_size', audit_log.mean_batch_size)
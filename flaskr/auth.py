@@ -1,16 +1,15 @@
 """Module for auth."""
 
-import json
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 
 from constants import (
     AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE,
     ERROR_MESSAGES, HTTP_STATUS, MISSING_AUTHORIZATION,
     INVALID_BEARER_TOKEN
 )
+from .keys import key_provider
 
 
 class AuthError(Exception):
@@ -39,7 +38,15 @@ def get_token_auth_header():
     Get token from authorization header.
     :return:
     """
-    header = request.headers.get('Authorization')
+    return parse_auth_header(request.headers.get('Authorization'))
+
+
+def parse_auth_header(header):
+    """
+    Get token from authorization header value.
+    :param header:
+    :return:
+    """
     if not header:
         auth_error(MISSING_AUTHORIZATION, HTTP_STATUS.UNAUTHORIZED)
 
@@ -74,23 +81,11 @@ def verify_decode_jwt(token):
     :param token:
     :return:
     """
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    rsa_key = {}
-
     unverified_header = jwt.get_unverified_header(token)
     if 'kid' not in unverified_header:
         auth_error('Authorization malformed.', HTTP_STATUS.UNAUTHORIZED)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = key_provider.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -140,6 +135,7 @@ def requires_auth(permission=''):
             token = get_token_auth_header()
             payload = verify_decode_jwt(token)
             check_permissions(permission, payload)
+            _request_ctx_stack.top.current_user = payload
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,95 @@
+"""Periodic background tasks of a worker."""
+
+import atexit
+import os
+import threading
+
+
+class PeriodicTask:
+    """Run a function in a daemon thread every interval seconds."""
+
+    def __init__(self, app, name, interval, fn, run_on_stop=False):
+        """
+        Init method.
+
+        :param app:
+        :param name:
+        :param interval:
+        :param fn:
+        :param run_on_stop: whether to run the task a last time on stop,
+            for tasks holding work that would be lost otherwise
+        """
+        self.app = app
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.run_on_stop = run_on_stop
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._pid = None
+        atexit.register(self.stop)
+
+    def ensure_started(self):
+        """
+        Start the thread once per process.
+
+        Threads do not survive a fork, so a pid change (e.g. a gunicorn
+        worker forked from a preloaded app) starts a new one.
+
+        :return:
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(
+                target=self._loop, name=self.name, daemon=True).start()
+
+    def wake(self):
+        """
+        Run the task now instead of waiting for the interval.
+
+        :return:
+        """
+        self._wake.set()
+
+    def run_once(self):
+        """
+        Run the task in an app context, logging failures.
+
+        :return:
+        """
+        with self._run_lock, self.app.app_context():
+            try:
+                self.fn()
+            except Exception:
+                self.app.logger.exception(
+                    f'Background task {self.name} failed')
+
+    def stop(self):
+        """
+        Stop the thread, running the task a last time if run_on_stop.
+
+        :return:
+        """
+        if self._pid == os.getpid() and not self._stop.is_set():
+            self._stop.set()
+            self._wake.set()
+            if self.run_on_stop:
+                self.run_once()
+
+    def _loop(self):
+        """
+        Thread body.
+
+        :return:
+        """
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self._stop.is_set():
+                self.run_once()
@@ -0,0 +1,459 @@
+"""Read-only catalog snapshot, memory-mapped and shared by all workers."""
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from models import (
+    db, Question, Category, QuestionChange, question_listeners, shard_router
+)
+from constants import CATALOG_SNAPSHOT_PATH
+from utils import words
+from .metrics import metrics
+
+MAGIC = b'TRV2'
+# magic, version, change log sequence, questions, categories, words,
+# postings, blob bytes
+HEADER = struct.Struct('=4sQQIIIIQ')
+# Stands for a missing category or difficulty.
+MISSING = -2 ** 31
+
+
+def _section(view, offset, typecode, count):
+    """
+    Get a typed view of count items at offset, and the offset after it.
+
+    :param view:
+    :param offset:
+    :param typecode:
+    :param count:
+    :return:
+    """
+    size = array(typecode).itemsize * count
+    return view[offset:offset + size].cast(typecode), offset + size
+
+
+class _Texts:
+    """Sequence of the texts found between consecutive blob offsets."""
+
+    def __init__(self, blob, offsets):
+        """
+        Init method.
+
+        :param blob:
+        :param offsets:
+        """
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, position):
+        return str(self._blob[
+            self._offsets[position]:self._offsets[position + 1]], 'utf-8')
+
+
+def write_snapshot(path):
+    """
+    Write a snapshot of questions and categories, replacing path atomically.
+
+    Layout after the header, in native byte order: question ids (sorted),
+    categories and difficulties as int32 arrays, offsets of question and
+    answer texts into the blob as a uint32 array, category ids and offsets
+    of their types, then the sorted words of question texts with offsets
+    into an int32 array of question ids per word, then the utf-8 blob.
+
+    :param path:
+    :return: version of the snapshot
+    """
+    version = int(time.time() * 1000)
+    # Changes logged after this sequence may be missing from the snapshot.
+    sequence = db.session.query(
+        func.max(QuestionChange.sequence)).scalar() or 0
+    db.session.commit()
+    ids, categories, difficulties = array('i'), array('i'), array('i')
+    offsets, blob = array('I', [0]), bytearray()
+    postings = defaultdict(list)
+    for question_id, question, answer, category, difficulty in \
+            shard_router.merged(lambda session: session.query(
+                Question.id, Question.question, Question.answer,
+                Question.category, Question.difficulty).order_by(
+                Question.id).yield_per(10000)):
+        ids.append(question_id)
+        categories.append(MISSING if category is None else int(category))
+        difficulties.append(MISSING if difficulty is None else difficulty)
+        for text in (question, answer):
+            blob += (text or '').encode('utf-8')
+            offsets.append(len(blob))
+        for word in words(question):
+            postings[word].append(question_id)
+
+    category_ids, type_offsets = array('i'), array('I', [len(blob)])
+    for category_id, category_type in db.session.query(
+            Category.id, Category.type).order_by(Category.id):
+        category_ids.append(category_id)
+        blob += (category_type or '').encode('utf-8')
+        type_offsets.append(len(blob))
+    shard_router.commit()
+
+    word_offsets, posting_offsets = array('I', [len(blob)]), array('I', [0])
+    posting_ids = array('i')
+    for word in sorted(postings):
+        blob += word.encode('utf-8')
+        word_offsets.append(len(blob))
+        posting_ids.extend(postings.pop(word))
+        posting_offsets.append(len(posting_ids))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(
+                MAGIC, version, sequence, len(ids), len(category_ids),
+                len(word_offsets) - 1, len(posting_ids), len(blob)))
+            for section in (ids, categories, difficulties, offsets,
+                            category_ids, type_offsets, word_offsets,
+                            posting_offsets, posting_ids):
+                section.tofile(snapshot_file)
+            snapshot_file.write(blob)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    metrics.incr('catalog.writes')
+    return version
+
+
+class CatalogSnapshot:
+    """
+    Questions and categories of a snapshot file, read through mmap.
+
+    Pages of the file are shared by every process mapping it, so workers
+    add no memory of their own for the catalog.
+    """
+
+    def __init__(self, path):
+        """
+        Init method.
+
+        :param path:
+        """
+        with open(path, 'rb') as snapshot_file:
+            stat = os.fstat(snapshot_file.fileno())
+            self._mmap = mmap.mmap(
+                snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.size = stat.st_size
+
+        view = memoryview(self._mmap)
+        magic, self.version, self.sequence, questions, categories, \
+            vocabulary, postings, blob_size = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a catalog snapshot')
+        offset = HEADER.size
+        self._ids, offset = _section(view, offset, 'i', questions)
+        self._categories, offset = _section(view, offset, 'i', questions)
+        self._difficulties, offset = _section(view, offset, 'i', questions)
+        self._offsets, offset = _section(
+            view, offset, 'I', 2 * questions + 1)
+        self._category_ids, offset = _section(view, offset, 'i', categories)
+        type_offsets, offset = _section(view, offset, 'I', categories + 1)
+        word_offsets, offset = _section(view, offset, 'I', vocabulary + 1)
+        self._posting_offsets, offset = _section(
+            view, offset, 'I', vocabulary + 1)
+        self._postings, offset = _section(view, offset, 'i', postings)
+        self._blob = view[offset:offset + blob_size]
+        self._types = _Texts(self._blob, type_offsets)
+        # Sorted words of question texts, searched with bisect.
+        self.vocabulary = _Texts(self._blob, word_offsets)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _text(self, start, end):
+        """
+        Decode text of the blob.
+
+        :param start:
+        :param end:
+        :return:
+        """
+        return str(self._blob[start:end], 'utf-8')
+
+    @staticmethod
+    def _value(value):
+        """
+        Convert a stored integer, MISSING meaning None.
+
+        :param value:
+        :return:
+        """
+        return None if value == MISSING else value
+
+    def _position(self, question_id):
+        """
+        Find position of a question id.
+
+        :param question_id:
+        :return: None if the snapshot does not hold it
+        """
+        position = bisect_left(self._ids, question_id)
+        if position == len(self._ids) or \
+                self._ids[position] != question_id:
+            return None
+        return position
+
+    def question(self, question_id):
+        """
+        Get question formatted like Question.format.
+
+        :param question_id:
+        :return: None if the snapshot does not hold it
+        """
+        position = self._position(question_id)
+        if position is None:
+            return None
+        offsets = self._offsets
+        return {
+            'id': question_id,
+            'question': self._text(
+                offsets[2 * position], offsets[2 * position + 1]),
+            'answer': self._text(
+                offsets[2 * position + 1], offsets[2 * position + 2]),
+            'category': self._value(self._categories[position]),
+            'difficulty': self._value(self._difficulties[position]),
+        }
+
+    def rows(self):
+        """
+        Get (id, category, difficulty) of every question.
+
+        :return:
+        """
+        value = self._value
+        return ((question_id, value(category), value(difficulty))
+                for question_id, category, difficulty in zip(
+                    self._ids, self._categories, self._difficulties))
+
+    def text(self, question_id):
+        """
+        Get question text.
+
+        :param question_id:
+        :return: None if the snapshot does not hold it
+        """
+        position = self._position(question_id)
+        if position is None:
+            return None
+        return self._text(
+            self._offsets[2 * position], self._offsets[2 * position + 1])
+
+    def postings(self, position):
+        """
+        Get ids of the questions having the word at position of vocabulary.
+
+        :param position:
+        :return:
+        """
+        return self._postings[self._posting_offsets[position]:
+                              self._posting_offsets[position + 1]]
+
+    def categories(self):
+        """
+        Get type of every category by id.
+
+        :return:
+        """
+        return dict(zip(self._category_ids, self._types))
+
+
+class SharedCatalog:
+    """
+    Current snapshot of a path, swapped when a newer file replaces it.
+
+    Workers write a new snapshot when they changed questions, at most once
+    per sync, and every worker maps the newest file on its next sync. The
+    snapshot in use is a single reference, swapped atomically; requests
+    holding the previous one keep reading it until they drop it.
+
+    Questions changed through other workers bypass the snapshot once they
+    are evicted through redis, or once the change log shows them changed
+    after the snapshot was written, read on every sync.
+    """
+
+    def __init__(self, path):
+        """
+        Init method.
+
+        :param path: None to disable snapshots
+        """
+        self.path = path
+        self.snapshot = None
+        # Changed question ids, by sequence number of their last change.
+        self._changed = {}
+        # Same for questions changed through other workers.
+        self._remote = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def question(self, question_id):
+        """
+        Get question of the current snapshot.
+
+        :param question_id:
+        :return: None without snapshot, or if changed since it was written
+        """
+        snapshot = self.snapshot
+        if snapshot is None or self.is_changed(question_id):
+            return None
+        return snapshot.question(question_id)
+
+    def is_changed(self, question_id):
+        """
+        Whether a question changed since the current snapshot was written.
+
+        :param question_id:
+        :return:
+        """
+        return question_id in self._changed or question_id in self._remote
+
+    def mark_changed(self, question_id):
+        """
+        Bypass the snapshot for a question changed through another worker.
+
+        :param question_id:
+        :return:
+        """
+        with self._lock:
+            self._sequence += 1
+            remote = dict(self._remote)
+            remote[question_id] = self._sequence
+            self._remote = remote
+
+    def read_changes(self):
+        """
+        Bypass the snapshot for questions logged as changed after it.
+
+        :return:
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
+        with self._lock:
+            read = self._sequence
+        changed = {question_id for (question_id,) in db.session.query(
+            QuestionChange.question_id).filter(
+            QuestionChange.sequence > snapshot.sequence).distinct()}
+        db.session.commit()
+        # Marks made while reading may be missing from the log read.
+        with self._lock:
+            remote = {question_id: read for question_id in changed}
+            remote.update(
+                (question_id, sequence)
+                for question_id, sequence in self._remote.items()
+                if sequence > read)
+            self._remote = remote
+
+    def load(self):
+        """
+        Map the snapshot, writing it first if there is none yet.
+
+        :return:
+        """
+        if not self.path:
+            return
+        try:
+            self.refresh()
+        except ValueError:
+            # Written in an older format.
+            self.snapshot = None
+        if self.snapshot is None:
+            self.publish()
+        self.read_changes()
+
+    def refresh(self):
+        """
+        Swap to the snapshot file if it was replaced.
+
+        :return: whether the snapshot was swapped
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self.snapshot is not None and self.snapshot.key == key:
+            return False
+        self.snapshot = CatalogSnapshot(self.path)
+        metrics.incr('catalog.swaps')
+        return True
+
+    def publish(self):
+        """
+        Write a snapshot including the questions changed by this worker.
+
+        :return:
+        """
+        with self._lock:
+            published = self._sequence
+        write_snapshot(self.path)
+        self.refresh()
+        # Changes made while writing may be missing from the snapshot.
+        with self._lock:
+            self._changed = {
+                question_id: sequence
+                for question_id, sequence in self._changed.items()
+                if sequence > published
+            }
+
+    def sync(self):
+        """
+        Publish changes of this worker, map the newest snapshot and read
+        the changes logged after it.
+
+        :return:
+        """
+        if not self.path:
+            return
+        if self._changed:
+            self.publish()
+        else:
+            self.refresh()
+        self.read_changes()
+
+    def on_question_change(self, action, question, previous):
+        """
+        Question listener bypassing the snapshot for changed questions.
+
+        :param action: insert, update or delete
+        :param question:
+        :param previous: values before the change
+        :return:
+        """
+        if not self.path:
+            return
+        with self._lock:
+            self._sequence += 1
+            changed = dict(self._changed)
+            changed[previous['id'] if previous else question.id] = \
+                self._sequence
+            self._changed = changed
+
+
+catalog = SharedCatalog(CATALOG_SNAPSHOT_PATH)
+question_listeners.append(catalog.on_question_change)
+metrics.gauge('catalog.version', lambda: catalog.snapshot and
+              catalog.snapshot.version)
+metrics.gauge('catalog.questions', lambda: catalog.snapshot and
+              len(catalog.snapshot))
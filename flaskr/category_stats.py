@@ -0,0 +1,140 @@
+"""Question counts per category and difficulty, held by every worker."""
+
+import threading
+
+from sqlalchemy import func
+
+from models import (
+    db, Question, CategoryStat, question_listeners, stat_key,
+    rebuild_category_stats, shard_router
+)
+from .metrics import metrics
+
+
+class CategoryStats:
+    """
+    Copy of the category_stats table, read without querying.
+
+    Question writes keep the table current in their own transaction, and
+    the listener applies writes of this worker to the copy. ``refresh``
+    reloads it to pick up writes of other workers, and rebuilds the table
+    first if its total no longer matches the questions, e.g. after rows
+    were written outside the app.
+
+    The copy is replaced rather than mutated, so reads need no lock.
+    """
+
+    def __init__(self):
+        """
+        Init method.
+        """
+        self.loaded = False
+        self._lock = threading.Lock()
+        # category -> {difficulty: number of questions}
+        self._counts = {}
+
+    def ensure_loaded(self):
+        """
+        Refresh on first use.
+
+        :return:
+        """
+        if not self.loaded:
+            self.refresh()
+
+    def load(self):
+        """
+        Replace the copy with the rows of the table.
+
+        :return:
+        """
+        counts = {}
+        for category, difficulty, questions in db.session.query(
+                CategoryStat.category, CategoryStat.difficulty,
+                CategoryStat.questions):
+            if questions > 0:
+                counts.setdefault(category, {})[difficulty] = questions
+        db.session.commit()
+        with self._lock:
+            self._counts = counts
+            self.loaded = True
+
+    def refresh(self):
+        """
+        Rebuild the table if its total is off, then reload the copy.
+
+        :return: whether the table was up to date
+        """
+        counted = db.session.query(func.coalesce(
+            func.sum(CategoryStat.questions), 0)).as_scalar()
+        expected = db.session.query(func.count(Question.id)).filter(
+            Question.category.isnot(None)).as_scalar()
+        if shard_router.enabled:
+            # Shards are other databases: a write committed between the
+            # two reads makes the next refresh rebuild once more.
+            counted = db.session.query(counted).scalar()
+            expected = sum(session.query(expected).scalar()
+                           for session in shard_router.sessions())
+        else:
+            # One statement, so both totals come from the same snapshot.
+            counted, expected = db.session.query(counted, expected).one()
+        fresh = int(counted) == expected
+        if not fresh:
+            rebuild_category_stats(db.session)
+            metrics.incr('category_stats.rebuilds')
+        shard_router.commit()
+        self.load()
+        return fresh
+
+    def histograms(self):
+        """
+        Get number of questions per difficulty of every category.
+
+        :return: category -> {difficulty: number of questions}
+        """
+        return self._counts
+
+    def counts(self):
+        """
+        Get number of questions of every category.
+
+        :return:
+        """
+        return {category: sum(difficulties.values())
+                for category, difficulties in self._counts.items()}
+
+    def on_question_change(self, action, question, previous):
+        """
+        Question listener applying writes of this worker to the copy.
+
+        :param action: insert, update or delete
+        :param question:
+        :param previous: values before the change
+        :return:
+        """
+        if not self.loaded:
+            return
+        old = stat_key(previous)
+        new = None if action == 'delete' else stat_key({
+            'category': question.category,
+            'difficulty': question.difficulty,
+        })
+        if old == new:
+            return
+        with self._lock:
+            counts = dict(self._counts)
+            for key, delta in ((old, -1), (new, 1)):
+                if key is None:
+                    continue
+                category, difficulty = key
+                difficulties = dict(counts.get(category, {}))
+                difficulties[difficulty] = \
+                    difficulties.get(difficulty, 0) + delta
+                if difficulties[difficulty] <= 0:
+                    del difficulties[difficulty]
+                counts[category] = difficulties
+            self._counts = counts
+
+
+category_stats = CategoryStats()
+question_listeners.append(category_stats.on_question_change)
@@ -0,0 +1,108 @@
+"""Negotiated response compression for trivia app."""
+
+import hashlib
+import zlib
+
+from flask import request
+
+from constants import (
+    COMPRESSION_MIN_SIZE, COMPRESSION_CACHE_BYTES,
+    DEFAULT_COMPRESSION_LEVEL, COMPRESSION_LEVELS
+)
+from utils import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html')
+CACHEABLE_METHODS = ('GET', 'HEAD')
+
+# Compressed bodies keyed by (body digest, encoding, level), so repeated
+# identical GET responses are compressed once.
+compressed_cache = LRUCache(
+    max_entries=4096, max_bytes=COMPRESSION_CACHE_BYTES)
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Pick the best supported encoding from an Accept-Encoding header.
+
+    :param accept_encoding:
+    :return:
+    """
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    supported = ('br', 'gzip') if brotli else ('gzip',)
+    candidates = [
+        encoding for encoding in supported
+        if accepted.get(encoding, accepted.get('*', 0)) > 0
+    ]
+    return max(candidates, key=lambda encoding: accepted.get(
+        encoding, accepted.get('*', 0))) if candidates else None
+
+
+def compress(data, encoding, level):
+    """
+    Compress data with the given encoding and (gzip, brotli) level.
+
+    :param data:
+    :param encoding:
+    :param level:
+    :return:
+    """
+    gzip_level, brotli_quality = level
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+
+    # wbits=31 writes a gzip container with a zero mtime, so equal input
+    # always gives equal output.
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_response(response):
+    """
+    Compress response body in place if the client accepts it.
+
+    :param response:
+    :return:
+    """
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if not encoding:
+        return response
+
+    level = COMPRESSION_LEVELS.get(request.endpoint, DEFAULT_COMPRESSION_LEVEL)
+    if request.method in CACHEABLE_METHODS:
+        key = (hashlib.blake2b(data, digest_size=16).digest(), encoding, level)
+        body = compressed_cache.get(key)
+        if body is None:
+            body = compress(data, encoding, level)
+            compressed_cache.set(key, body)
+    else:
+        body = compress(data, encoding, level)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,632 @@
+"""Near-duplicate detection of questions with MinHash and LSH."""
+
+import bisect
+import threading
+import zlib
+from array import array
+from collections import Counter
+from functools import lru_cache
+from itertools import combinations
+from multiprocessing import Pool
+
+from sqlalchemy import func
+
+from models import (
+    db, Question, QuestionChange, question_listeners, shard_router
+)
+from constants import (
+    DEDUPE_MODE, DEDUPE_THRESHOLD, DEDUPE_SHINGLE_SIZE,
+    DEDUPE_SIGNATURE_SIZE, DEDUPE_BANDS, DEDUPE_MAX_CANDIDATES,
+    DEDUPE_MAX_BUCKET
+)
+from utils import WORD
+from .metrics import metrics
+
+MODES = ('off', 'flag', 'reject')
+MASK = (1 << 64) - 1
+# Odd constant spreading the bits of CRC-32 over 64 bits (Fibonacci
+# hashing).
+MIX = 0x9E3779B97F4A7C15
+# Changes since the arrays were sorted, relative to their size, before
+# compact merges them in.
+COMPACT_RATIO = 0.1
+COMPACT_MIN = 1000
+
+
+def normalize(text):
+    """
+    Lower case words of text, separated by single spaces.
+
+    :param text:
+    :return:
+    """
+    return ' '.join(WORD.findall((text or '').lower()))
+
+
+def shingles(text, size=DEDUPE_SHINGLE_SIZE):
+    """
+    Get character shingles of normalized text.
+
+    :param text:
+    :param size: characters per shingle
+    :return:
+    """
+    normalized = normalize(text)
+    if len(normalized) <= size:
+        return {normalized} if normalized else set()
+    return {normalized[start:start + size]
+            for start in range(len(normalized) - size + 1)}
+
+
+def jaccard(first, second):
+    """
+    Get Jaccard similarity of two shingle sets.
+
+    :param first:
+    :param second:
+    :return:
+    """
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def signature(shingle_set, size=DEDUPE_SIGNATURE_SIZE):
+    """
+    Get one permutation MinHash signature of shingles.
+
+    Every shingle is hashed once, into one of size bins, keeping the
+    smallest hash per bin, rather than hashed once per value of the
+    signature. Empty bins take the value of the next bin holding one,
+    shifted by their distance, so short texts get comparable signatures.
+
+    :param shingle_set:
+    :param size:
+    :return: list of size values, None without shingles
+    """
+    if not shingle_set:
+        return None
+    bins = [None] * size
+    for shingle in shingle_set:
+        value = (zlib.crc32(shingle.encode('utf-8')) * MIX) & MASK
+        position = (value * size) >> 64
+        if bins[position] is None or value < bins[position]:
+            bins[position] = value
+    values = []
+    for position in range(size):
+        distance = 0
+        while bins[(position + distance) % size] is None:
+            distance += 1
+        values.append(bins[(position + distance) % size] + (distance << 64))
+    return values
+
+
+def band_keys(values, bands=DEDUPE_BANDS):
+    """
+    Get a key per band of a signature.
+
+    Hashes of tuples of ints do not depend on the process, so keys of
+    different workers compare.
+
+    :param values: signature
+    :param bands:
+    :return:
+    """
+    rows = len(values) // bands
+    return [hash((band,) + tuple(values[band * rows:(band + 1) * rows]))
+            for band in range(bands)]
+
+
+def text_keys(text):
+    """
+    Get band keys of text.
+
+    :param text:
+    :return: None for text without words
+    """
+    values = signature(shingles(text))
+    return None if values is None else band_keys(values)
+
+
+class LSHIndex:
+    """
+    Band keys of texts, for finding texts sharing a band in sub-linear time.
+
+    Keys of each band of the texts loaded last are held in a sorted array
+    with a parallel array of ids, searched with bisect, which takes 12
+    bytes per band and text where dicts and sets would take ten times more.
+    Texts added since are held in a dict, and removed ones are left out of
+    lookups until ``compact`` merges the changes into the arrays.
+    """
+
+    def __init__(self, bands=DEDUPE_BANDS):
+        """
+        Init method.
+
+        :param bands:
+        """
+        self.bands = bands
+        self._lock = threading.Lock()
+        # (keys, ids) per band
+        self._arrays = self._sorted(())
+        # key -> ids and id -> keys, of texts added since
+        self._recent = {}
+        self._added = {}
+        # ids left out of the arrays
+        self._removed = set()
+        # changes made while compacting
+        self._pending = None
+
+    def __len__(self):
+        return len(self._arrays[0][1]) - len(self._removed) + \
+            len(self._added)
+
+    def load(self, items):
+        """
+        Replace index content.
+
+        :param items: (id, keys) pairs
+        :return:
+        """
+        arrays = self._sorted(items)
+        with self._lock:
+            self._arrays = arrays
+            self._recent, self._added, self._removed = {}, {}, set()
+            self._pending = None
+
+    def _sorted(self, items):
+        """
+        Get arrays of keys and ids of every band, sorted by key.
+
+        :param items: (id, keys) pairs
+        :return:
+        """
+        ids = array('i')
+        keys = [array('q') for _ in range(self.bands)]
+        for row_id, row_keys in items:
+            ids.append(row_id)
+            for band, key in zip(keys, row_keys):
+                band.append(key)
+        arrays = []
+        for band in keys:
+            # Sort positions rather than (key, id) tuples, which would take
+            # ten times the memory of the arrays while sorting.
+            order = sorted(range(len(band)), key=band.__getitem__)
+            arrays.append((array('q', (band[position] for position in order)),
+                           array('i', (ids[position] for position in order))))
+        return arrays
+
+    def add(self, row_id, keys):
+        """
+        Add or replace keys of id.
+
+        :param row_id:
+        :param keys:
+        :return:
+        """
+        with self._lock:
+            self._apply(row_id, keys)
+
+    def remove(self, row_id):
+        """
+        Remove id.
+
+        :param row_id:
+        :return:
+        """
+        with self._lock:
+            self._apply(row_id, None)
+
+    def _apply(self, row_id, keys):
+        """
+        Replace keys of id, with the lock held.
+
+        :param row_id:
+        :param keys: None to remove id
+        :return:
+        """
+        if self._pending is not None:
+            self._pending.append((row_id, keys))
+        for key in self._added.pop(row_id, ()):
+            ids = self._recent[key]
+            ids.discard(row_id)
+            if not ids:
+                del self._recent[key]
+        self._removed.add(row_id)
+        if keys is not None:
+            self._added[row_id] = keys
+            for key in keys:
+                self._recent.setdefault(key, set()).add(row_id)
+
+    def candidates(self, keys, max_bucket=DEDUPE_MAX_BUCKET):
+        """
+        Get ids sharing a band with keys.
+
+        :param keys:
+        :param max_bucket: maximum number of ids read per band, so a text
+            copied thousands of times does not make lookups linear
+        :return: Counter of shared bands per id
+        """
+        found = Counter()
+        with self._lock:
+            for (band_keys, band_ids), key in zip(self._arrays, keys):
+                start = bisect.bisect_left(band_keys, key)
+                end = min(start + max_bucket, len(band_keys))
+                for position in range(start, end):
+                    if band_keys[position] != key:
+                        break
+                    if band_ids[position] not in self._removed:
+                        found[band_ids[position]] += 1
+                found.update(self._recent.get(key, ()))
+        return found
+
+    def needs_compact(self):
+        """
+        Get whether enough changed since load to merge the changes.
+
+        :return:
+        """
+        return len(self._removed) > max(
+            COMPACT_MIN, COMPACT_RATIO * len(self._arrays[0][1]))
+
+    def compact(self):
+        """
+        Merge added and removed ids into the sorted arrays.
+
+        Lookups go on meanwhile; changes made while merging are replayed
+        on the merged arrays.
+
+        :return:
+        """
+        with self._lock:
+            arrays = self._arrays
+            added, removed = dict(self._added), set(self._removed)
+            self._pending = []
+        items = {}
+        for band, (band_keys, band_ids) in enumerate(arrays):
+            for key, row_id in zip(band_keys, band_ids):
+                if row_id not in removed:
+                    items.setdefault(row_id, [0] * self.bands)[band] = key
+        items.update(added)
+        arrays = self._sorted(items.items())
+        with self._lock:
+            pending = self._pending
+            self._arrays = arrays
+            self._recent, self._added, self._removed = {}, {}, set()
+            self._pending = None
+            for row_id, row_keys in pending:
+                self._apply(row_id, row_keys)
+
+    def memory(self):
+        """
+        Get approximate memory footprint of the arrays in bytes.
+
+        :return:
+        """
+        return sum(
+            values.buffer_info()[1] * values.itemsize
+            for band in self._arrays for values in band)
+
+
+class DuplicateIndex:
+    """
+    LSH index over the text of every question, kept by every worker.
+
+    Built from the questions on first use, it applies writes of this
+    worker through the listener and those of other workers from the
+    change log, read by ``sync``. Candidates sharing a band are checked
+    against the exact similarity of their text.
+    """
+
+    def __init__(self, mode=DEDUPE_MODE, threshold=DEDUPE_THRESHOLD):
+        """
+        Init method.
+
+        :param mode: off, flag or reject
+        :param threshold: minimum Jaccard similarity of duplicates
+        """
+        if mode not in MODES:
+            raise ValueError(f'Unknown DEDUPE_MODE {mode!r}')
+        if DEDUPE_SIGNATURE_SIZE % DEDUPE_BANDS:
+            raise ValueError('DEDUPE_SIGNATURE_SIZE must be a multiple of '
+                             'DEDUPE_BANDS')
+        self.mode = mode
+        self.threshold = threshold
+        self.built = False
+        self.sequence = 0
+        self.index = LSHIndex()
+        self._build_lock = threading.Lock()
+
+    def build(self):
+        """
+        Index every question.
+
+        :return:
+        """
+        # Read first: changes committed while building are replayed by
+        # the next sync.
+        sequence = db.session.query(
+            func.max(QuestionChange.sequence)).scalar() or 0
+        rows = shard_router.chain(lambda session: session.query(
+            Question.id, Question.question).yield_per(10000))
+        self.index.load(
+            (question_id, keys) for question_id, keys in (
+                (question_id, text_keys(text)) for question_id, text in rows)
+            if keys is not None)
+        shard_router.commit()
+        self.sequence = sequence
+        self.built = True
+        metrics.incr('dedupe.builds')
+
+    def ensure_built(self):
+        """
+        Build on first use, once when threads race.
+
+        :return:
+        """
+        if self.built:
+            return
+        with self._build_lock:
+            if not self.built:
+                self.build()
+
+    def sync(self):
+        """
+        Apply changes logged by other workers, then compact.
+
+        :return:
+        """
+        self.ensure_built()
+        changes = db.session.query(
+            QuestionChange.sequence, QuestionChange.question_id,
+            QuestionChange.action, QuestionChange.question).filter(
+            QuestionChange.sequence > self.sequence).order_by(
+            QuestionChange.sequence).all()
+        db.session.commit()
+        for sequence, question_id, action, text in changes:
+            self.apply(action, question_id, text)
+            self.sequence = sequence
+        if self.index.needs_compact():
+            self.index.compact()
+            metrics.incr('dedupe.compactions')
+
+    def apply(self, action, question_id, text):
+        """
+        Index or remove a question.
+
+        :param action: insert, update or delete
+        :param question_id:
+        :param text:
+        :return:
+        """
+        keys = None if action == 'delete' else text_keys(text)
+        if keys is None:
+            self.index.remove(question_id)
+        else:
+            self.index.add(question_id, keys)
+
+    def find(self, text, exclude=None, limit=DEDUPE_MAX_CANDIDATES):
+        """
+        Get questions similar to text.
+
+        :param text:
+        :param exclude: id of the question itself
+        :param limit: maximum number of candidates to compare, those
+            sharing the most bands first
+        :return: [{'id', 'question', 'similarity'}], most similar first
+        """
+        self.ensure_built()
+        query = shingles(text)
+        values = signature(query)
+        if values is None:
+            return []
+        candidates = self.index.candidates(band_keys(values))
+        candidates.pop(exclude, None)
+        ids = [question_id for question_id, _ in
+               candidates.most_common(limit)]
+        if not ids:
+            return []
+        metrics.incr('dedupe.candidates', len(ids))
+        duplicates = []
+        for question_id, candidate in shard_router.chain(
+                lambda session: session.query(
+                    Question.id, Question.question).filter(
+                    Question.id.in_(ids))):
+            similarity = jaccard(query, shingles(candidate))
+            if similarity >= self.threshold:
+                duplicates.append({
+                    'id': question_id,
+                    'question': candidate,
+                    'similarity': round(similarity, 3),
+                })
+        duplicates.sort(key=lambda duplicate: (
+            -duplicate['similarity'], duplicate['id']))
+        return duplicates
+
+    def check(self, text, exclude=None):
+        """
+        Get near-duplicates of a new question, as configured by mode.
+
+        :param text:
+        :param exclude:
+        :return: [] when off
+        """
+        if self.mode == 'off':
+            return []
+        duplicates = self.find(text, exclude)
+        if duplicates:
+            metrics.incr('dedupe.flagged' if self.mode == 'flag'
+                         else 'dedupe.rejected')
+        return duplicates
+
+    def on_question_change(self, action, question, previous):
+        """
+        Question listener keeping the index current.
+
+        :param action: insert, update or delete
+        :param question:
+        :param previous: values before the change
+        :return:
+        """
+        if not self.built:
+            return
+        if action == 'delete':
+            self.apply(action, previous['id'], None)
+        else:
+            self.apply(action, question.id, question.question)
+
+
+# Texts of the batch, in each process of the pool.
+_texts = {}
+
+
+def _init_worker(texts):
+    """
+    Pool initializer.
+
+    :param texts: id -> text
+    :return:
+    """
+    global _texts
+    _texts = texts
+    _shingles_of.cache_clear()
+
+
+def _keys_of(ids):
+    """
+    Get band keys of texts, in a pool process.
+
+    :param ids:
+    :return: [(id, keys)]
+    """
+    return [(row_id, keys) for row_id, keys in (
+        (row_id, text_keys(_texts[row_id])) for row_id in ids)
+        if keys is not None]
+
+
+@lru_cache(maxsize=10000)
+def _shingles_of(row_id):
+    """
+    Get shingles of a text, in a pool process.
+
+    Pairs are sorted, so the first text of a run of pairs is cached.
+
+    :param row_id:
+    :return:
+    """
+    return shingles(_texts[row_id])
+
+
+def _similar(task):
+    """
+    Keep pairs of similar texts, in a pool process.
+
+    :param task: (pairs, threshold)
+    :return:
+    """
+    pairs, threshold = task
+    return [(first, second) for first, second in pairs if jaccard(
+        _shingles_of(first), _shingles_of(second)) >= threshold]
+
+
+def _chunks(items, size):
+    """
+    Split a list in chunks.
+
+    :param items:
+    :param size:
+    :return:
+    """
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def find_clusters(rows, threshold=DEDUPE_THRESHOLD, processes=None,
+                  chunk_size=2000, max_bucket=DEDUPE_MAX_BUCKET):
+    """
+    Group texts into clusters of near-duplicates, on every core.
+
+    A pool of processes computes band keys, texts sharing the key of a band
+    are paired up, and the pool keeps the pairs similar enough. Texts
+    linked by kept pairs are a cluster. Texts of a band bucket larger than
+    max_bucket are only paired with its first one, so a few thousand
+    copies of a text do not make millions of pairs.
+
+    :param rows: (id, text) pairs
+    :param threshold:
+    :param processes: None for one per core, 1 to run in this process
+    :param chunk_size: texts or pairs per task
+    :param max_bucket:
+    :return: clusters as sorted lists of ids, largest first
+    """
+    texts = dict(rows)
+    if processes == 1:
+        _init_worker(texts)
+        pool, mapper = None, map
+    else:
+        pool = Pool(processes, initializer=_init_worker, initargs=(texts,))
+        mapper = pool.imap_unordered
+    try:
+        ids = array('i')
+        bands = [array('q') for _ in range(DEDUPE_BANDS)]
+        for chunk in mapper(_keys_of, _chunks(sorted(texts), chunk_size)):
+            for row_id, keys in chunk:
+                ids.append(row_id)
+                for band, key in zip(bands, keys):
+                    band.append(key)
+
+        # One band at a time, grouping equal keys by sorting positions,
+        # which holds far less than a dict of buckets of every band.
+        pairs = set()
+        for band in bands:
+            order = sorted(range(len(band)), key=band.__getitem__)
+            start = 0
+            while start < len(order):
+                end = start + 1
+                while end < len(order) and \
+                        band[order[end]] == band[order[start]]:
+                    end += 1
+                if end - start > 1:
+                    bucket = sorted(ids[position]
+                                    for position in order[start:end])
+                    if len(bucket) > max_bucket:
+                        pairs.update((bucket[0], row_id)
+                                     for row_id in bucket[1:])
+                    else:
+                        pairs.update(combinations(bucket, 2))
+                start = end
+        metrics.incr('dedupe.pairs', len(pairs))
+
+        parents = {}
+
+        def root(row_id):
+            while parents[row_id] != row_id:
+                parents[row_id] = parents[parents[row_id]]
+                row_id = parents[row_id]
+            return row_id
+
+        tasks = [(chunk, threshold)
+                 for chunk in _chunks(sorted(pairs), chunk_size)]
+        for similar in mapper(_similar, tasks):
+            for first, second in similar:
+                parents.setdefault(first, first)
+                parents.setdefault(second, second)
+                first, second = root(first), root(second)
+                if first != second:
+                    parents[max(first, second)] = min(first, second)
+    finally:
+        if pool is None:
+            _init_worker({})
+        else:
+            pool.terminate()
+            pool.join()
+
+    clusters = {}
+    for row_id in parents:
+        clusters.setdefault(root(row_id), []).append(row_id)
+    return sorted((sorted(cluster) for cluster in clusters.values()),
+                  key=lambda cluster: (-len(cluster), cluster[0]))
+
+
+duplicate_index = DuplicateIndex()
+question_listeners.append(duplicate_index.on_question_change)
+metrics.gauge('dedupe.bytes', duplicate_index.index.memory)
@@ -0,0 +1,241 @@
+"""Key providers verifying JWTs, and local keys minting them."""
+
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.request import urlopen
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+from constants import (
+    AUTH0_DOMAIN, API_AUDIENCE, ALGORITHMS, AUTH_KEY_PROVIDER, JWKS_URL,
+    JWKS_PATH, JWKS_CACHE_SECONDS, AUTH_PRIVATE_KEY_PATH
+)
+
+JWK_FIELDS = ('kty', 'kid', 'use', 'n', 'e')
+
+
+def _b64_int(value):
+    """
+    Encode an integer as unpadded base64url, as used by JWK.
+
+    :param value:
+    :return:
+    """
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def index_jwks(jwks):
+    """
+    Index keys of a JWKS by kid, keeping the fields used for verification.
+
+    :param jwks:
+    :return:
+    """
+    return {
+        key['kid']: {field: key[field] for field in JWK_FIELDS}
+        for key in jwks['keys']
+    }
+
+
+class RemoteJWKS:
+    """
+    Keys published at a JWKS url, e.g. by Auth0.
+
+    Keys are fetched once and cached for ``ttl`` seconds. An unknown kid
+    refetches them, at most once per ``min_refresh`` seconds, so rotated
+    keys are picked up without a restart.
+    """
+
+    def __init__(self, url, ttl=JWKS_CACHE_SECONDS, min_refresh=10):
+        """
+        Init method.
+
+        :param url:
+        :param ttl:
+        :param min_refresh:
+        """
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self._keys = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def _refresh(self, force):
+        """
+        Fetch keys if the cache expired, or if forced and not too recent.
+
+        :param force:
+        :return:
+        """
+        with self._lock:
+            now = time.monotonic()
+            age = None if self._fetched_at is None else now - self._fetched_at
+            if age is not None and age < (
+                    self.min_refresh if force else self.ttl):
+                return
+            with urlopen(self.url) as response:
+                self._keys = index_jwks(json.loads(response.read()))
+            self._fetched_at = now
+
+    def get_key(self, kid):
+        """
+        Get public key by kid.
+
+        :param kid:
+        :return: JWK, or None if unknown
+        """
+        self._refresh(force=False)
+        if kid not in self._keys:
+            self._refresh(force=True)
+        return self._keys.get(kid)
+
+
+class FileJWKS:
+    """Keys of a local JWKS file, read once."""
+
+    def __init__(self, path):
+        """
+        Init method.
+
+        :param path:
+        """
+        with open(path) as jwks_file:
+            self._keys = index_jwks(json.load(jwks_file))
+
+    def get_key(self, kid):
+        """
+        Get public key by kid.
+
+        :param kid:
+        :return: JWK, or None if unknown
+        """
+        return self._keys.get(kid)
+
+
+class LocalKeys:
+    """
+    RSA key pair held in process, verifying and minting tokens offline.
+
+    With a path, the key is loaded from that PEM file, which is created
+    if missing so every worker and the token minting command share it.
+    Without one, a throwaway key is generated.
+    """
+
+    def __init__(self, path=None, kid='local'):
+        """
+        Init method.
+
+        :param path:
+        :param kid:
+        """
+        self.kid = kid
+        self.key = self._load(path) if path else RSA.generate(2048)
+        self._public_key = self.jwks()['keys'][0]
+
+    @staticmethod
+    def _load(path):
+        """
+        Load PEM key file, creating it first if missing.
+
+        The key is written to a temporary file and linked into place, so
+        processes racing to create it all end up with the first one's key.
+
+        :param path:
+        :return:
+        """
+        if not os.path.exists(path):
+            key = RSA.generate(2048)
+            directory = os.path.dirname(os.path.abspath(path))
+            descriptor, temp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(descriptor, 'wb') as key_file:
+                key_file.write(key.exportKey('PEM'))
+            try:
+                os.link(temp_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(temp_path)
+
+        with open(path, 'rb') as key_file:
+            return RSA.importKey(key_file.read())
+
+    def jwks(self):
+        """
+        Get public key set in JWKS format.
+
+        :return:
+        """
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'n': _b64_int(self.key.n),
+            'e': _b64_int(self.key.e),
+        }]}
+
+    def write_jwks(self, path):
+        """
+        Write public key set, e.g. for a FileJWKS provider.
+
+        :param path:
+        :return:
+        """
+        with open(path, 'w') as jwks_file:
+            json.dump(self.jwks(), jwks_file)
+
+    def get_key(self, kid):
+        """
+        Get public key by kid.
+
+        :param kid:
+        :return: JWK, or None if unknown
+        """
+        return self._public_key if kid == self.kid else None
+
+    def mint(self, permissions, sub='local|user', expires_in=3600):
+        """
+        Mint a token accepted by verify_decode_jwt.
+
+        :param permissions:
+        :param sub:
+        :param expires_in:
+        :return:
+        """
+        now = int(time.time())
+        claims = {
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'sub': sub,
+            'aud': API_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions),
+        }
+        return jwt.encode(
+            claims, self.key.exportKey('PEM').decode('ascii'),
+            algorithm=ALGORITHMS[0], headers={'kid': self.kid})
+
+
+def create_key_provider(name=AUTH_KEY_PROVIDER):
+    """
+    Create the key provider configured by AUTH_KEY_PROVIDER.
+
+    :param name: remote, file or local
+    :return:
+    """
+    if name == 'remote':
+        return RemoteJWKS(JWKS_URL)
+    if name == 'file':
+        return FileJWKS(JWKS_PATH)
+    if name == 'local':
+        return LocalKeys(AUTH_PRIVATE_KEY_PATH)
+    raise ValueError(f'Unknown AUTH_KEY_PROVIDER {name!r}')
+
+
+key_provider = create_key_provider()
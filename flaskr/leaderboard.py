@@ -0,0 +1,257 @@
+"""Buffered answer recording and in-memory leaderboards."""
+
+import bisect
+import threading
+from collections import defaultdict
+
+from models import db, Answer, Score
+from .metrics import metrics
+
+
+class Leaderboard:
+    """Scores of users kept sorted for top-N reads."""
+
+    def __init__(self, scores=None):
+        """
+        Init method.
+
+        :param scores: mapping of user to score
+        """
+        self._scores = dict(scores or {})
+        self._ranking = sorted(
+            (-score, user) for user, score in self._scores.items())
+
+    def __len__(self):
+        return len(self._ranking)
+
+    def add(self, user, delta):
+        """
+        Add delta to score of user, keeping the ranking sorted.
+
+        :param user:
+        :param delta:
+        :return:
+        """
+        old = self._scores.get(user)
+        if old is not None:
+            del self._ranking[bisect.bisect_left(self._ranking, (-old, user))]
+        score = (old or 0) + delta
+        self._scores[user] = score
+        bisect.insort(self._ranking, (-score, user))
+
+    def top(self, limit):
+        """
+        Get best scores.
+
+        :param limit:
+        :return:
+        """
+        return [
+            {'user': user, 'score': -score}
+            for score, user in self._ranking[:limit]
+        ]
+
+
+class Scoreboard:
+    """Leaderboards per category and overall, persisted in batches."""
+
+    def __init__(self):
+        """
+        Init method.
+        """
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._boards = {}
+        self._overall = Leaderboard()
+        self._answers = []
+        self._deltas = defaultdict(int)
+        self._answered = {}
+
+    def ensure_loaded(self):
+        """
+        Load persisted scores on first use.
+
+        :return:
+        """
+        if not self._loaded:
+            self.load()
+
+    def answered(self, user):
+        """
+        Get ids of the questions a user answered, loading them on first use.
+
+        :param user:
+        :return:
+        """
+        answered = self._answered.get(user)
+        if answered is None:
+            rows = db.session.query(Answer.question_id).filter_by(
+                user=user).all()
+            db.session.commit()
+            with self._lock:
+                answered = self._answered.setdefault(user, set())
+                answered.update(question_id for question_id, in rows)
+        return answered
+
+    def record(self, user, question, correct):
+        """
+        Buffer the first answer of a user to a question and update
+        leaderboards in memory.
+
+        Later answers to the same question are not recorded. Answers of the
+        same user buffered by other workers are dropped when written, by
+        the unique constraint of the answers table.
+
+        :param user:
+        :param question:
+        :param correct:
+        :return: number of answers waiting to be written, or None if the
+            user already answered the question
+        """
+        category = question.category
+        answered = self.answered(user)
+        with self._lock:
+            if question.id in answered:
+                return None
+            answered.add(question.id)
+            self._answers.append({
+                'user': user,
+                'question_id': question.id,
+                'category': category,
+                'correct': correct,
+            })
+            if correct:
+                self._deltas[(user, category)] += 1
+                self._boards.setdefault(category, Leaderboard()).add(user, 1)
+                self._overall.add(user, 1)
+            pending = len(self._answers)
+        metrics.incr('answers.recorded')
+        return pending
+
+    def top(self, limit, category=None):
+        """
+        Get best scores of a category, or overall.
+
+        :param limit:
+        :param category:
+        :return:
+        """
+        with self._lock:
+            if category is None:
+                return self._overall.top(limit)
+            board = self._boards.get(category)
+            return board.top(limit) if board else []
+
+    def reset(self):
+        """
+        Drop buffered answers and leaderboards, reloading them on next use.
+
+        :return:
+        """
+        with self._lock:
+            self._loaded = False
+            self._boards = {}
+            self._overall = Leaderboard()
+            self._answers = []
+            self._deltas = defaultdict(int)
+            self._answered = {}
+
+    def pending(self):
+        """
+        Get number of answers waiting to be written.
+
+        :return:
+        """
+        return len(self._answers)
+
+    def flush(self):
+        """
+        Write buffered answers and their score deltas in one transaction,
+        then reload leaderboards to pick up scores of other workers.
+
+        Answers another worker already wrote are skipped and score nothing.
+        A batch racing another worker for the same answer fails on the
+        unique constraint and is retried on the next flush.
+
+        :return:
+        """
+        with self._lock:
+            answers, self._answers = self._answers, []
+            deltas, self._deltas = self._deltas, defaultdict(int)
+
+        if answers:
+            try:
+                written = self._unwritten(answers)
+                db.session.bulk_insert_mappings(Answer, written)
+                scored = defaultdict(int)
+                for answer in written:
+                    if answer['correct']:
+                        scored[(answer['user'], answer['category'])] += 1
+                for (user, category), delta in scored.items():
+                    updated = Score.query.filter_by(
+                        user=user, category=category).update(
+                        {Score.score: Score.score + delta},
+                        synchronize_session=False)
+                    if not updated:
+                        db.session.add(Score(user, category, delta))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    self._answers[:0] = answers
+                    for key, delta in deltas.items():
+                        self._deltas[key] += delta
+                raise
+            metrics.incr('answers.flushed', len(written))
+            metrics.incr('answers.duplicates', len(answers) - len(written))
+
+        self.load()
+
+    @staticmethod
+    def _unwritten(answers):
+        """
+        Filter out answers already in the answers table.
+
+        :param answers:
+        :return:
+        """
+        users = {answer['user'] for answer in answers}
+        question_ids = {answer['question_id'] for answer in answers}
+        written = set(db.session.query(Answer.user, Answer.question_id).filter(
+            Answer.user.in_(users), Answer.question_id.in_(question_ids)))
+        return [
+            answer for answer in answers
+            if (answer['user'], answer['question_id']) not in written
+        ]
+
+    def load(self):
+        """
+        Rebuild leaderboards from persisted scores plus unwritten deltas.
+
+        :return:
+        """
+        rows = db.session.query(Score.user, Score.category, Score.score).all()
+        db.session.commit()
+
+        with self._lock:
+            scores = defaultdict(lambda: defaultdict(int))
+            for user, category, score in rows:
+                scores[category][user] += score
+            for (user, category), delta in self._deltas.items():
+                scores[category][user] += delta
+
+            overall = defaultdict(int)
+            for category_scores in scores.values():
+                for user, score in category_scores.items():
+                    overall[user] += score
+
+            self._boards = {
+                category: Leaderboard(category_scores)
+                for category, category_scores in scores.items()
+            }
+            self._overall = Leaderboard(overall)
+            self._loaded = True
+
+
+scoreboard = Scoreboard()
+metrics.gauge('answers.pending', scoreboard.pending)
@@ -0,0 +1,69 @@
+"""In-process metrics for trivia app."""
+
+import threading
+from collections import defaultdict
+
+
+class Metrics:
+    """Counters and gauges of a single worker."""
+
+    def __init__(self):
+        """
+        Init method.
+        """
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        """
+        Increment counter.
+
+        :param name:
+        :param value:
+        :return:
+        """
+        with self._lock:
+            self._counters[name] += value
+
+    def counters(self):
+        """
+        Get current value of all counters.
+
+        :return:
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def gauge(self, name, getter):
+        """
+        Register a gauge read when metrics are collected.
+
+        :param name:
+        :param getter:
+        :return:
+        """
+        self._gauges[name] = getter
+
+    def snapshot(self):
+        """
+        Get current value of all counters and gauges.
+
+        :return:
+        """
+        values = self.counters()
+        for name, getter in self._gauges.items():
+            values[name] = getter()
+        return values
+
+    def reset(self):
+        """
+        Reset all counters.
+
+        :return:
+        """
+        with self._lock:
+            self._counters.clear()
+
+
+metrics = Metrics()
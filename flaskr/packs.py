@@ -0,0 +1,301 @@
+"""Prebuilt quiz packs: static, compressed and content-hashed files."""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+
+from flask import request, abort, send_from_directory, Response
+from sqlalchemy import func
+
+from models import db, Question, Category, QuestionChange, shard_router
+from constants import (
+    PACKS_DIR, PACK_RETENTION_SECONDS, PACK_COMPRESSION_LEVEL
+)
+from .compression import brotli, compress, negotiate_encoding
+from .metrics import metrics
+
+MANIFEST = 'manifest.json'
+ALL = 'all'
+EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
+PACK_FILE = re.compile(r'^(all|category-\d+)\.[0-9a-f]{16}\.json\.(gz|br)$')
+
+
+def pack_name(category_id):
+    """
+    Get name of the pack of a category, or of all categories.
+
+    :param category_id: None for all categories
+    :return:
+    """
+    return ALL if category_id is None else f'category-{category_id}'
+
+
+def write_atomic(path, data):
+    """
+    Write file through a temporary file renamed into place.
+
+    :param path:
+    :param data:
+    :return:
+    """
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(descriptor, 'wb') as temp_file:
+            temp_file.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class PackBuilder:
+    """
+    Build one quiz pack per category and one for all categories.
+
+    Pack files are named after a hash of their content, so they never
+    change and can be cached forever. ``manifest.json`` maps pack names to
+    their current file and is the only file to revalidate.
+
+    Builds are incremental: a pack is rebuilt when the change log has
+    changes of its category since the last build, or when the count or
+    sum of ids of its questions changed, which catches questions moved to
+    another category or deleted.
+    """
+
+    def __init__(self, directory):
+        """
+        Init method.
+
+        :param directory: None to disable packs
+        """
+        self.directory = directory
+
+    def path(self, filename):
+        """
+        Get path of a file of the pack directory.
+
+        :param filename:
+        :return:
+        """
+        return os.path.join(self.directory, filename)
+
+    def manifest(self):
+        """
+        Read current manifest.
+
+        :return:
+        """
+        try:
+            with open(self.path(MANIFEST)) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return {'version': 0, 'sequence': 0, 'packs': {}}
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the build lock of the directory, shared by all processes.
+
+        :return: whether the lock was acquired
+        """
+        with open(self.path('.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def fingerprints():
+        """
+        Get [count, sum of ids] of the questions of every pack.
+
+        :return:
+        """
+        fingerprints = {ALL: [0, 0]}
+        for category, count, total in shard_router.chain(
+                lambda session: session.query(
+                    Question.category, func.count(Question.id),
+                    func.sum(Question.id)).group_by(Question.category)):
+            fingerprints[ALL][0] += count
+            fingerprints[ALL][1] += int(total)
+            if category is not None:
+                fingerprints[pack_name(category)] = [count, int(total)]
+        return fingerprints
+
+    @staticmethod
+    def changed_packs(sequence):
+        """
+        Get names of packs with logged changes after a sequence number.
+
+        :param sequence:
+        :return:
+        """
+        return {pack_name(category) for (category,) in db.session.query(
+            QuestionChange.category).filter(
+            QuestionChange.sequence > sequence,
+            QuestionChange.category.isnot(None)).distinct()}
+
+    def build(self, full=False):
+        """
+        Rebuild stale packs and publish a new manifest.
+
+        :param full: rebuild every pack
+        :return: names of the rebuilt packs, or None if another process
+            is building
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._locked() as locked:
+            if not locked:
+                return None
+            manifest = self.manifest()
+            # Read first: changes committed while building are picked up
+            # by the next build.
+            sequence = db.session.query(
+                func.max(QuestionChange.sequence)).scalar() or 0
+            fingerprints = self.fingerprints()
+            categories = {
+                pack_name(category_id): (category_id, category_type)
+                for category_id, category_type in db.session.query(
+                    Category.id, Category.type)
+            }
+            packs = manifest['packs']
+            names = set(categories) | {ALL}
+            if full:
+                stale = names
+            else:
+                stale = {name for name in names if name not in packs or
+                         packs[name]['fingerprint'] !=
+                         fingerprints.get(name, [0, 0])}
+                stale |= self.changed_packs(manifest['sequence']) & names
+                if stale:
+                    stale.add(ALL)
+
+            for name in sorted(stale):
+                packs[name] = self.write_pack(
+                    name, categories.get(name), fingerprints.get(name, [0, 0]))
+            shard_router.commit()
+
+            for name in set(packs) - names:
+                del packs[name]
+            if stale or sequence != manifest['sequence']:
+                manifest.update(
+                    version=manifest['version'] + 1, sequence=sequence,
+                    built_at=int(time.time()))
+                write_atomic(self.path(MANIFEST), json.dumps(
+                    manifest, indent=2, sort_keys=True).encode('utf-8'))
+            self.remove_unused(manifest)
+        metrics.incr('packs.rebuilt', len(stale))
+        return sorted(stale)
+
+    def write_pack(self, name, category, fingerprint):
+        """
+        Write compressed files of a pack, unless unchanged.
+
+        :param name:
+        :param category: (id, type), None for all categories
+        :param fingerprint:
+        :return: manifest entry
+        """
+        # Columns rather than entities: the pack of all categories holds
+        # every question, and loading them as instances dominates builds.
+        def pack_query(session):
+            query = session.query(*(
+                getattr(Question, name) for name in Question.FIELDS))
+            if category is not None:
+                query = query.filter(Question.category == category[0])
+            return query.order_by(Question.id).yield_per(10000)
+
+        sessions = None if category is None else [
+            shard_router.session_for(category[0])]
+        questions = [dict(zip(Question.FIELDS, row)) for row in
+                     shard_router.merged(pack_query, sessions=sessions)]
+        data = json.dumps({
+            'name': name,
+            'category': category and {'id': category[0], 'type': category[1]},
+            'questions': questions,
+        }, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        filename = f'{name}.{digest}.json'
+
+        encodings = ('gzip', 'br') if brotli else ('gzip',)
+        for encoding in encodings:
+            path = self.path(filename + EXTENSIONS[encoding])
+            if not os.path.exists(path):
+                write_atomic(path, compress(
+                    data, encoding, PACK_COMPRESSION_LEVEL))
+        return {
+            'file': filename,
+            'encodings': list(encodings),
+            'questions': len(questions),
+            'bytes': len(data),
+            'fingerprint': fingerprint,
+        }
+
+    def remove_unused(self, manifest, retention=PACK_RETENTION_SECONDS):
+        """
+        Remove pack files left out of the manifest for retention seconds.
+
+        Clients holding an older manifest keep loading its packs meanwhile.
+
+        :param manifest:
+        :param retention:
+        :return:
+        """
+        used = {pack['file'] for pack in manifest['packs'].values()}
+        deadline = time.time() - retention
+        for filename in os.listdir(self.directory):
+            if PACK_FILE.match(filename) and \
+                    filename.rsplit('.', 1)[0] not in used and \
+                    os.path.getmtime(self.path(filename)) < deadline:
+                os.unlink(self.path(filename))
+
+    def response(self, filename):
+        """
+        Serve manifest or pack file, precompressed as the client accepts.
+
+        :param filename: manifest.json or <name>.<hash>.json
+        :return:
+        """
+        if not self.directory:
+            abort(404)
+        if filename == MANIFEST:
+            response = send_from_directory(self.directory, MANIFEST)
+            response.cache_control.no_cache = True
+            return response
+
+        if not PACK_FILE.match(filename + EXTENSIONS['gzip']):
+            abort(404)
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+        if encoding and os.path.exists(
+                self.path(filename + EXTENSIONS[encoding])):
+            response = send_from_directory(
+                self.directory, filename + EXTENSIONS[encoding],
+                mimetype='application/json')
+            response.headers['Content-Encoding'] = encoding
+        else:
+            try:
+                with open(self.path(
+                        filename + EXTENSIONS['gzip']), 'rb') as pack_file:
+                    data = zlib.decompress(pack_file.read(), 31)
+            except FileNotFoundError:
+                abort(404)
+            response = Response(data, mimetype='application/json')
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = \
+            'public, max-age=31536000, immutable'
+        return response
+
+
+pack_builder = PackBuilder(PACKS_DIR)
@@ -0,0 +1,400 @@
+"""Sampling profiler of the threads of a live worker."""
+
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Flask
+
+from constants import (
+    PROFILE_INTERVAL, PROFILE_SLOW_SECONDS, PROFILE_MAX_STACKS,
+    PROFILE_SIGNAL, PROFILE_SIGNAL_SECONDS, PROFILE_GROUPS
+)
+from .metrics import metrics
+
+OTHER = 'other'
+# Counts the samples of new stacks once a profile holds max_stacks.
+TRUNCATED = '[truncated]'
+
+
+def collapse(stacks):
+    """
+    Format stack counts as collapsed stacks, read by flamegraph.pl.
+
+    :param stacks: Counter of ';' separated stacks, root first
+    :return: one "stack count" line per stack
+    """
+    return ''.join(
+        f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+class Profile:
+    """Stack and group counts of sampled threads."""
+
+    def __init__(self, max_stacks=PROFILE_MAX_STACKS):
+        """
+        Init method.
+
+        :param max_stacks:
+        """
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self.groups = Counter()
+        self.samples = 0
+        self.requests = 0
+
+    def add(self, stack, group, count=1):
+        """
+        Count samples of a stack.
+
+        :param stack:
+        :param group:
+        :param count:
+        :return:
+        """
+        if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+            stack = TRUNCATED
+        self.stacks[stack] += count
+        self.groups[group] += count
+        self.samples += count
+
+    def merge(self, other):
+        """
+        Add samples of another profile.
+
+        :param other:
+        :return:
+        """
+        for stack, count in other.stacks.items():
+            if stack not in self.stacks and \
+                    len(self.stacks) >= self.max_stacks:
+                stack = TRUNCATED
+            self.stacks[stack] += count
+        self.groups.update(other.groups)
+        self.samples += other.samples
+
+    def summary(self, top=20):
+        """
+        Get share of samples of every group and the most sampled stacks.
+
+        :param top:
+        :return:
+        """
+        return {
+            'samples': self.samples,
+            'groups': {
+                group: {
+                    'samples': count,
+                    'percent': round(100 * count / self.samples, 1),
+                }
+                for group, count in self.groups.most_common()
+            },
+            'stacks': [
+                {'stack': stack, 'samples': count}
+                for stack, count in self.stacks.most_common(top)
+            ],
+        }
+
+
+class _Request:
+    """Request served by a thread, and its samples."""
+
+    __slots__ = ('label', 'started', 'profile')
+
+    def __init__(self, label):
+        """
+        Init method.
+
+        :param label:
+        """
+        self.label = label
+        self.started = time.monotonic()
+        self.profile = None
+
+
+class SamplingProfiler:
+    """
+    Sample stacks of running threads from a background thread.
+
+    Every ``interval`` seconds, the sampler reads the current frame of
+    every thread with ``sys._current_frames`` and counts its stack. Nothing
+    is traced in between, so the cost is that of the samples themselves
+    and no thread is slowed down while nothing is sampled.
+
+    Stacks of request threads start at the route, e.g. ``GET get_questions``,
+    and stop at ``Flask.full_dispatch_request``. Each sample is attributed
+    to a group, the innermost frame of the stack matching one of ``groups``
+    (e.g. jwt, sqlalchemy or json), or ``other``.
+
+    With ``slow_seconds``, request threads are sampled all the time, and
+    samples of requests slower than that are kept per route.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL,
+                 slow_seconds=PROFILE_SLOW_SECONDS, groups=PROFILE_GROUPS):
+        """
+        Init method.
+
+        :param interval:
+        :param slow_seconds: None to only sample while capturing
+        :param groups: (name, path fragments) pairs
+        """
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        self.groups = groups
+        self.slow = {}
+        self._requests = {}
+        self._captures = {}
+        self._frames = {}
+        self._prefixes = sorted(
+            {os.path.join(os.path.abspath(path), '') for path in sys.path},
+            key=len, reverse=True)
+        self._root = Flask.full_dispatch_request.__code__
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def reset(self):
+        """
+        Drop profiles of slow requests.
+
+        :return:
+        """
+        with self._lock:
+            self.slow = {}
+
+    def begin_request(self, label):
+        """
+        Register the request served by the current thread.
+
+        :param label: route of the request
+        :return:
+        """
+        if self.slow_seconds is not None:
+            self._ensure_sampling()
+        with self._lock:
+            self._requests[threading.get_ident()] = _Request(label)
+
+    def end_request(self):
+        """
+        Unregister the request of the current thread, keeping its samples
+        if it was slow.
+
+        :return:
+        """
+        with self._lock:
+            request = self._requests.pop(threading.get_ident(), None)
+        if request is None or request.profile is None or \
+                self.slow_seconds is None or \
+                time.monotonic() - request.started < self.slow_seconds:
+            return
+        with self._lock:
+            profile = self.slow.get(request.label)
+            if profile is None:
+                profile = self.slow[request.label] = Profile()
+            profile.merge(request.profile)
+            profile.requests += 1
+        metrics.incr('profiler.slow_requests')
+
+    def slow_profiles(self):
+        """
+        Get copies of the profiles of slow requests, by route.
+
+        :return:
+        """
+        with self._lock:
+            profiles = {}
+            for label, profile in self.slow.items():
+                profiles[label] = copy = Profile()
+                copy.merge(profile)
+                copy.requests = profile.requests
+            return profiles
+
+    def capture(self, seconds, all_threads=False):
+        """
+        Sample threads for some seconds.
+
+        The calling thread is left out, so it can be a request thread.
+
+        :param seconds:
+        :param all_threads: also sample threads not serving a request,
+            e.g. background tasks
+        :return:
+        """
+        profile = Profile()
+        ident = threading.get_ident()
+        with self._lock:
+            self._captures[ident] = (profile, all_threads)
+        try:
+            self._ensure_sampling()
+            time.sleep(seconds)
+        finally:
+            with self._lock:
+                del self._captures[ident]
+        metrics.incr('profiler.captures')
+        return profile
+
+    def _ensure_sampling(self):
+        """
+        Start the sampler thread, once per process.
+
+        :return:
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._loop, name='profiler', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        """
+        Sampler thread body, until nothing is left to sample.
+
+        :return:
+        """
+        while True:
+            with self._lock:
+                if not self._captures and self.slow_seconds is None:
+                    self._thread = None
+                    return
+            started = time.monotonic()
+            self.sample()
+            time.sleep(max(
+                0.0, self.interval - (time.monotonic() - started)))
+
+    def sample(self):
+        """
+        Count the current stack of every sampled thread.
+
+        :return:
+        """
+        frames = sys._current_frames()
+        with self._lock:
+            requests = dict(self._requests)
+            captures = list(self._captures.values())
+            skipped = set(self._captures) | {threading.get_ident()}
+        all_threads = any(everything for _, everything in captures)
+        names = {thread.ident: thread.name
+                 for thread in threading.enumerate()} if all_threads else {}
+
+        samples = []
+        for ident, frame in frames.items():
+            request = requests.get(ident)
+            if ident in skipped or request is None and not all_threads:
+                continue
+            root = request.label if request else \
+                f'thread {names.get(ident, ident)}'
+            stack, group = self._stack(frame)
+            samples.append((ident, request, f'{root};{stack}', group))
+        del frames
+
+        with self._lock:
+            for ident, request, stack, group in samples:
+                if request is not None and \
+                        self._requests.get(ident) is request:
+                    if request.profile is None:
+                        request.profile = Profile()
+                    request.profile.add(stack, group)
+                for profile, everything in captures:
+                    if request is not None or everything:
+                        profile.add(stack, group)
+
+    def _stack(self, frame):
+        """
+        Get collapsed stack of a frame and its group.
+
+        :param frame: innermost frame
+        :return: (stack, group)
+        """
+        labels = []
+        group = None
+        while frame is not None:
+            code = frame.f_code
+            label, frame_group = self._frame(code)
+            labels.append(label)
+            if group is None:
+                group = frame_group
+            if code is self._root:
+                break
+            frame = frame.f_back
+        labels.reverse()
+        return ';'.join(labels), group or OTHER
+
+    def _frame(self, code):
+        """
+        Get label and group of a code object, cached.
+
+        :param code:
+        :return: (label, group or None)
+        """
+        cached = self._frames.get(code)
+        if cached is not None:
+            return cached
+        path = code.co_filename.replace(os.sep, '/')
+        for prefix in self._prefixes:
+            if code.co_filename.startswith(prefix):
+                path = code.co_filename[len(prefix):].replace(os.sep, '/')
+                break
+        group = next((
+            name for name, fragments in self.groups
+            if any(fragment in f'/{path}' for fragment in fragments)), None)
+        cached = self._frames[code] = (f'{path}:{code.co_name}', group)
+        return cached
+
+    def dump(self, directory, seconds=PROFILE_SIGNAL_SECONDS):
+        """
+        Capture all threads and write collapsed stacks of the capture and
+        of slow requests, one file per route.
+
+        :param directory:
+        :param seconds:
+        :return: paths of the written files
+        """
+        os.makedirs(directory, exist_ok=True)
+        prefix = f'{os.getpid()}-{time.strftime("%Y%m%dT%H%M%S")}'
+        profiles = {f'profile-{prefix}': self.capture(
+            seconds, all_threads=True)}
+        for label, profile in self.slow_profiles().items():
+            route = re.sub(r'\W+', '-', label).strip('-')
+            profiles[f'slow-{prefix}-{route}'] = profile
+
+        paths = []
+        for name, profile in profiles.items():
+            path = os.path.join(directory, f'{name}.folded')
+            with open(path, 'w') as profile_file:
+                profile_file.write(collapse(profile.stacks))
+            paths.append(path)
+        return paths
+
+    def install_signal_handler(self, directory, signal_name=PROFILE_SIGNAL):
+        """
+        Dump a profile to directory when the process receives a signal.
+
+        Only the main thread can install handlers, so this must run when
+        the worker imports the app, not in a request.
+
+        :param directory:
+        :param signal_name: e.g. SIGUSR2
+        :return: whether the handler was installed
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return False
+
+        def handle(signum, frame):
+            threading.Thread(
+                target=self.dump, args=(directory,), name='profiler-dump',
+                daemon=True).start()
+
+        signal.signal(getattr(signal, signal_name), handle)
+        return True
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,249 @@
+"""Cache of formatted questions by id, kept current on question writes."""
+
+import json
+import os
+import socket
+import threading
+import time
+
+from models import db, question_listeners, shard_router
+from constants import (
+    QUESTION_CACHE_ENTRIES, QUESTION_CACHE_BYTES, QUESTION_CACHE_TTL,
+    QUESTION_CACHE_REDIS_URL, QUESTION_CACHE_RETRY_SECONDS
+)
+from utils import LRUCache
+from .catalog import catalog
+from .metrics import metrics
+
+
+class RedisInvalidator:
+    """Broadcast evictions to the caches of all workers through redis."""
+
+    CHANNEL = 'trivia:questions:evict'
+
+    def __init__(self, url, cache):
+        """
+        Init method.
+
+        :param url:
+        :param cache: LRUCache to evict from
+        """
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.cache = cache
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def origin():
+        """
+        Identify this worker in messages, to skip its own evictions.
+
+        :return:
+        """
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def publish(self, question_id):
+        """
+        Ask other workers to evict a question.
+
+        :param question_id:
+        :return:
+        """
+        self.client.publish(self.CHANNEL, f'{self.origin()} {question_id}')
+
+    def ensure_listening(self):
+        """
+        Start the subscriber thread once per process.
+
+        :return:
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(
+                target=self._listen, name='question-cache-evictions',
+                daemon=True).start()
+
+    def _listen(self):
+        """
+        Thread body, resubscribing with backoff when the connection fails.
+
+        Evictions published while disconnected are lost, so the cache is
+        cleared once subscribed again.
+
+        :return:
+        """
+        delay = 1
+        failed = False
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                if failed:
+                    self.cache.clear()
+                    failed = False
+                delay = 1
+                for message in pubsub.listen():
+                    self.receive(message['data'])
+            except Exception:
+                db.get_app().logger.exception(
+                    'Question cache eviction listener failed, '
+                    f'resubscribing in {delay}s')
+                metrics.incr('question_cache.listener_errors')
+                failed = True
+                time.sleep(delay)
+                delay = min(delay * 2, QUESTION_CACHE_RETRY_SECONDS)
+
+    def receive(self, data):
+        """
+        Evict the question of a message, ignoring malformed messages.
+
+        :param data: message published by another worker
+        :return:
+        """
+        try:
+            origin, question_id = data.decode().split(' ')
+            question_id = int(question_id)
+        except (AttributeError, UnicodeDecodeError, ValueError):
+            db.get_app().logger.warning(
+                f'Ignoring malformed question cache eviction {data!r}')
+            metrics.incr('question_cache.bad_messages')
+            return
+        if origin != self.origin():
+            self.cache.delete(question_id)
+            catalog.mark_changed(question_id)
+            metrics.incr('question_cache.remote_evictions')
+
+
+class QuestionCache:
+    """
+    Bounded LRU cache of formatted questions by id.
+
+    Writes through Question.insert/update/delete update or evict entries.
+    Changes made by other workers are broadcast through redis when
+    configured, and entries expire after ``ttl`` seconds in any case, in
+    case a broadcast is missed. Misses are
+    served from the catalog snapshot when it holds the question, and
+    loaded from the database otherwise.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, redis_url=None):
+        """
+        Init method.
+
+        :param max_entries:
+        :param max_bytes:
+        :param ttl:
+        :param redis_url:
+        """
+        self.cache = LRUCache(
+            max_entries, max_bytes, sizeof=lambda entry: entry[1])
+        self.invalidator = RedisInvalidator(redis_url, self.cache) \
+            if redis_url else None
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit):
+        """
+        Count a lookup, from request threads running concurrently.
+
+        :param hit:
+        :return:
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, question_id):
+        """
+        Get formatted question, loading it on a miss.
+
+        :param question_id:
+        :return: formatted question, or None if it does not exist
+        """
+        if self.invalidator:
+            self.invalidator.ensure_listening()
+
+        entry = self.cache.get(question_id)
+        if entry and (self.ttl is None or entry[2] > time.monotonic()):
+            self._count(True)
+            return dict(entry[0])
+
+        question = catalog.question(question_id)
+        if question:
+            self._count(True)
+            metrics.incr('catalog.hits')
+            return question
+
+        self._count(False)
+        question = shard_router.get(question_id)
+        if not question:
+            return None
+        return dict(self.put(question))
+
+    def put(self, question):
+        """
+        Cache formatted question.
+
+        :param question:
+        :return: formatted question
+        """
+        formatted = question.format()
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.cache.set(
+            question.id, (formatted, len(json.dumps(formatted)), expires))
+        return formatted
+
+    def hit_ratio(self):
+        """
+        Get ratio of lookups served from the cache.
+
+        :return:
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def evict(self, question_id):
+        """
+        Evict question from this and, if configured, all other workers.
+
+        :param question_id:
+        :return:
+        """
+        self.cache.delete(question_id)
+        if self.invalidator:
+            self.invalidator.publish(question_id)
+
+    def on_question_change(self, action, question, previous):
+        """
+        Question listener writing changes through to the cache.
+
+        :param action: insert, update or delete
+        :param question:
+        :param previous: values before the change
+        :return:
+        """
+        if action == 'delete':
+            self.evict(previous['id'])
+            return
+        self.put(question)
+        if action == 'update' and self.invalidator:
+            self.invalidator.publish(question.id)
+
+
+question_cache = QuestionCache(
+    QUESTION_CACHE_ENTRIES, QUESTION_CACHE_BYTES, QUESTION_CACHE_TTL,
+    QUESTION_CACHE_REDIS_URL)
+question_listeners.append(question_cache.on_question_change)
+metrics.gauge('question_cache.hit_ratio', question_cache.hit_ratio)
+metrics.gauge('question_cache.entries', lambda: len(question_cache.cache))
+metrics.gauge('question_cache.bytes', lambda: question_cache.cache.size)
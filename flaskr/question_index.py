@@ -0,0 +1,300 @@
+"""In-process index of question ids per category and difficulty."""
+
+import random
+import sys
+import threading
+from array import array
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from models import Question, question_listeners, shard_router
+from .metrics import metrics
+
+
+def category_key(category):
+    """
+    Normalize category id, e.g. ``"1"`` sent by a client to ``1``.
+
+    :param category:
+    :return: integer, or text for ids no question can have
+    """
+    try:
+        return int(category)
+    except (TypeError, ValueError):
+        return str(category)
+
+
+class QuestionIndex:
+    """
+    Arrays of question ids per category and per (category, difficulty).
+
+    Category None holds all questions.
+
+    Arrays only grow in place: writers append under a lock and swap in a
+    copy to remove an id, so draws read them without locking and adding a
+    question does not copy the whole-catalog buckets.
+    """
+
+    def __init__(self):
+        """
+        Init method.
+        """
+        self.built = False
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._difficulties = {}
+
+    def build(self, snapshot=None):
+        """
+        Build index from a catalog snapshot, or a single streamed query.
+
+        :param snapshot:
+        :return:
+        """
+        buckets = defaultdict(lambda: array('i'))
+        if snapshot is not None:
+            rows = snapshot.rows()
+        else:
+            rows = shard_router.chain(lambda session: session.query(
+                Question.id, Question.category, Question.difficulty
+            ).yield_per(10000))
+        difficulties = defaultdict(set)
+        for question_id, category, difficulty in rows:
+            for key in self._keys(category, difficulty):
+                buckets[key].append(question_id)
+            difficulties[category_key(category)].add(difficulty)
+            difficulties[None].add(difficulty)
+        if snapshot is None:
+            shard_router.commit()
+
+        with self._lock:
+            self._buckets = dict(buckets)
+            self._difficulties = {
+                key: self._sorted(values)
+                for key, values in difficulties.items()
+            }
+            self.built = True
+        metrics.incr('question_index.builds')
+
+    def ensure_built(self, snapshot=None):
+        """
+        Build index on first use.
+
+        :param snapshot:
+        :return:
+        """
+        if not self.built:
+            self.build(snapshot)
+
+    @staticmethod
+    def _keys(category, difficulty):
+        """
+        Get keys of the buckets holding a question.
+
+        :param category:
+        :param difficulty:
+        :return:
+        """
+        category = category_key(category)
+        return category, (category, difficulty), None, (None, difficulty)
+
+    @staticmethod
+    def _sorted(difficulties):
+        """
+        Sort difficulties, ignoring missing ones.
+
+        :param difficulties:
+        :return:
+        """
+        return tuple(sorted(
+            difficulty for difficulty in difficulties
+            if difficulty is not None))
+
+    def ids(self, category=None, difficulty=None):
+        """
+        Get ids of a category, of a difficulty within it, or of all questions.
+
+        :param category: falsy for all categories
+        :param difficulty:
+        :return:
+        """
+        key = category_key(category) if category else None
+        if difficulty is not None:
+            key = (key, difficulty)
+        return self._buckets.get(key, array('i'))
+
+    def difficulties(self, category=None):
+        """
+        Get sorted difficulties of a category, or of all questions.
+
+        :param category: falsy for all categories
+        :return:
+        """
+        key = category_key(category) if category else None
+        return self._difficulties.get(key, ())
+
+    def count(self, category=None, difficulty=None):
+        """
+        Count questions.
+
+        :param category:
+        :param difficulty:
+        :return:
+        """
+        return len(self.ids(category, difficulty))
+
+    def draw(self, category=None, exclude=(), difficulty=None):
+        """
+        Draw a random question id, excluding given ids.
+
+        Samples and rejects excluded ids while they are a minority of the
+        bucket, so a draw takes a few tries whatever the bucket size.
+
+        :param category:
+        :param exclude:
+        :param difficulty:
+        :return: id, or None if every question is excluded
+        """
+        ids = self.ids(category, difficulty)
+        exclude = set(exclude)
+        if len(exclude) * 2 < len(ids):
+            while True:
+                question_id = ids[random.randrange(len(ids))]
+                if question_id not in exclude:
+                    return question_id
+
+        remaining = [
+            question_id for question_id in ids if question_id not in exclude]
+        return random.choice(remaining) if remaining else None
+
+    def add(self, question_id, category, difficulty):
+        """
+        Add question id.
+
+        :param question_id:
+        :param category:
+        :param difficulty:
+        :return:
+        """
+        with self._lock:
+            for key in self._keys(category, difficulty):
+                ids = self._buckets.get(key)
+                if ids is None:
+                    self._buckets[key] = array('i', [question_id])
+                else:
+                    ids.append(question_id)
+            for key in (category_key(category), None):
+                known = self._difficulties.get(key, ())
+                if difficulty is not None and difficulty not in known:
+                    self._difficulties[key] = self._sorted(
+                        known + (difficulty,))
+
+    def remove(self, question_id, category, difficulty):
+        """
+        Remove question id.
+
+        :param question_id:
+        :param category:
+        :param difficulty:
+        :return:
+        """
+        with self._lock:
+            for key in self._keys(category, difficulty):
+                if key in self._buckets:
+                    self._buckets[key] = self._without(
+                        self._buckets[key], question_id)
+            for key in (category_key(category), None):
+                if not self._buckets.get((key, difficulty)):
+                    self._difficulties[key] = tuple(
+                        known for known in self._difficulties.get(key, ())
+                        if known != difficulty)
+
+    @staticmethod
+    def _without(ids, question_id):
+        """
+        Get copy of ids without question id.
+
+        :param ids:
+        :param question_id:
+        :return:
+        """
+        ids = array('i', ids)
+        try:
+            ids.remove(question_id)
+        except ValueError:
+            pass
+        return ids
+
+    def on_question_change(self, action, question, previous):
+        """
+        Question listener keeping the index current.
+
+        :param action: insert, update or delete
+        :param question:
+        :param previous: values before the change
+        :return:
+        """
+        if not self.built:
+            return
+        if action in ('update', 'delete'):
+            self.remove(
+                previous['id'], previous['category'], previous['difficulty'])
+        if action in ('insert', 'update'):
+            self.add(question.id, question.category, question.difficulty)
+
+    def summary(self):
+        """
+        Get (count, sum of ids) per (category, difficulty).
+
+        :return:
+        """
+        return {
+            key: (len(ids), sum(ids))
+            for key, ids in self._buckets.items()
+            if isinstance(key, tuple) and key[0] is not None
+        }
+
+    def verify(self):
+        """
+        Compare index with the database, rebuilding it on mismatch.
+
+        Catches changes committed by other workers or outside the app.
+
+        :return: whether the index was up to date
+        """
+        rows = list(shard_router.chain(lambda session: session.query(
+            Question.category, Question.difficulty,
+            func.count(Question.id), func.sum(Question.id)).group_by(
+            Question.category, Question.difficulty)))
+        shard_router.commit()
+        expected = {}
+        for category, difficulty, count, total in rows:
+            key = (category_key(category), difficulty)
+            known = expected.get(key, (0, 0))
+            expected[key] = (known[0] + count, known[1] + int(total))
+        summary = {key: value for key, value in self.summary().items()
+                   if value[0]}
+        if expected == summary:
+            return True
+
+        metrics.incr('question_index.stale')
+        self.build()
+        return False
+
+    def memory(self):
+        """
+        Get approximate memory footprint in bytes.
+
+        :return:
+        """
+        buckets = self._buckets
+        return sys.getsizeof(buckets) + sum(
+            sys.getsizeof(key) + sys.getsizeof(ids)
+            for key, ids in buckets.items())
+
+
+question_index = QuestionIndex()
+question_listeners.append(question_index.on_question_change)
+metrics.gauge('question_index.questions', lambda: len(question_index.ids()))
+metrics.gauge('question_index.bytes', question_index.memory)
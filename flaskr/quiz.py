@@ -0,0 +1,180 @@
+"""Quiz question selection on the in-process question index."""
+
+import random
+from numbers import Number
+
+from flask import abort
+
+from constants import HTTP_STATUS
+from .question_index import question_index
+from .question_cache import question_cache
+from .metrics import metrics
+
+
+def get_quiz_options(request_data):
+    """
+    Get selection options of a quiz request.
+
+    ``difficulty`` restricts draws to a difficulty or list of difficulties,
+    ``weights`` maps difficulties to their relative draw probability, and
+    ``adaptive`` moves one difficulty up after each correct answer in
+    ``previous_answers`` and one down after each wrong one.
+
+    :param request_data:
+    :return:
+    """
+    difficulties = request_data.get('difficulty')
+    if difficulties is not None:
+        if not isinstance(difficulties, list):
+            difficulties = [difficulties]
+        if not difficulties or not all(
+                isinstance(difficulty, int)
+                and not isinstance(difficulty, bool)
+                for difficulty in difficulties):
+            abort(HTTP_STATUS.BAD_REQUEST)
+        difficulties = set(difficulties)
+
+    weights = request_data.get('weights')
+    if weights is not None:
+        try:
+            weights = {int(difficulty): weight
+                       for difficulty, weight in weights.items()}
+        except (AttributeError, ValueError):
+            abort(HTTP_STATUS.BAD_REQUEST)
+        if not all(isinstance(weight, Number)
+                   and not isinstance(weight, bool) and weight >= 0
+                   for weight in weights.values()):
+            abort(HTTP_STATUS.BAD_REQUEST)
+
+    answers = None
+    if request_data.get('adaptive'):
+        answers = request_data.get('previous_answers', [])
+        if not isinstance(answers, list):
+            abort(HTTP_STATUS.BAD_REQUEST)
+
+    return {'difficulties': difficulties, 'weights': weights,
+            'answers': answers}
+
+
+class QuizEngine:
+    """Draw questions by difficulty from per (category, difficulty) buckets."""
+
+    def __init__(self, index):
+        """
+        Init method.
+
+        :param index:
+        """
+        self.index = index
+
+    def level(self, category, answers, difficulties=None):
+        """
+        Get difficulty reached by a player after the given answers.
+
+        Players start at the easiest difficulty of the category.
+
+        :param category:
+        :param answers: whether each previous answer was correct
+        :param difficulties:
+        :return:
+        """
+        available = self.available(category, difficulties)
+        if not available:
+            return None
+        position = 0
+        for correct in answers:
+            position += 1 if correct else -1
+            position = min(max(position, 0), len(available) - 1)
+        return available[position]
+
+    def available(self, category, difficulties=None):
+        """
+        Get difficulties of a category allowed by the filter.
+
+        :param category:
+        :param difficulties:
+        :return:
+        """
+        available = self.index.difficulties(category)
+        if difficulties is None:
+            return available
+        return tuple(
+            difficulty for difficulty in available
+            if difficulty in difficulties)
+
+    def draw(self, category, exclude=(), difficulties=None, weights=None,
+             answers=None):
+        """
+        Draw a question id.
+
+        Without options every question of the category is equally likely.
+        Work per draw depends on the number of difficulties, not on the
+        number of questions.
+
+        :param category: falsy for all categories
+        :param exclude:
+        :param difficulties: allowed difficulties
+        :param weights: relative probability of each difficulty
+        :param answers: correctness of previous answers, for adaptive draws
+        :return: id, or None if no question is left
+        """
+        exclude = set(exclude)
+        if difficulties is None and weights is None and answers is None:
+            return self.index.draw(category, exclude)
+
+        if answers is not None:
+            level = self.level(category, answers, difficulties)
+            if level is None:
+                return None
+            # Closest difficulty with questions left, harder on ties.
+            for difficulty in sorted(
+                    self.available(category, difficulties),
+                    key=lambda difficulty: (abs(difficulty - level),
+                                            -difficulty)):
+                question_id = self.index.draw(category, exclude, difficulty)
+                if question_id is not None:
+                    return question_id
+            return None
+
+        candidates = {
+            difficulty: weights.get(difficulty, 0) if weights is not None
+            else self.index.count(category, difficulty)
+            for difficulty in self.available(category, difficulties)
+        }
+        candidates = {difficulty: weight for difficulty, weight
+                      in candidates.items() if weight > 0}
+        while candidates:
+            difficulty = random.choices(
+                list(candidates), list(candidates.values()))[0]
+            question_id = self.index.draw(category, exclude, difficulty)
+            if question_id is not None:
+                return question_id
+            del candidates[difficulty]
+        return None
+
+
+quiz_engine = QuizEngine(question_index)
+
+
+def draw_question(category_id, previous_questions, **options):
+    """
+    Draw a random question of a category, excluding previous questions.
+
+    :param category_id: falsy to draw from all categories
+    :param previous_questions:
+    :param options: see QuizEngine.draw
+    :return:
+    """
+    question_index.ensure_built()
+    previous_questions = set(map(int, previous_questions))
+    while True:
+        question_id = quiz_engine.draw(
+            category_id, previous_questions, **options)
+        if question_id is None:
+            return None
+        question = question_cache.get(question_id)
+        if question:
+            metrics.incr('quiz.draws')
+            return question
+        # Deleted by another worker since the index was last verified.
+        previous_questions.add(question_id)
@@ -0,0 +1,268 @@
+"""Rate limiting and admission control for expensive routes."""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, _request_ctx_stack
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+
+from constants import (
+    RATE_LIMITS, RATE_LIMIT_REDIS_URL, RATE_LIMIT_ENABLED,
+    RATE_LIMIT_TRUSTED_PROXIES
+)
+
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+'''
+
+
+class InProcessBackend:
+    """
+    Token buckets kept in the memory of the worker.
+
+    Buckets are kept in least recently used order. Full buckets carry no
+    state, so they are dropped from the least recently used end, and so
+    are buckets over MAX_KEYS, which are full unless more clients were
+    seen within the time a bucket takes to fill up. Each bucket is dropped
+    once, so eviction costs constant time per request on average.
+    """
+
+    MAX_KEYS = 100000
+
+    def __init__(self):
+        """
+        Init method.
+        """
+        # key -> (tokens, last update, time the bucket is full again)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst):
+        """
+        Take a token from the bucket of key.
+
+        :param key:
+        :param rate:
+        :param burst:
+        :return: (allowed, seconds until a token is available)
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            self._buckets.move_to_end(key)
+            # The bucket of key was just taken from, so it is never full.
+            while len(self._buckets) > self.MAX_KEYS or \
+                    next(iter(self._buckets.values()))[2] <= now:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def reset(self):
+        """
+        Forget all buckets.
+
+        :return:
+        """
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBackend:
+    """Token buckets shared by all workers through redis."""
+
+    def __init__(self, url):
+        """
+        Init method.
+
+        :param url:
+        """
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def consume(self, key, rate, burst):
+        """
+        Take a token from the bucket of key.
+
+        :param key:
+        :param rate:
+        :param burst:
+        :return: (allowed, seconds until a token is available)
+        """
+        allowed, tokens = self.script(
+            keys=[f'ratelimit:{key}'], args=[rate, burst, time.time()])
+        tokens = float(tokens)
+        return bool(allowed), 0 if allowed else (1 - tokens) / rate
+
+    def reset(self):
+        """
+        Forget all buckets.
+
+        :return:
+        """
+        for key in self.client.scan_iter('ratelimit:*'):
+            self.client.delete(key)
+
+
+def client_address(remote_addr, forwarded_for,
+                   trusted_proxies=RATE_LIMIT_TRUSTED_PROXIES):
+    """
+    Get address of the client as seen by the outermost trusted proxy.
+
+    Each proxy appends the address it got the request from to
+    X-Forwarded-For, so only the last ``trusted_proxies`` entries were not
+    written by the client.
+
+    :param remote_addr: address of the socket peer
+    :param forwarded_for: X-Forwarded-For header, or None
+    :param trusted_proxies:
+    :return:
+    """
+    if trusted_proxies and forwarded_for:
+        addresses = [address.strip() for address in forwarded_for.split(',')]
+        if len(addresses) >= trusted_proxies:
+            return addresses[-trusted_proxies]
+    return remote_addr
+
+
+def identify(payload, remote_addr, forwarded_for):
+    """
+    Identify the client by JWT subject, or by IP for anonymous requests.
+
+    :param payload: verified JWT payload, or None
+    :param remote_addr:
+    :param forwarded_for:
+    :return:
+    """
+    if payload and payload.get('sub'):
+        return f"sub:{payload['sub']}"
+    return f'ip:{client_address(remote_addr, forwarded_for)}'
+
+
+def client_key():
+    """
+    Identify the client of the current request.
+
+    :return:
+    """
+    return identify(
+        getattr(_request_ctx_stack.top, 'current_user', None),
+        request.remote_addr, request.headers.get('X-Forwarded-For'))
+
+
+class RateLimiter:
+    """Token bucket rate limiter with a concurrency cap per route."""
+
+    def __init__(self, backend, limits, enabled=True):
+        """
+        Init method.
+
+        :param backend:
+        :param limits:
+        :param enabled:
+        """
+        self.backend = backend
+        self.limits = limits
+        self.enabled = enabled
+        self.slots = {
+            name: threading.BoundedSemaphore(concurrency)
+            for name, (rate, burst, concurrency) in limits.items()
+        }
+
+    def admit(self, name, client):
+        """
+        Take a token of client and a concurrency slot of the limits
+        configured under name.
+
+        :param name:
+        :param client: key of the client, see identify
+        :return: slot to release once the request is served, None when
+            limiting is off
+        """
+        if not self.enabled:
+            return None
+
+        rate, burst, concurrency = self.limits[name]
+        allowed, retry_after = self.backend.consume(
+            f'{name}:{client}', rate, burst)
+        if not allowed:
+            error = TooManyRequests()
+            error.retry_after = retry_after
+            raise error
+
+        slots = self.slots[name]
+        if not slots.acquire(blocking=False):
+            raise ServiceUnavailable()
+        return slots
+
+    def limit(self, name):
+        """
+        Limit decorated route with the limits configured under name.
+
+        Place it below ``requires_auth`` so clients are keyed by their
+        verified JWT subject.
+
+        :param name:
+        :return:
+        """
+        def rate_limit_decorator(f):
+            """
+            Rate limit decorator.
+
+            :param f:
+            :return:
+            """
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                """
+                Wrapper method.
+
+                :param args:
+                :param kwargs:
+                :return:
+                """
+                slot = self.admit(name, client_key())
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    if slot is not None:
+                        slot.release()
+
+            return wrapper
+
+        return rate_limit_decorator
+
+    def reset(self):
+        """
+        Forget all buckets.
+
+        :return:
+        """
+        self.backend.reset()
+
+
+rate_limiter = RateLimiter(
+    RedisBackend(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL
+    else InProcessBackend(), RATE_LIMITS, RATE_LIMIT_ENABLED)
+rate_limited = rate_limiter.limit
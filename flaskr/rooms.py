@@ -0,0 +1,249 @@
+"""Live quiz rooms pushing questions to players over Server-Sent Events."""
+
+import json
+import queue
+import secrets
+import threading
+import time
+
+from constants import (
+    ROOM_HEARTBEAT_SECONDS, ROOM_IDLE_SECONDS, ROOM_PLAYER_BACKLOG
+)
+from .metrics import metrics
+
+# Events after which the stream of a player ends.
+FINAL_EVENTS = ('event: closed\n', 'event: dropped\n')
+
+
+def format_event(event, data):
+    """
+    Serialize an event in Server-Sent Events format.
+
+    :param event:
+    :param data:
+    :return:
+    """
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class Room:
+    """Quiz room of a host and the players subscribed to it."""
+
+    def __init__(self, room_id, host, category_id):
+        """
+        Init method.
+
+        :param room_id:
+        :param host:
+        :param category_id:
+        """
+        self.id = room_id
+        self.host = host
+        self.category_id = category_id
+        self.asked = []
+        self.current = None
+        self.closed = False
+        self._players = set()
+        self._lock = threading.Lock()
+        self._ask_lock = threading.Lock()
+        self.last_active = time.monotonic()
+
+    @property
+    def players(self):
+        return len(self._players)
+
+    def join(self):
+        """
+        Subscribe a player, replaying the current question to late joiners.
+
+        :return:
+        """
+        player = queue.Queue(maxsize=ROOM_PLAYER_BACKLOG)
+        self.last_active = time.monotonic()
+        with self._lock:
+            if self.current:
+                player.put_nowait(self.current)
+            self._players.add(player)
+        return player
+
+    def leave(self, player):
+        """
+        Unsubscribe a player.
+
+        :param player:
+        :return:
+        """
+        with self._lock:
+            self._players.discard(player)
+
+    def ask(self, draw):
+        """
+        Draw the next question once and push it to every player, or push
+        the end of the quiz when no question is left.
+
+        Concurrent calls are serialized, so no question is asked twice.
+
+        :param draw: callable drawing a question, excluding the given ids
+        :return: question, or None
+        """
+        self.last_active = time.monotonic()
+        with self._ask_lock:
+            with self._lock:
+                asked = list(self.asked)
+            question = draw(asked)
+            if question:
+                with self._lock:
+                    self.asked.append(question['id'])
+                self.publish('question', question)
+            else:
+                self.publish('finished', {'room': self.id})
+        return question
+
+    def publish(self, event, data):
+        """
+        Push an event to every player.
+
+        The event is serialized once for all players. Players too slow to
+        keep up with their backlog are dropped: their backlog is replaced
+        by a dropped event ending their stream, so they rejoin.
+
+        :param event:
+        :param data:
+        :return:
+        """
+        message = format_event(event, data)
+        with self._lock:
+            if event == 'question':
+                self.current = message
+            for player in list(self._players):
+                try:
+                    player.put_nowait(message)
+                except queue.Full:
+                    self._players.discard(player)
+                    self._drop(player)
+                    metrics.incr('rooms.players_dropped')
+            delivered = len(self._players)
+        metrics.incr('rooms.events')
+        metrics.incr('rooms.deliveries', delivered)
+
+    def _drop(self, player):
+        """
+        Replace the backlog of a player with a dropped event.
+
+        Events are only put under the room lock, so the emptied queue has
+        room for it.
+
+        :param player:
+        :return:
+        """
+        try:
+            while True:
+                player.get_nowait()
+        except queue.Empty:
+            pass
+        player.put_nowait(format_event('dropped', {'room': self.id}))
+
+    def stream(self, player):
+        """
+        Yield events of a player until the room closes or the player leaves.
+
+        :param player:
+        :return:
+        """
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    message = player.get(timeout=ROOM_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    if self.closed:
+                        return
+                    yield ': keep-alive\n\n'
+                    continue
+                yield message
+                if message.startswith(FINAL_EVENTS):
+                    return
+        finally:
+            self.leave(player)
+
+    def format(self):
+        """
+        Format method.
+
+        :return:
+        """
+        return {
+            'id': self.id,
+            'category': self.category_id,
+            'asked': len(self.asked),
+            'players': self.players,
+        }
+
+
+class RoomRegistry:
+    """Rooms hosted by this worker."""
+
+    def __init__(self):
+        """
+        Init method.
+        """
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def create(self, host, category_id):
+        """
+        Create room.
+
+        :param host:
+        :param category_id:
+        :return:
+        """
+        room = Room(secrets.token_urlsafe(8), host, category_id)
+        with self._lock:
+            self._rooms[room.id] = room
+        return room
+
+    def get(self, room_id):
+        """
+        Get room by id.
+
+        :param room_id:
+        :return:
+        """
+        return self._rooms.get(room_id)
+
+    def close(self, room):
+        """
+        Close room and disconnect its players.
+
+        :param room:
+        :return:
+        """
+        with self._lock:
+            self._rooms.pop(room.id, None)
+        room.closed = True
+        room.publish('closed', {'room': room.id})
+
+    def expire(self, idle_seconds=ROOM_IDLE_SECONDS):
+        """
+        Close rooms no player joined and no question was asked in for
+        idle_seconds, e.g. rooms whose host left without closing them.
+
+        :param idle_seconds:
+        :return: number of closed rooms
+        """
+        cutoff = time.monotonic() - idle_seconds
+        with self._lock:
+            idle = [room for room in self._rooms.values()
+                    if room.last_active < cutoff]
+        for room in idle:
+            self.close(room)
+        metrics.incr('rooms.expired', len(idle))
+        return len(idle)
+
+
+rooms = RoomRegistry()
+metrics.gauge('rooms.active', lambda: len(rooms))
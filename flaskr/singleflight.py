@@ -0,0 +1,122 @@
+"""Coalescing of identical concurrent reads."""
+
+import threading
+from functools import wraps
+
+from flask import request, make_response, current_app
+
+from .metrics import metrics
+
+
+class _Call:
+    """In-flight computation shared by concurrent callers."""
+
+    def __init__(self):
+        """
+        Init method.
+        """
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run a computation once per key for all concurrent callers."""
+
+    def __init__(self):
+        """
+        Init method.
+        """
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Run fn, or wait for the result of an identical in-flight call.
+
+        :param key:
+        :param fn:
+        :return: (result, whether this caller ran fn)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, False
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, True
+
+
+reads = SingleFlight()
+
+
+def coalesced(f):
+    """
+    Share one execution of a read route among identical concurrent requests.
+
+    Requests are identical when they hit the same endpoint with the same
+    view and query arguments. Every request gets its own response object
+    built from the shared serialized body.
+
+    :param f:
+    :return:
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        """
+        Wrapper method.
+
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        key = (
+            request.endpoint,
+            tuple(sorted(kwargs.items())),
+            tuple(sorted(request.args.items(multi=True))),
+        )
+
+        def render():
+            response = make_response(f(*args, **kwargs))
+            return response.get_data(), response.status_code, \
+                response.mimetype
+
+        (body, status, mimetype), leader = reads.do(key, render)
+        metrics.incr(
+            f"coalesce.{request.endpoint}.{'leader' if leader else 'shared'}")
+        return current_app.response_class(
+            body, status=status, mimetype=mimetype)
+
+    return wrapper
+
+
+def dedupe_rate():
+    """
+    Get share of coalesced requests served by another request's query.
+
+    :return:
+    """
+    counters = metrics.counters()
+    shared = sum(value for name, value in counters.items()
+                 if name.startswith('coalesce.') and name.endswith('.shared'))
+    leaders = sum(value for name, value in counters.items()
+                  if name.startswith('coalesce.') and name.endswith('.leader'))
+    return shared / (shared + leaders) if shared + leaders else None
+
+
+metrics.gauge('coalesce.dedupe_rate', dedupe_rate)
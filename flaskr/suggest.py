@@ -0,0 +1,332 @@
+"""In-memory prefix index for question and category suggestions."""
+
+import bisect
+import sys
+import threading
+from array import array
+from collections import defaultdict
+
+from models import db, Question, Category, question_listeners, shard_router
+from constants import SUGGEST_SCAN_LIMIT, SUGGEST_SNIPPET_LENGTH
+from utils import WORD, words
+from .catalog import catalog
+from .metrics import metrics
+
+
+class PrefixIndex:
+    """
+    Sorted vocabulary with a posting array of ids per word.
+
+    Words matching a prefix are a contiguous range of the vocabulary found
+    with bisect. Structures are replaced rather than mutated, so searches
+    read them without locking.
+    """
+
+    def __init__(self):
+        """
+        Init method.
+        """
+        self._lock = threading.Lock()
+        self._words = []
+        self._postings = {}
+        self._texts = {}
+
+    def __len__(self):
+        return len(self._texts)
+
+    def load(self, rows):
+        """
+        Replace index content.
+
+        :param rows: (id, text) pairs
+        :return:
+        """
+        postings = defaultdict(lambda: array('i'))
+        texts = {}
+        for row_id, text in rows:
+            texts[row_id] = text
+            for word in words(text):
+                postings[word].append(row_id)
+        with self._lock:
+            self._words = sorted(postings)
+            self._postings = dict(postings)
+            self._texts = texts
+
+    def add(self, row_id, text):
+        """
+        Add or replace text of id.
+
+        :param row_id:
+        :param text:
+        :return:
+        """
+        with self._lock:
+            self._remove(row_id)
+            vocabulary = None
+            for word in words(text):
+                ids = self._postings.get(word)
+                if ids is None:
+                    if vocabulary is None:
+                        vocabulary = list(self._words)
+                    bisect.insort(vocabulary, word)
+                    ids = array('i')
+                self._postings[word] = ids + array('i', [row_id])
+            if vocabulary is not None:
+                self._words = vocabulary
+            self._texts[row_id] = text
+
+    def remove(self, row_id):
+        """
+        Remove id.
+
+        :param row_id:
+        :return:
+        """
+        with self._lock:
+            self._remove(row_id)
+
+    def _remove(self, row_id):
+        """
+        Remove id, with the lock held.
+
+        :param row_id:
+        :return:
+        """
+        text = self._texts.pop(row_id, None)
+        if text is None:
+            return
+        vocabulary = None
+        for word in words(text):
+            ids = array('i', self._postings.get(word, ()))
+            if row_id in ids:
+                ids.remove(row_id)
+            if ids:
+                self._postings[word] = ids
+                continue
+            self._postings.pop(word, None)
+            if vocabulary is None:
+                vocabulary = list(self._words)
+            position = bisect.bisect_left(vocabulary, word)
+            if position < len(vocabulary) and vocabulary[position] == word:
+                del vocabulary[position]
+        if vocabulary is not None:
+            self._words = vocabulary
+
+    def __contains__(self, row_id):
+        return row_id in self._texts
+
+    def ids(self):
+        """
+        Get indexed ids.
+
+        :return:
+        """
+        return list(self._texts)
+
+    def search(self, query, limit, scan_limit=SUGGEST_SCAN_LIMIT):
+        """
+        Get ids whose text has a word starting with each word of query.
+
+        :param query:
+        :param limit:
+        :param scan_limit:
+        :return: [(id, text)]
+        """
+        vocabulary, postings, texts = self._words, self._postings, self._texts
+        return scan(
+            query, limit, scan_limit, vocabulary,
+            lambda position: postings.get(vocabulary[position], ()),
+            texts.get)
+
+    def memory(self):
+        """
+        Get approximate memory footprint in bytes.
+
+        :return:
+        """
+        return sys.getsizeof(self._words) + sum(
+            sys.getsizeof(word) + sys.getsizeof(ids)
+            for word, ids in self._postings.items()) + sum(
+            sys.getsizeof(text) for text in self._texts.values())
+
+
+def scan(query, limit, scan_limit, vocabulary, postings, text,
+         skip=None):
+    """
+    Get ids whose text has a word starting with each word of query.
+
+    The last word of the query drives the scan, as it is usually the one
+    being typed. At most scan_limit candidates are examined, so very short
+    prefixes answer quickly with partial results.
+
+    :param query:
+    :param limit:
+    :param scan_limit:
+    :param vocabulary: sorted words
+    :param postings: position in vocabulary -> ids having that word
+    :param text: id -> text, or None if unknown
+    :param skip: id -> whether to leave it out
+    :return: [(id, text)]
+    """
+    tokens = WORD.findall(query.lower())
+    if not tokens or limit <= 0:
+        return []
+    prefix, others = tokens[-1], tokens[:-1]
+
+    results = []
+    seen = set()
+    position = bisect.bisect_left(vocabulary, prefix)
+    while position < len(vocabulary) and len(seen) < scan_limit:
+        if not vocabulary[position].startswith(prefix):
+            break
+        for row_id in postings(position):
+            if row_id in seen:
+                continue
+            seen.add(row_id)
+            if skip and skip(row_id):
+                continue
+            row_text = text(row_id)
+            if row_text is None:
+                continue
+            if others:
+                text_words = words(row_text)
+                if not all(any(text_word.startswith(token)
+                               for text_word in text_words)
+                           for token in others):
+                    continue
+            results.append((row_id, row_text))
+            if len(results) >= limit:
+                return results
+        position += 1
+    return results
+
+
+class SuggestIndex:
+    """
+    Prefix indexes over question text and category names.
+
+    Built from a catalog snapshot, questions are searched in the snapshot,
+    shared by all workers, and the index of this worker only holds the
+    questions it changed since; changed questions are left out of
+    snapshot results.
+    """
+
+    def __init__(self, catalog):
+        """
+        Init method.
+
+        :param catalog:
+        """
+        self.built = False
+        self.catalog = catalog
+        self.from_snapshot = False
+        self.questions = PrefixIndex()
+        self.categories = PrefixIndex()
+
+    def build(self, snapshot=None):
+        """
+        Build indexes from a catalog snapshot, or streamed queries.
+
+        :param snapshot:
+        :return:
+        """
+        if snapshot is not None:
+            if not self.from_snapshot:
+                self.questions.load(())
+            # Questions changed before the snapshot was written are in it.
+            for question_id in self.questions.ids():
+                if not self.catalog.is_changed(question_id):
+                    self.questions.remove(question_id)
+            self.categories.load(snapshot.categories().items())
+            self.from_snapshot = True
+        else:
+            self.questions.load(shard_router.chain(
+                lambda session: session.query(
+                    Question.id, Question.question).yield_per(10000)))
+            self.categories.load(
+                db.session.query(Category.id, Category.type))
+            shard_router.commit()
+            self.from_snapshot = False
+        self.built = True
+        metrics.incr('suggest.builds')
+
+    def ensure_built(self, snapshot=None):
+        """
+        Build indexes on first use.
+
+        :param snapshot:
+        :return:
+        """
+        if not self.built:
+            self.build(snapshot)
+
+    def suggest(self, query, limit):
+        """
+        Get questions and categories matching query.
+
+        :param query:
+        :param limit:
+        :return:
+        """
+        return {
+            'questions': [
+                {'id': question_id, 'snippet': snippet(text)}
+                for question_id, text in self.search_questions(query, limit)
+            ],
+            'categories': [
+                {'id': category_id, 'type': text}
+                for category_id, text in self.categories.search(query, limit)
+            ],
+        }
+
+    def search_questions(self, query, limit):
+        """
+        Get questions matching query, changed ones first.
+
+        :param query:
+        :param limit:
+        :return: [(id, text)]
+        """
+        results = self.questions.search(query, limit)
+        snapshot = self.catalog.snapshot if self.from_snapshot else None
+        if snapshot is None:
+            return results
+        return results + scan(
+            query, limit - len(results), SUGGEST_SCAN_LIMIT,
+            snapshot.vocabulary, snapshot.postings, snapshot.text,
+            skip=lambda question_id: question_id in self.questions or
+            self.catalog.is_changed(question_id))
+
+    def on_question_change(self, action, question, previous):
+        """
+        Question listener keeping the index current.
+
+        :param action: insert, update or delete
+        :param question:
+        :param previous: values before the change
+        :return:
+        """
+        if not self.built:
+            return
+        if action == 'delete':
+            self.questions.remove(previous['id'])
+        else:
+            self.questions.add(question.id, question.question)
+
+
+def snippet(text):
+    """
+    Shorten text to a snippet.
+
+    :param text:
+    :return:
+    """
+    if len(text) <= SUGGEST_SNIPPET_LENGTH:
+        return text
+    return text[:SUGGEST_SNIPPET_LENGTH - 1].rstrip() + '…'
+
+
+suggest_index = SuggestIndex(catalog)
+question_listeners.append(suggest_index.on_question_change)
+metrics.gauge('suggest.bytes', lambda: suggest_index.questions.memory() +
+              suggest_index.categories.memory())
@@ -1,8 +1,20 @@
+import json
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
+from sqlalchemy import func, literal
 
+from constants import ROLE_PERMISSIONS, CATALOG_SNAPSHOT_PATH, PACKS_DIR
 from flaskr import app
-from models import db
+from flaskr.audit import audit_log
+from flaskr.dedupe import duplicate_index, find_clusters
+from flaskr.catalog import write_snapshot
+from flaskr.packs import PackBuilder
+from flaskr.keys import key_provider, LocalKeys
+from models import (
+    db, Question, QuestionChange, QuestionShard, CategoryStat,
+    rebuild_category_stats, shard_router
+)
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +22,238 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('-r', '--role', dest='role', default='user',
+                choices=sorted(ROLE_PERMISSIONS))
+@manager.option('-p', '--permissions', dest='permissions', default=None,
+                help='comma separated, instead of the permissions of role')
+@manager.option('-s', '--sub', dest='sub', default='local|user')
+@manager.option('-e', '--expires-in', dest='expires_in', type=int,
+                default=3600)
+def mint_token(role, permissions, sub, expires_in):
+    """
+    Print a token signed by the local key, with AUTH_KEY_PROVIDER=local.
+
+    :param role:
+    :param permissions:
+    :param sub:
+    :param expires_in:
+    :return:
+    """
+    if not isinstance(key_provider, LocalKeys):
+        raise SystemExit('Tokens can only be minted with '
+                         'AUTH_KEY_PROVIDER=local.')
+    permissions = permissions.split(',') if permissions \
+        else ROLE_PERMISSIONS[role]
+    print(key_provider.mint(permissions, sub=sub, expires_in=expires_in))
+
+
+@manager.option('-o', '--output', dest='path', default=CATALOG_SNAPSHOT_PATH)
+def build_catalog(path):
+    """
+    Write the catalog snapshot mapped by workers, e.g. before they start.
+
+    :param path:
+    :return:
+    """
+    if not path:
+        raise SystemExit('Set CATALOG_SNAPSHOT_PATH or pass --output.')
+    version = write_snapshot(path)
+    print(f'Wrote catalog snapshot {version} to {path}')
+
+
+@manager.option('-o', '--output', dest='directory', default=PACKS_DIR)
+@manager.option('-f', '--full', dest='full', action='store_true',
+                help='rebuild every pack, not only changed ones')
+def build_packs(directory, full):
+    """
+    Build quiz packs of changed categories and publish their manifest.
+
+    :param directory:
+    :param full:
+    :return:
+    """
+    if not directory:
+        raise SystemExit('Set PACKS_DIR or pass --output.')
+    rebuilt = PackBuilder(directory).build(full=full)
+    if rebuilt is None:
+        raise SystemExit('Another process is building packs.')
+    print(f"Rebuilt {len(rebuilt)} packs: {', '.join(rebuilt) or 'none'}")
+
+
+@manager.command
+def backfill_changes():
+    """
+    Log an insert for every question missing from the change log.
+
+    Run once after deploying the change log, so clients syncing from
+    sequence 0 also receive questions created before it.
+
+    :return:
+    """
+    logged = db.session.query(QuestionChange.question_id)
+    if shard_router.enabled:
+        # Shards cannot select from the change log of the app database.
+        logged = {question_id for (question_id,) in logged}
+        rows = [
+            dict(zip(Question.FIELDS[1:], row[1:]), question_id=row[0],
+                 action='insert')
+            for row in shard_router.merged(lambda session: session.query(*(
+                getattr(Question, name) for name in Question.FIELDS
+            )).order_by(Question.id))
+            if row[0] not in logged
+        ]
+        db.session.bulk_insert_mappings(QuestionChange, rows)
+        shard_router.commit()
+        print(f'Logged {len(rows)} questions')
+        return
+
+    rows = db.session.query(
+        Question.id, Question.question, Question.answer, Question.category,
+        Question.difficulty, literal('insert'), func.now()).filter(
+        ~Question.id.in_(logged)).order_by(Question.id)
+    result = db.session.execute(
+        QuestionChange.__table__.insert().from_select(
+            ['question_id', 'question', 'answer', 'category', 'difficulty',
+             'action', 'created_at'], rows.statement))
+    db.session.commit()
+    print(f'Logged {result.rowcount} questions')
+
+
+@manager.command
+def refresh_category_stats():
+    """
+    Recount questions per category and difficulty.
+
+    Workers rebuild the counts when their total is off; run this after
+    moving questions between categories outside the app.
+
+    :return:
+    """
+    rebuild_category_stats(db.session)
+    db.session.commit()
+    rows = db.session.query(CategoryStat).count()
+    print(f'Counted questions of {rows} categories and difficulties')
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=10000)
+def shard_questions(batch_size):
+    """
+    Copy questions of the app database to the shards of QUESTION_SHARDS.
+
+    Run once when enabling sharding, before workers serve writes. Ids are
+    kept, and questions already copied are skipped, so the command can be
+    run again after a failure. The questions table of the app database is
+    left as it was.
+
+    :param batch_size:
+    :return:
+    """
+    if not shard_router.enabled:
+        raise SystemExit('Set QUESTION_SHARDS to shard questions.')
+    sharded = {question_id for (question_id,) in db.session.query(
+        QuestionShard.id)}
+    rows = [dict(zip(Question.FIELDS, row)) for row in db.session.query(*(
+        getattr(Question, name) for name in Question.FIELDS)).order_by(
+        Question.id) if row[0] not in sharded]
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        shards = {}
+        for row in batch:
+            shards.setdefault(
+                shard_router.shard_of(row['category']), []).append(row)
+        for shard, questions in shards.items():
+            session = shard_router.sessions()[shard]
+            # Copied by a run failing before updating the directory.
+            copied = {question_id for (question_id,) in session.query(
+                Question.id).filter(Question.id.in_(
+                    [row['id'] for row in questions]))}
+            session.bulk_insert_mappings(Question, [
+                row for row in questions if row['id'] not in copied])
+            session.commit()
+        db.session.bulk_insert_mappings(QuestionShard, [
+            {'id': row['id'], 'shard': shard_router.shard_of(row['category'])}
+            for row in batch])
+        db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(
+            "SELECT setval('question_shards_id_seq', GREATEST("
+            "(SELECT MAX(id) FROM question_shards), "
+            "(SELECT COALESCE(MAX(id), 1) FROM questions)))")
+        db.session.commit()
+    print(f'Copied {len(rows)} questions to {len(shard_router.urls)} shards')
+
+
+@manager.option('-p', '--processes', dest='processes', type=int,
+                default=None, help='default: one per core')
+@manager.option('-t', '--threshold', dest='threshold', type=float,
+                default=None, help='default: DEDUPE_THRESHOLD')
+@manager.option('-o', '--output', dest='path', default=None,
+                help='also write clusters to a JSON file')
+def find_duplicates(processes, threshold, path):
+    """
+    Print clusters of near-duplicate questions of the catalog.
+
+    :param processes:
+    :param threshold:
+    :param path:
+    :return:
+    """
+    texts = dict(shard_router.chain(
+        lambda session: session.query(Question.id, Question.question)))
+    shard_router.commit()
+    clusters = find_clusters(
+        texts.items(), threshold or duplicate_index.threshold, processes)
+    for cluster in clusters:
+        print(f'{len(cluster)} questions:')
+        for question_id in cluster:
+            print(f'  {question_id}: {texts[question_id]}')
+    if path:
+        with open(path, 'w') as output:
+            json.dump([[{'id': question_id, 'question': texts[question_id]}
+                        for question_id in cluster]
+                       for cluster in clusters], output, indent=2)
+    print(f'Found {len(clusters)} clusters of near-duplicates among '
+          f'{len(texts)} questions')
+
+
+@manager.option('path', help='JSON list of questions, as for POST /questions')
+@manager.option('-m', '--mode', dest='mode', default=None,
+                choices=('off', 'flag', 'reject'),
+                help='default: DEDUPE_MODE')
+def import_questions(path, mode):
+    """
+    Insert questions, checking each one for near-duplicates.
+
+    Questions are also checked against those imported before them, so a
+    file holding the same question twice imports it once with reject.
+
+    :param path:
+    :param mode:
+    :return:
+    """
+    with open(path) as questions_file:
+        questions = json.load(questions_file)
+    if mode:
+        duplicate_index.mode = mode
+    token = {'sub': 'manage.py import_questions'}
+    imported = rejected = 0
+    for values in questions:
+        duplicates = duplicate_index.check(values.get('question'))
+        if duplicates:
+            similar = ', '.join(str(duplicate['id'])
+                                for duplicate in duplicates)
+            print(f"{values.get('question')!r} is similar to {similar}")
+            if duplicate_index.mode == 'reject':
+                rejected += 1
+                continue
+        question = Question(**values)
+        question.insert()
+        audit_log.record(token, 'insert', question.id,
+                         after=question.format())
+        imported += 1
+    print(f'Imported {imported} questions, rejected {rejected}')
+
+
 if __name__ == '__main__':
     manager.run()
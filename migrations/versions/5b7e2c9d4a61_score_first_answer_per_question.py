@@ -0,0 +1,50 @@
+"""score first answer per question
+
+Store answer and score categories as integers, like questions.category,
+and allow one answer per user and question. Later answers already stored
+are deleted and scores recounted from the remaining answers.
+
+Revision ID: 5b7e2c9d4a61
+Revises: c20df0bf2078
+Create Date: 2026-10-19 09:41:27.513204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2c9d4a61'
+down_revision = 'c20df0bf2078'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        'DELETE FROM answers WHERE id NOT IN ('
+        'SELECT MIN(id) FROM answers GROUP BY "user", question_id)')
+    op.execute('DELETE FROM scores')
+    op.execute(
+        'INSERT INTO scores ("user", category, score) '
+        'SELECT "user", category, COUNT(*) FROM answers '
+        'WHERE correct GROUP BY "user", category')
+
+    for table in ('answers', 'scores'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(
+                'category', existing_type=sa.String(), type_=sa.Integer(),
+                postgresql_using='category::integer')
+    with op.batch_alter_table('answers') as batch_op:
+        batch_op.create_unique_constraint(
+            'uq_answers_user', ['user', 'question_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('answers') as batch_op:
+        batch_op.drop_constraint('uq_answers_user', type_='unique')
+    for table in ('answers', 'scores'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(
+                'category', existing_type=sa.Integer(), type_=sa.String(),
+                postgresql_using='category::text')
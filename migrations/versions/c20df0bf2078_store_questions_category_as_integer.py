@@ -0,0 +1,34 @@
+"""store questions category as integer
+
+questions.category was created as text by db.create_all, while databases
+restored from trivia.psql hold it as integer. Convert the text column so
+every database stores category ids as integers.
+
+Revision ID: c20df0bf2078
+Revises:
+Create Date: 2026-10-19 05:12:58.995128
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c20df0bf2078'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('questions') as batch_op:
+        batch_op.alter_column(
+            'category', existing_type=sa.String(), type_=sa.Integer(),
+            postgresql_using='category::integer')
+
+
+def downgrade():
+    with op.batch_alter_table('questions') as batch_op:
+        batch_op.alter_column(
+            'category', existing_type=sa.Integer(), type_=sa.String(),
+            postgresql_using='category::text')
@@ -1,14 +1,38 @@
 """Models module for trivia app."""
 
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+import datetime
+import heapq
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from itertools import islice
+from sqlalchemy import (
+    Column, String, Integer, Boolean, DateTime, Text, UniqueConstraint,
+    create_engine, func
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import (
+    make_transient, make_transient_to_detached, object_session
+)
+from sqlalchemy.orm.attributes import get_history
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+from constants import (
+    GROUP_COMMIT_ENABLED, GROUP_COMMIT_BATCH_SIZE, GROUP_COMMIT_WINDOW,
+    QUESTION_SHARDS
+)
+
 
 test_database_path = os.environ.get('TEST_DATABASE_URL')
 db = SQLAlchemy()
 
+# Callables notified with (action, question, previous values) after a
+# question is committed, e.g. to keep in-process indexes current.
+question_listeners = []
+
 
 def setup_db(app, database_path=os.environ.get('DATABASE_URL')):
     """
@@ -23,17 +47,148 @@ def setup_db(app, database_path=os.environ.get('DATABASE_URL')):
     db.app = app
     db.init_app(app)
     db.create_all()
+    shard_router.setup(app)
+
+
+class GroupCommitter:
+    """
+    Commit writes of concurrent requests together, in one transaction.
+
+    Writes are queued to a committer thread, which applies each one in its
+    own SAVEPOINT and commits the group once ``batch_size`` writes are
+    queued or ``window`` seconds after the first one. A failing write only
+    rolls back its SAVEPOINT, so every caller gets its own result or error.
+    """
+
+    def __init__(self, batch_size, window, enabled=True):
+        """
+        Init method.
+
+        :param batch_size:
+        :param window:
+        :param enabled:
+        """
+        self.batch_size = batch_size
+        self.window = window
+        self.enabled = enabled
+        self.groups = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, operation):
+        """
+        Run operation in the next group and wait until it is committed.
+
+        :param operation: callable taking the committer session
+        :return: result of operation
+        """
+        self.ensure_started()
+        future = Future()
+        self._queue.put((operation, future))
+        return future.result()
+
+    def ensure_started(self):
+        """
+        Start the committer thread once per process.
+
+        :return:
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(
+                target=self._loop, name='group-commit', daemon=True).start()
+
+    def mean_group_size(self):
+        """
+        Get mean number of writes per commit.
+
+        :return:
+        """
+        return self.writes / self.groups if self.groups else None
+
+    def _collect(self):
+        """
+        Wait for a write, then collect a group of them.
+
+        :return: [(operation, future)]
+        """
+        group = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(group) < self.batch_size:
+            try:
+                group.append(self._queue.get(
+                    timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return group
+
+    def _loop(self):
+        """
+        Thread body.
+
+        :return:
+        """
+        while True:
+            group = self._collect()
+            with db.get_app().app_context():
+                self.commit(group)
+
+    def commit(self, group):
+        """
+        Apply and commit a group of writes, then resolve their futures.
+
+        :param group: [(operation, future)]
+        :return:
+        """
+        session = db.session
+        outcomes = []
+        try:
+            for operation, future in group:
+                savepoint = session.begin_nested()
+                try:
+                    result = operation(session)
+                    savepoint.commit()
+                except Exception as error:
+                    savepoint.rollback()
+                    outcomes.append((future, None, error))
+                else:
+                    outcomes.append((future, result, None))
+            session.commit()
+        except Exception as error:
+            session.rollback()
+            outcomes = [(future, None, error) for _, future in group]
+        finally:
+            db.session.remove()
+
+        self.groups += 1
+        self.writes += len(group)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+group_committer = GroupCommitter(
+    GROUP_COMMIT_BATCH_SIZE, GROUP_COMMIT_WINDOW, GROUP_COMMIT_ENABLED)
 
 
 class Question(db.Model):
     """Question Model."""
 
     __tablename__ = 'questions'
+    FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer)
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -57,8 +212,22 @@ class Question(db.Model):
         :param self:
         :return:
         """
-        db.session.add(self)
-        db.session.commit()
+        if shard_router.enabled:
+            shard_router.insert(self)
+        elif group_committer.enabled:
+            values = self.values()
+            self.id = group_committer.submit(
+                lambda session: Question._apply(session, None, values))
+            # Attach as if loaded, like a committed insert.
+            make_transient_to_detached(self)
+            db.session.add(self)
+        else:
+            db.session.add(self)
+            db.session.flush()
+            count_question(db.session, None, self.values())
+            log_change(db.session, 'insert', self.id, self.values())
+            db.session.commit()
+        self.notify('insert')
 
     def update(self):
         """
@@ -67,7 +236,21 @@ class Question(db.Model):
         :param self:
         :return:
         """
-        db.session.commit()
+        previous = self.committed_values()
+        if shard_router.enabled:
+            shard_router.update(self, previous)
+        elif group_committer.enabled:
+            question_id, values = self.id, self.values()
+            # Release the request transaction while the group commits; the
+            # question reloads the committed values on next access.
+            db.session.rollback()
+            group_committer.submit(lambda session: Question._apply(
+                session, question_id, values, previous))
+        else:
+            count_question(db.session, previous, self.values())
+            log_change(db.session, 'update', self.id, self.values())
+            db.session.commit()
+        self.notify('update', previous)
 
     def delete(self):
         """
@@ -76,8 +259,99 @@ class Question(db.Model):
         :param self:
         :return:
         """
-        db.session.delete(self)
-        db.session.commit()
+        previous = self.committed_values()
+        if shard_router.enabled:
+            shard_router.delete(self, previous)
+        elif group_committer.enabled:
+            question_id = self.id
+            db.session.rollback()
+            db.session.expunge(self)
+            group_committer.submit(lambda session: Question._apply(
+                session, question_id, previous=previous))
+        else:
+            count_question(db.session, previous, None)
+            db.session.delete(self)
+            log_change(db.session, 'delete', self.id)
+            db.session.commit()
+        self.notify('delete', previous)
+
+    def values(self):
+        """
+        Get column values, except id.
+
+        :param self:
+        :return:
+        """
+        with (object_session(self) or db.session).no_autoflush:
+            return {name: getattr(self, name) for name in self.FIELDS[1:]}
+
+    @staticmethod
+    def _apply(session, question_id, values=None, previous=None):
+        """
+        Write a question in a group commit session.
+
+        :param session:
+        :param question_id: None to insert
+        :param values: None to delete
+        :param previous: committed values, None to insert
+        :return: id
+        """
+        if question_id is None:
+            question = Question(**values)
+            session.add(question)
+            session.flush()
+            count_question(session, None, values)
+            log_change(session, 'insert', question.id, values)
+            return question.id
+
+        # Plain statements, without loading the question first: SQLite
+        # cannot upgrade a read lock to a write lock while others write.
+        query = session.query(Question).filter(Question.id == question_id)
+        if values is None:
+            changed = query.delete(synchronize_session=False)
+        else:
+            changed = query.update(values, synchronize_session=False)
+        if not changed:
+            raise LookupError(f'Question {question_id} does not exist')
+        count_question(session, previous, values)
+        log_change(session, 'delete' if values is None else 'update',
+                   question_id, values)
+        return question_id
+
+    def committed_values(self):
+        """
+        Get values of indexed columns as last committed.
+
+        :param self:
+        :return:
+        """
+        values = {'id': self.id}
+        session = object_session(self) or db.session
+        for name in ('category', 'difficulty'):
+            history = get_history(self, name)
+            if history.deleted:
+                values[name] = history.deleted[0]
+            elif not history.added:
+                values[name] = getattr(self, name)
+            else:
+                # Set while expired, the old value was never loaded.
+                with session.no_autoflush:
+                    values[name] = session.query(
+                        getattr(Question, name)).filter(
+                        Question.id == self.id).scalar()
+        return values
+
+    def notify(self, action, previous=None):
+        """
+        Notify question listeners of a committed change.
+
+        :param self:
+        :param action:
+        :param previous:
+        :return:
+        """
+        for listener in question_listeners:
+            listener(action, self, previous)
 
     def format(self):
         return {
@@ -89,6 +363,185 @@ class Question(db.Model):
         }
 
 
+class QuestionChange(db.Model):
+    """Change log of questions, for clients syncing incrementally."""
+
+    __tablename__ = 'question_changes'
+
+    sequence = Column(Integer, primary_key=True)
+    question_id = Column(Integer, nullable=False)
+    action = Column(String, nullable=False)
+    question = Column(String)
+    answer = Column(String)
+    category = Column(Integer)
+    difficulty = Column(Integer)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __init__(self, action, question_id, values=None):
+        """
+        Init method.
+
+        :param action: insert, update or delete
+        :param question_id:
+        :param values: question values, None for a delete
+        """
+        self.action = action
+        self.question_id = question_id
+        for name, value in (values or {}).items():
+            setattr(self, name, value)
+
+    def format(self):
+        """
+        Format method, deletes being tombstones without question.
+
+        :param self:
+        :return:
+        """
+        return {
+            'sequence': self.sequence,
+            'action': self.action,
+            'id': self.question_id,
+            'question': None if self.action == 'delete' else {
+                'id': self.question_id,
+                'question': self.question,
+                'answer': self.answer,
+                'category': self.category,
+                'difficulty': self.difficulty
+            }
+        }
+
+
+class QuestionShard(db.Model):
+    """Directory of sharded questions, allocating their ids."""
+
+    __tablename__ = 'question_shards'
+    # Ids are never reused, even after the last question is deleted.
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = Column(Integer, primary_key=True)
+    shard = Column(Integer, nullable=False)
+
+
+# Key of the Postgres advisory lock ordering change log writers.
+CHANGE_LOG_LOCK = 0x7472697669610001
+
+
+def log_change(session, action, question_id, values=None):
+    """
+    Add a question change to the change log, in the transaction of session.
+
+    On Postgres a transaction-level advisory lock is taken before the
+    change gets its sequence number and held until commit, so sequence
+    numbers are committed in order and a client never skips a change
+    committed late. Unlike a table lock, it does not block reads or vacuum
+    of the log. Writers log their change last, right before committing,
+    so they only wait for each other's commits.
+
+    :param session:
+    :param action: insert, update or delete
+    :param question_id:
+    :param values: question values, None for a delete
+    :return:
+    """
+    if db.engine.dialect.name == 'postgresql':
+        session.execute(
+            'SELECT pg_advisory_xact_lock(:key)', {'key': CHANGE_LOG_LOCK})
+    session.add(QuestionChange(action, question_id, values))
+
+
+class CategoryStat(db.Model):
+    """Number of questions per category and difficulty."""
+
+    __tablename__ = 'category_stats'
+
+    category = Column(Integer, primary_key=True, autoincrement=False)
+    # 0 for questions without difficulty.
+    difficulty = Column(Integer, primary_key=True, autoincrement=False)
+    questions = Column(Integer, nullable=False, default=0)
+
+
+def stat_key(values):
+    """
+    Get (category, difficulty) row of category_stats counting a question.
+
+    :param values: question values, None for no question
+    :return: None if not counted, i.e. without category
+    """
+    if values is None or values.get('category') is None:
+        return None
+    return int(values['category']), int(values.get('difficulty') or 0)
+
+
+def count_question(session, previous, values):
+    """
+    Move a question between rows of category_stats, in the transaction of
+    session.
+
+    A missing row is inserted in a SAVEPOINT, so a concurrent transaction
+    inserting it first makes this one update it instead of failing.
+
+    :param session:
+    :param previous: committed values, None for an insert
+    :param values: new values, None for a delete
+    :return:
+    """
+    old, new = stat_key(previous), stat_key(values)
+    if old == new:
+        return
+    for key, delta in ((old, -1), (new, 1)):
+        if key is None:
+            continue
+        query = session.query(CategoryStat).filter(
+            CategoryStat.category == key[0],
+            CategoryStat.difficulty == key[1])
+        increment = {CategoryStat.questions: CategoryStat.questions + delta}
+        if query.update(increment, synchronize_session=False) or delta < 0:
+            continue
+        try:
+            with session.begin_nested():
+                session.add(CategoryStat(
+                    category=key[0], difficulty=key[1], questions=1))
+        except IntegrityError:
+            query.update(increment, synchronize_session=False)
+
+
+def rebuild_category_stats(session):
+    """
+    Recount category_stats from questions, in the transaction of session.
+
+    On Postgres writers of the table wait until commit, so their changes
+    are neither lost nor counted twice.
+
+    :param session:
+    :return:
+    """
+    if db.engine.dialect.name == 'postgresql':
+        session.execute('LOCK TABLE category_stats IN EXCLUSIVE MODE')
+    difficulty = func.coalesce(Question.difficulty, 0)
+    session.query(CategoryStat).delete(synchronize_session=False)
+    if not shard_router.enabled:
+        session.execute(CategoryStat.__table__.insert().from_select(
+            ['category', 'difficulty', 'questions'],
+            session.query(
+                Question.category, difficulty,
+                func.count(Question.id)).filter(
+                Question.category.isnot(None)).group_by(
+                Question.category, difficulty).statement))
+        return
+    rows = [
+        {'category': category, 'difficulty': row_difficulty,
+         'questions': questions}
+        for category, row_difficulty, questions in shard_router.chain(
+            lambda shard: shard.query(
+                Question.category, difficulty,
+                func.count(Question.id)).filter(
+                Question.category.isnot(None)).group_by(
+                Question.category, difficulty))
+    ]
+    if rows:
+        session.execute(CategoryStat.__table__.insert(), rows)
+
+
 class Category(db.Model):
     """Category Model."""
 
@@ -117,3 +570,431 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
         }
+
+
+class Answer(db.Model):
+    """Answer Model."""
+
+    __tablename__ = 'answers'
+    # Only the first answer of a user to a question is scored.
+    __table_args__ = (
+        UniqueConstraint('user', 'question_id', name='uq_answers_user'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user = Column(String, index=True)
+    question_id = Column(Integer)
+    category = Column(Integer)
+    correct = Column(Boolean)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+class Score(db.Model):
+    """Score Model, correct answers of a user per category."""
+
+    __tablename__ = 'scores'
+
+    user = Column(String, primary_key=True)
+    category = Column(Integer, primary_key=True)
+    score = Column(Integer, default=0)
+
+    def __init__(self, user, category, score=0):
+        """
+        Init method.
+
+        :param user:
+        :param category:
+        :param score:
+        """
+        self.user = user
+        self.category = category
+        self.score = score
+
+
+class AuditEvent(db.Model):
+    """Audit trail of question writes, by user."""
+
+    __tablename__ = 'audit_events'
+
+    id = Column(Integer, primary_key=True)
+    user = Column(String, index=True)
+    action = Column(String, nullable=False)
+    question_id = Column(Integer, index=True)
+    # Question values as JSON, before is null for an insert and after for
+    # a delete.
+    before = Column(Text)
+    after = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def format(self):
+        """
+        Format method.
+
+        :param self:
+        :return:
+        """
+        return {
+            'id': self.id,
+            'user': self.user,
+            'action': self.action,
+            'question_id': self.question_id,
+            'before': self.before and json.loads(self.before),
+            'after': self.after and json.loads(self.after),
+            'created_at': self.created_at.isoformat()
+        }
+
+
+class ShardRouter:
+    """
+    Route question reads and writes to the databases holding them.
+
+    Questions are sharded by category over QUESTION_SHARDS, each a
+    database with its own questions table. Reads of one category go to its
+    shard; others run on every shard, with results merged by id. The
+    question_shards table of the app database allocates ids, unique over
+    shards, and maps them to their shard.
+
+    Writes commit the shard first, then the change log, category counts
+    and directory in the app database. The two commits are not atomic: a
+    write failing the second one is undone on its shard, i.e. an insert or
+    the new row of a move is removed and a deleted row is inserted again.
+    A moved question is removed from its old shard last; if that fails,
+    the old row is skipped by merged reads of this worker and removed
+    again before its next write.
+
+    Without shards, the only shard is the app database itself, so callers
+    need not care whether questions are sharded.
+    """
+
+    def __init__(self, urls):
+        """
+        Init method.
+
+        :param urls: database URLs of the shards
+        """
+        self.urls = list(urls)
+        self._sessions = []
+        self._engines = []
+        self._apps = set()
+        # (shard, id) of rows left behind by moves, see _remove_orphans.
+        self._orphans = set()
+
+    @property
+    def enabled(self):
+        """
+        Whether questions are sharded.
+
+        :return:
+        """
+        return bool(self._sessions)
+
+    def setup(self, app, urls=None):
+        """
+        Connect to the shards, creating their questions table.
+
+        :param app:
+        :param urls: None to keep the current ones, [] to stop sharding
+        :return:
+        """
+        if urls is not None:
+            self.urls = list(urls)
+        for session in self._sessions:
+            session.remove()
+        for engine in self._engines:
+            engine.dispose()
+        self._engines = [create_engine(url) for url in self.urls]
+        self._orphans = set()
+        for engine in self._engines:
+            Question.__table__.create(engine, checkfirst=True)
+        # binds={} so every table, questions included, uses the shard.
+        self._sessions = [
+            db.create_scoped_session(options={'bind': engine, 'binds': {}})
+            for engine in self._engines
+        ]
+        if app not in self._apps:
+            self._apps.add(app)
+            app.teardown_appcontext(self.remove)
+
+    def remove(self, error=None):
+        """
+        Remove shard sessions of the app context, like db.session.
+
+        :param error:
+        :return:
+        """
+        for session in self._sessions:
+            session.remove()
+
+    def shard_of(self, category):
+        """
+        Get shard index of a category.
+
+        :param category: id, or None for questions without category
+        :return:
+        """
+        return int(category or 0) % len(self._sessions)
+
+    def session_for(self, category):
+        """
+        Get session of the shard of a category.
+
+        :param category:
+        :return:
+        """
+        if not self.enabled:
+            return db.session
+        return self._sessions[self.shard_of(category)]
+
+    def sessions(self):
+        """
+        Get session of every shard.
+
+        :return:
+        """
+        return list(self._sessions) or [db.session]
+
+    def commit(self):
+        """
+        End read transactions of the app database and every shard.
+
+        :return:
+        """
+        db.session.commit()
+        for session in self._sessions:
+            session.commit()
+
+    def get(self, question_id):
+        """
+        Get question by id from its shard.
+
+        :param question_id:
+        :return: None if it does not exist
+        """
+        if not self.enabled:
+            return Question.query.get(question_id)
+        shard = db.session.query(QuestionShard.shard).filter(
+            QuestionShard.id == question_id).scalar()
+        if shard is None or shard >= len(self._sessions):
+            return None
+        return self._sessions[shard].query(Question).get(question_id)
+
+    def chain(self, query):
+        """
+        Run a query on every shard, one after the other.
+
+        :param query: callable making the query of a session
+        :return: iterator of the rows of every shard
+        """
+        for session in self.sessions():
+            yield from query(session)
+
+    def merged(self, query, limit=None, offset=0, sessions=None):
+        """
+        Run a query ordered by question id on every shard, merging rows.
+
+        Each shard returns up to offset + limit rows, so deep pages cost
+        more than on a single database.
+
+        :param query: callable making the query of a session, ordered by
+            id, with rows having an id attribute
+        :param limit:
+        :param offset:
+        :param sessions: shards to query, all by default
+        :return: iterator of rows ordered by id
+        """
+        sessions = sessions or self.sessions()
+        queries = [query(session) for session in sessions]
+        if len(queries) == 1:
+            return self._skip_orphans(sessions[0], queries[0].limit(
+                limit).offset(offset or None))
+        offset = max(offset, 0)
+        if limit is not None:
+            limit = max(limit, 0)
+            queries = [query.limit(offset + limit) for query in queries]
+        rows = heapq.merge(*(
+            self._skip_orphans(session, query)
+            for session, query in zip(sessions, queries)),
+            key=lambda row: row.id)
+        return islice(rows, offset, None if limit is None else offset + limit)
+
+    def insert(self, question):
+        """
+        Insert question in the shard of its category.
+
+        :param question:
+        :return:
+        """
+        self._remove_orphans()
+        values = question.values()
+        shard = self.shard_of(values['category'])
+        entry = QuestionShard(shard=shard)
+        db.session.add(entry)
+        db.session.flush()
+        question.id = entry.id
+        session = self._sessions[shard]
+        session.add(question)
+        self._commit_shard(session)
+        count_question(db.session, None, values)
+        log_change(db.session, 'insert', question.id, values)
+        self._commit(lambda: self._remove_row(session, entry.id))
+
+    def update(self, question, previous):
+        """
+        Update question, moving it if its category is in another shard.
+
+        :param question: loaded through get
+        :param previous: committed values
+        :return:
+        """
+        self._remove_orphans()
+        values = question.values()
+        moved = self.shard_of(values['category']) != \
+            self.shard_of(previous['category'])
+        source = object_session(question)
+        target = self.session_for(values['category'])
+        if not moved:
+            self._commit_shard(source)
+        else:
+            # Insert the new row first, so the question is never missing.
+            source.expunge(question)
+            make_transient(question)
+            target.add(question)
+            self._commit_shard(target)
+            db.session.query(QuestionShard).filter(
+                QuestionShard.id == question.id).update(
+                {'shard': self.shard_of(values['category'])},
+                synchronize_session=False)
+        count_question(db.session, previous, values)
+        log_change(db.session, 'update', question.id, values)
+        if not moved:
+            self._commit()
+            return
+        self._commit(lambda: self._remove_row(target, question.id))
+        try:
+            self._remove_row(source, question.id)
+        except Exception:
+            source.rollback()
+            self._orphans.add(
+                (self.shard_of(previous['category']), question.id))
+            db.get_app().logger.exception(
+                f'Could not remove moved question {question.id} from its '
+                f'old shard, retrying before the next write')
+
+    def delete(self, question, previous):
+        """
+        Delete question from its shard.
+
+        :param question: loaded through get
+        :param previous: committed values
+        :return:
+        """
+        self._remove_orphans()
+        session = object_session(question)
+        row = dict(question.values(), id=question.id)
+        session.delete(question)
+        self._commit_shard(session)
+        db.session.query(QuestionShard).filter(
+            QuestionShard.id == previous['id']).delete(
+            synchronize_session=False)
+        count_question(db.session, previous, None)
+        log_change(db.session, 'delete', previous['id'])
+        self._commit(lambda: self._restore_row(session, row))
+
+    @staticmethod
+    def _commit_shard(session):
+        """
+        Commit a shard, rolling back the app database if it fails.
+
+        :param session:
+        :return:
+        """
+        try:
+            session.commit()
+        except Exception:
+            session.rollback()
+            db.session.rollback()
+            raise
+
+    @staticmethod
+    def _commit(undo=None):
+        """
+        Commit the app database after a shard, undoing the shard write if
+        it fails.
+
+        :param undo: callable undoing the shard write
+        :return:
+        """
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            if undo is not None:
+                try:
+                    undo()
+                except Exception:
+                    db.get_app().logger.exception(
+                        'Could not undo a shard write')
+            raise
+
+    @staticmethod
+    def _remove_row(session, question_id):
+        """
+        Delete a question row from a shard.
+
+        :param session:
+        :param question_id:
+        :return:
+        """
+        session.query(Question).filter(Question.id == question_id).delete(
+            synchronize_session=False)
+        session.commit()
+
+    @staticmethod
+    def _restore_row(session, values):
+        """
+        Insert a deleted question row in a shard again.
+
+        :param session:
+        :param values: column values, id included
+        :return:
+        """
+        try:
+            session.execute(Question.__table__.insert().values(**values))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    def _skip_orphans(self, session, rows):
+        """
+        Skip rows of a shard left behind by moves.
+
+        :param session:
+        :param rows:
+        :return: iterator of rows
+        """
+        orphans = {question_id for shard, question_id in list(self._orphans)
+                   if self._sessions[shard] is session}
+        if not orphans:
+            return iter(rows)
+        return (row for row in rows if row.id not in orphans)
+
+    def _remove_orphans(self):
+        """
+        Remove rows left behind by moves whose removal failed.
+
+        Runs on its own connection, so pending changes of the shard
+        sessions are not committed with it.
+
+        :return:
+        """
+        for shard, question_id in list(self._orphans):
+            try:
+                self._engines[shard].execute(Question.__table__.delete().where(
+                    Question.__table__.c.id == question_id))
+            except Exception:
+                continue
+            self._orphans.discard((shard, question_id))
+
+
+shard_router = ShardRouter(QUESTION_SHARDS)
@@ -1,15 +1,56 @@
 """Module for unit tests of trivia app."""
 
 import os
+import asyncio
+import importlib
+import gzip
 import pdb
+import tempfile
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
-
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import create_engine
+
+from benchmarks.replay import replay, read_log
+from benchmarks.stats import percentile, summarize, compare
+from fixtures import (
+    setup_database, reset_app_state, auth_header, TransactionFixture
+)
+from jose import jwt
+import flaskr
 from flaskr import app
-from models import setup_db, Question, Category, test_database_path
+from flaskr.audit import audit_log, AuditLog, DatabaseSink, JsonLinesSink
+from flaskr.background import PeriodicTask
+from flaskr.catalog import catalog, write_snapshot, CatalogSnapshot
+from flaskr.category_stats import category_stats
+from flaskr.dedupe import duplicate_index, find_clusters
+from flaskr.keys import key_provider, FileJWKS, LocalKeys, RemoteJWKS
+from flaskr.leaderboard import scoreboard
+from flaskr.metrics import metrics
+from flaskr.packs import pack_builder
+from flaskr.profiler import profiler
+from flaskr.question_index import question_index, QuestionIndex
+from flaskr.question_cache import question_cache, RedisInvalidator
+from flaskr.quiz import QuizEngine
+from flaskr.ratelimit import InProcessBackend, client_address
+from flaskr.rooms import rooms
+from flaskr.suggest import suggest_index
+from utils import LRUCache
+from models import (
+    db, Question, Category, CategoryStat, AuditEvent, Answer,
+    group_committer, log_change, shard_router
+)
+try:
+    import aiosqlite
+    from flaskr.asgi import TriviaASGI, Database
+except ImportError:
+    TriviaASGI = None
 from constants import (HTTP_STATUS, ERROR_MESSAGES, MISSING_AUTHORIZATION,
-                       INVALID_BEARER_TOKEN, INVALID_BEARER_TOKEN)
+                       INVALID_BEARER_TOKEN, INVALID_BEARER_TOKEN, RATE_LIMITS,
+                       ROOM_PLAYER_BACKLOG, PROFILE_MAX_SECONDS)
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -19,8 +60,10 @@ class TriviaTestCase(unittest.TestCase):
         """Define test variables and initialize app."""
         self.app = app
         self.client = self.app.test_client
-        self.database_path = test_database_path
-        setup_db(self.app, self.database_path)
+        setup_database(self.app)
+        self.transaction = TransactionFixture(self.app)
+        self.transaction.begin()
+        reset_app_state()
 
         self.test_category = 1
         self.test_question = {
@@ -40,30 +83,18 @@ class TriviaTestCase(unittest.TestCase):
             'previous_questions': []
         }
 
-        with open('./trivia_tokens.json') as json_file:
-            data = json.load(json_file)
-            self.admin_header = {
-                'Authorization': 'Bearer {}'.format(data.get('admin'))
-            }
-            self.user_header = {
-                'Authorization': 'Bearer {}'.format(data.get('user'))
-            }
+        self.admin_header = auth_header('admin')
+        self.user_header = auth_header('user')
 
         self.invalid_bearer_token = {
-            'Authorization': 'Bearer {} invalid'.format(data.get('member'))
+            'Authorization': '{} invalid'.format(
+                self.user_header['Authorization'])
         }
 
         self.without_token = {
             'Authorization': 'Bearer'
         }
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-
     def tearDown(self):
         """
         Executed after reach test.
@@ -71,7 +102,7 @@ class TriviaTestCase(unittest.TestCase):
         :param self:
         :return:
         """
-        pass
+        self.transaction.rollback()
 
     def test_get_categories_successfully(self):
         """
@@ -484,6 +515,97 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data.get('success'), False)
         self.assertEqual(data.get('message'), INVALID_BEARER_TOKEN)
 
+    def test_play_quiz_with_expired_token(self):
+        """
+        Test case to play quiz with an expired token.
+
+        :param self:
+        :return:
+        """
+        token = key_provider.mint(['play-quiz'], expires_in=-60)
+        response = self.client().post(
+            '/quizzes', json=self.quiz_data,
+            headers={'Authorization': f'Bearer {token}'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.UNAUTHORIZED)
+        self.assertEqual(data.get('message'), 'Token expired.')
+
+    def test_play_quiz_with_wrong_audience_token(self):
+        """
+        Test case to play quiz with a token minted for another API.
+
+        :param self:
+        :return:
+        """
+        claims = jwt.get_unverified_claims(key_provider.mint(['play-quiz']))
+        claims['aud'] = 'https://other-api'
+        token = jwt.encode(
+            claims, key_provider.key.exportKey('PEM').decode('ascii'),
+            algorithm='RS256', headers={'kid': key_provider.kid})
+        response = self.client().post(
+            '/quizzes', json=self.quiz_data,
+            headers={'Authorization': f'Bearer {token}'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.UNAUTHORIZED)
+        self.assertTrue(data.get('message').startswith('Incorrect claims.'))
+
+    def test_file_jwks_verifies_local_keys_tokens(self):
+        """
+        Test case to share a local key file and verify its tokens with the
+        JWKS it writes.
+
+        :param self:
+        :return:
+        """
+        directory = tempfile.mkdtemp()
+        key_path = os.path.join(directory, 'key.pem')
+        jwks_path = os.path.join(directory, 'jwks.json')
+        keys = LocalKeys(key_path)
+        keys.write_jwks(jwks_path)
+        provider = FileJWKS(jwks_path)
+        auth = importlib.import_module('flaskr.auth')
+        self.addCleanup(setattr, auth, 'key_provider', auth.key_provider)
+        auth.key_provider = provider
+
+        accepted = self.client().post(
+            '/quizzes', json=self.quiz_data, headers={
+                'Authorization': f'Bearer {keys.mint(["play-quiz"])}'})
+        forged = self.client().post(
+            '/quizzes', json=self.quiz_data, headers=self.user_header)
+
+        self.assertEqual(LocalKeys(key_path).jwks(), keys.jwks())
+        self.assertEqual(provider.get_key(keys.kid), keys.get_key(keys.kid))
+        self.assertIsNone(provider.get_key('unknown'))
+        self.assertEqual(accepted.status_code, HTTP_STATUS.OK)
+        self.assertEqual(forged.status_code, HTTP_STATUS.BAD_REQUEST)
+
+    def test_remote_jwks_refetches_keys_on_unknown_kid(self):
+        """
+        Test case to pick up rotated keys without waiting for the cache to
+        expire, at most once per min_refresh seconds.
+
+        :param self:
+        :return:
+        """
+        jwks_path = os.path.join(tempfile.mkdtemp(), 'jwks.json')
+        key_provider.write_jwks(jwks_path)
+        url = 'file://' + jwks_path
+        remote, throttled = RemoteJWKS(url, min_refresh=0), RemoteJWKS(url)
+        remote.get_key(key_provider.kid)
+        throttled.get_key(key_provider.kid)
+
+        jwks = key_provider.jwks()
+        jwks['keys'][0]['kid'] = 'rotated'
+        with open(jwks_path, 'w') as jwks_file:
+            json.dump(jwks, jwks_file)
+
+        self.assertEqual(remote.get_key('rotated'), jwks['keys'][0])
+        self.assertIsNone(remote.get_key(key_provider.kid))
+        self.assertIsNone(throttled.get_key('rotated'))
+        self.assertIsNotNone(throttled.get_key(key_provider.kid))
+
     def test_play_quiz_with_admin(self):
         """
         Test case to play quiz with admin token.
@@ -574,6 +696,1816 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(
             json_data.get('message'), ERROR_MESSAGES[HTTP_STATUS.FORBIDDEN])
 
+    def test_get_questions_compressed(self):
+        """
+        Test case to get questions with gzip compression.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get(
+            '/questions', headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(response.data))
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertIn('Accept-Encoding', response.headers.get('Vary'))
+        self.assertEqual(data.get('success'), True)
+        self.assertTrue(len(data.get('questions')))
+
+    def test_get_questions_without_accept_encoding(self):
+        """
+        Test case to get questions uncompressed when not accepted.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get(
+            '/questions', headers={'Accept-Encoding': 'gzip;q=0'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+        self.assertEqual(data.get('success'), True)
+
+    def test_get_questions_with_fields(self):
+        """
+        Test case to get questions with sparse fieldset.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get('/questions?fields=id,question')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('success'), True)
+        self.assertTrue(len(data.get('questions')))
+        for question in data.get('questions'):
+            self.assertEqual(set(question), {'id', 'question'})
+        self.assertNotIn('categories', data)
+
+    def test_get_questions_with_fields_and_categories(self):
+        """
+        Test case to get questions with sparse fieldset and categories.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get(
+            '/questions?fields=id&include=categories')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(set(data.get('questions')[0]), {'id'})
+        self.assertTrue(len(data.get('categories')))
+
+    def test_get_questions_with_invalid_fields(self):
+        """
+        Test case to get questions with unknown field.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get('/questions?fields=id,password')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+        self.assertEqual(data.get('success'), False)
+        self.assertEqual(
+            data.get('message'),
+            ERROR_MESSAGES[HTTP_STATUS.BAD_REQUEST]
+        )
+
+    def test_search_question_rate_limited(self):
+        """
+        Test case to search questions beyond the rate limit.
+
+        :param self:
+        :return:
+        """
+        rate, burst, concurrency = RATE_LIMITS['search_questions']
+        search = {'searchTerm': 'no question matches this'}
+        for _ in range(burst):
+            self.client().post('/questions/search', json=search)
+
+        response = self.client().post('/questions/search', json=search)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.TOO_MANY_REQUESTS)
+        self.assertTrue(response.headers.get('Retry-After'))
+        self.assertEqual(data.get('success'), False)
+        self.assertEqual(
+            data.get('message'),
+            ERROR_MESSAGES[HTTP_STATUS.TOO_MANY_REQUESTS]
+        )
+
+    def test_search_rate_limit_ignores_forwarded_for(self):
+        """
+        Test case to keep limiting clients sending their own X-Forwarded-For.
+
+        :param self:
+        :return:
+        """
+        rate, burst, concurrency = RATE_LIMITS['search_questions']
+        search = {'searchTerm': 'no question matches this'}
+        statuses = [self.client().post(
+            '/questions/search', json=search,
+            headers={'X-Forwarded-For': f'10.0.0.{attempt}'}).status_code
+            for attempt in range(burst + 1)]
+
+        self.assertEqual(statuses[-1], HTTP_STATUS.TOO_MANY_REQUESTS)
+        self.assertEqual(client_address('10.1.0.1', '1.2.3.4, 10.0.0.9', 1),
+                         '10.0.0.9')
+        self.assertEqual(client_address('10.1.0.1', '1.2.3.4, 10.0.0.9', 0),
+                         '10.1.0.1')
+        self.assertEqual(client_address('10.1.0.1', '1.2.3.4', 2),
+                         '10.1.0.1')
+
+    def test_rate_limit_buckets_are_bounded(self):
+        """
+        Test case to drop least recently used and full token buckets.
+
+        :param self:
+        :return:
+        """
+        backend = InProcessBackend()
+        backend.MAX_KEYS = 2
+        for key in ('a', 'b', 'c'):
+            backend.consume(key, 1, 5)
+        self.assertEqual(list(backend._buckets), ['b', 'c'])
+
+        backend.consume('b', 1, 5)
+        backend.consume('d', 1, 5)
+        self.assertEqual(list(backend._buckets), ['b', 'd'])
+
+        backend = InProcessBackend()
+        backend.consume('e', 1000, 1)
+        time.sleep(0.01)
+        backend.consume('f', 1000, 1)
+        self.assertEqual(list(backend._buckets), ['f'])
+
+    def test_get_metrics_successfully(self):
+        """
+        Test case to get metrics of coalesced reads.
+
+        :param self:
+        :return:
+        """
+        self.client().get('/categories')
+        response = self.client().get('/metrics')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('success'), True)
+        self.assertTrue(data.get('pid'))
+        self.assertTrue(
+            data.get('metrics').get('coalesce.get_categories.leader'))
+
+    def test_coalesce_identical_concurrent_reads(self):
+        """
+        Test case to serve identical concurrent reads from one computation.
+
+        :param self:
+        :return:
+        """
+        started, release = threading.Event(), threading.Event()
+        calls = []
+        formatted_categories = flaskr.get_formatted_categories
+
+        def slow_categories():
+            calls.append(threading.get_ident())
+            started.set()
+            release.wait(5)
+            return formatted_categories()
+
+        self.addCleanup(setattr, flaskr, 'get_formatted_categories',
+                        formatted_categories)
+        flaskr.get_formatted_categories = slow_categories
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(
+            self.client().get('/categories'))) for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # Let the other requests reach the in-flight call.
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        counters = metrics.counters()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(counters.get('coalesce.get_categories.leader'), 1)
+        self.assertEqual(counters.get('coalesce.get_categories.shared'), 3)
+        self.assertEqual(
+            {(response.status_code, response.data) for response in responses},
+            {(HTTP_STATUS.OK, responses[0].data)})
+
+    def test_create_room_successfully(self):
+        """
+        Test case to create quiz room successfully.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post(
+            '/rooms', json=self.quiz_data, headers=self.admin_header)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+        self.assertEqual(data.get('success'), True)
+        self.assertTrue(data.get('room').get('id'))
+
+    def test_create_room_without_auth_header(self):
+        """
+        Test case to create quiz room without auth.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post('/rooms', json=self.quiz_data)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.UNAUTHORIZED)
+        self.assertEqual(data.get('success'), False)
+        self.assertEqual(data.get('message'), MISSING_AUTHORIZATION)
+
+    def test_create_room_with_invalid_user(self):
+        """
+        Test case to create quiz room with player token.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post(
+            '/rooms', json=self.quiz_data, headers=self.user_header)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.FORBIDDEN)
+        self.assertEqual(data.get('success'), False)
+
+    def test_room_pushes_question_to_players(self):
+        """
+        Test case to push drawn room question to joined players.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post(
+            '/rooms', json=self.quiz_data, headers=self.admin_header)
+        room_id = json.loads(response.data).get('room').get('id')
+        events = self.client().get(
+            f'/rooms/{room_id}/events', headers=self.user_header,
+            buffered=False)
+
+        response = self.client().post(
+            f'/rooms/{room_id}/questions', headers=self.admin_header)
+        data = json.loads(response.data)
+        stream = iter(events.response)
+        next(stream)
+        event = next(stream).decode()
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('players'), 1)
+        self.assertTrue(event.startswith('event: question\n'))
+        self.assertEqual(
+            json.loads(event.split('data: ', 1)[1]), data.get('question'))
+        events.close()
+
+    def test_room_drops_slow_players(self):
+        """
+        Test case to end the stream of a player too slow to keep up.
+
+        :param self:
+        :return:
+        """
+        room = rooms.create('test|host', 1)
+        self.addCleanup(rooms.close, room)
+        slow, fast = room.join(), room.join()
+        stream = room.stream(slow)
+        next(stream)
+        for number in range(ROOM_PLAYER_BACKLOG + 1):
+            room.publish('question', {'id': number})
+            fast.get_nowait()
+
+        self.assertEqual(room.players, 1)
+        self.assertTrue(next(stream).startswith('event: dropped\n'))
+        self.assertRaises(StopIteration, next, stream)
+
+    def test_idle_rooms_expire(self):
+        """
+        Test case to close rooms left idle by their host.
+
+        :param self:
+        :return:
+        """
+        idle = rooms.create('test|host', 1)
+        active = rooms.create('test|host', 1)
+        self.addCleanup(rooms.close, active)
+        idle.last_active -= 60
+        player = idle.join()
+        idle.last_active -= 60
+
+        self.assertEqual(rooms.expire(30), 1)
+        self.assertTrue(idle.closed)
+        self.assertIsNone(rooms.get(idle.id))
+        self.assertTrue(player.get_nowait().startswith('event: closed\n'))
+        self.assertIs(rooms.get(active.id), active)
+
+    def test_next_room_question_with_invalid_room(self):
+        """
+        Test case to draw question of unknown room.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post(
+            '/rooms/unknown/questions', headers=self.admin_header)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.NOT_FOUND)
+        self.assertEqual(data.get('success'), False)
+
+    def test_submit_answer_successfully(self):
+        """
+        Test case to submit answer of a question successfully.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post(
+            '/questions', json=self.test_question, headers=self.admin_header)
+        question_id = json.loads(response.data).get('id')
+
+        response = self.client().post(
+            '/answers', headers=self.user_header,
+            json={'question_id': question_id, 'answer': ' testa '})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+        self.assertEqual(data.get('success'), True)
+        self.assertEqual(data.get('correct'), True)
+        self.assertEqual(data.get('answer'), self.test_question['answer'])
+
+    def test_submit_answer_scores_first_answer_only(self):
+        """
+        Test case to score only the first answer of a user to a question.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post(
+            '/questions', json=self.test_question, headers=self.admin_header)
+        question_id = json.loads(response.data).get('id')
+
+        wrong = self.client().post(
+            '/answers', headers=self.user_header,
+            json={'question_id': question_id, 'answer': 'wrong'})
+        retry = self.client().post(
+            '/answers', headers=self.user_header,
+            json={'question_id': question_id, 'answer': 'TestA'})
+        scoreboard.flush()
+        data = json.loads(wrong.data)
+
+        self.assertEqual(wrong.status_code, HTTP_STATUS.CREATED)
+        self.assertEqual(data.get('correct'), False)
+        self.assertNotIn('answer', data)
+        self.assertEqual(retry.status_code, HTTP_STATUS.CONFLICT)
+        self.assertEqual(Answer.query.filter_by(
+            question_id=question_id).count(), 1)
+        self.assertEqual(scoreboard.top(10, self.test_category), [])
+
+    def test_scoreboard_skips_answers_written_by_other_workers(self):
+        """
+        Test case to score nothing for an answer another worker wrote first.
+
+        :param self:
+        :return:
+        """
+        question = Question(**self.test_question)
+        question.insert()
+        scoreboard.record('test|player', question, True)
+        db.session.add(Answer(
+            user='test|player', question_id=question.id,
+            category=question.category, correct=False))
+        db.session.commit()
+
+        scoreboard.flush()
+
+        self.assertEqual(Answer.query.filter_by(
+            question_id=question.id).count(), 1)
+        self.assertEqual(scoreboard.top(10, self.test_category), [])
+        self.assertEqual(metrics.counters().get('answers.duplicates'), 1)
+
+    def test_submit_answer_with_invalid_question_id(self):
+        """
+        Test case to submit answer with a question id that is not an integer.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post(
+            '/answers', headers=self.user_header,
+            json={'question_id': '1; DROP', 'answer': 'TestA'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+        self.assertEqual(data.get('success'), False)
+
+    def test_submit_answer_without_auth_header(self):
+        """
+        Test case to submit answer without auth.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post(
+            '/answers', json={'question_id': 1, 'answer': 'TestA'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.UNAUTHORIZED)
+        self.assertEqual(data.get('success'), False)
+        self.assertEqual(data.get('message'), MISSING_AUTHORIZATION)
+
+    def test_get_leaderboard_successfully(self):
+        """
+        Test case to get overall leaderboard.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get('/leaderboard?limit=5')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('success'), True)
+        self.assertLessEqual(len(data.get('leaderboard')), 5)
+
+    def test_get_category_leaderboard_with_invalid_category(self):
+        """
+        Test case to get leaderboard of unknown category.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get('/categories/1000/leaderboard')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.NOT_FOUND)
+        self.assertEqual(data.get('success'), False)
+
+    def test_question_index_tracks_question_changes(self):
+        """
+        Test case to keep question index current on insert/update/delete.
+
+        :param self:
+        :return:
+        """
+        with self.app.app_context():
+            question_index.ensure_built()
+            count = question_index.count(self.test_category)
+            question = Question(**self.test_question)
+            question.insert()
+            self.assertEqual(
+                question_index.count(self.test_category), count + 1)
+            self.assertIn(question.id, question_index.ids(
+                self.test_category, self.test_question['difficulty']))
+
+            question.difficulty = 2
+            question.update()
+            self.assertNotIn(question.id, question_index.ids(
+                self.test_category, self.test_question['difficulty']))
+            self.assertIn(
+                question.id, question_index.ids(self.test_category, 2))
+
+            question.delete()
+            self.assertEqual(question_index.count(self.test_category), count)
+            self.assertTrue(question_index.verify())
+
+    def test_play_quiz_with_difficulty(self):
+        """
+        Test case to play quiz restricted to a difficulty.
+
+        :param self:
+        :return:
+        """
+        quiz_data = dict(self.quiz_data, difficulty=[1, 4])
+        response = self.client().post(
+            '/quizzes', json=quiz_data, headers=self.user_header)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('success'), True)
+        self.assertIn(data.get('question').get('difficulty'), [1, 4])
+
+    def test_play_quiz_with_invalid_weights(self):
+        """
+        Test case to play quiz with negative difficulty weights.
+
+        :param self:
+        :return:
+        """
+        quiz_data = dict(self.quiz_data, weights={'1': -1})
+        response = self.client().post(
+            '/quizzes', json=quiz_data, headers=self.user_header)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+        self.assertEqual(data.get('success'), False)
+
+    def quiz_engine_for(self, difficulties):
+        """
+        Get quiz engine on an index of ten questions per difficulty.
+
+        :param difficulties:
+        :return: engine, and difficulty of each question id
+        """
+        index = QuestionIndex()
+        index.built = True
+        levels = {}
+        for difficulty in difficulties:
+            for _ in range(10):
+                levels[len(levels) + 1] = difficulty
+                index.add(len(levels), 5, difficulty)
+        return QuizEngine(index), levels
+
+    def test_quiz_weights_skew_draws(self):
+        """
+        Test case to draw difficulties in proportion to their weights.
+
+        :param self:
+        :return:
+        """
+        engine, levels = self.quiz_engine_for((1, 2))
+
+        draws = [levels[engine.draw(5, weights={1: 1, 2: 9})]
+                 for _ in range(1000)]
+        self.assertGreater(draws.count(2), 800)
+        self.assertEqual({levels[engine.draw(5, weights={1: 0, 2: 1})]
+                          for _ in range(100)}, {2})
+
+    def test_quiz_adaptive_difficulty(self):
+        """
+        Test case to move difficulty up after correct answers and down
+        after wrong ones.
+
+        :param self:
+        :return:
+        """
+        engine, levels = self.quiz_engine_for((1, 2, 3))
+
+        for answers, expected in (
+                ([], 1), ([True], 2), ([True, True], 3),
+                ([True, True, True], 3), ([True, True, False], 2),
+                ([True, False, False], 1), ([False], 1)):
+            self.assertEqual(
+                levels[engine.draw(5, answers=answers)], expected, answers)
+        self.assertEqual(
+            levels[engine.draw(5, answers=[True], difficulties={1, 3})], 3)
+
+    def test_play_quiz_with_boolean_difficulty(self):
+        """
+        Test case to reject booleans as difficulties.
+
+        :param self:
+        :return:
+        """
+        quiz_data = dict(self.quiz_data, difficulty=True)
+        response = self.client().post(
+            '/quizzes', json=quiz_data, headers=self.user_header)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+
+    def test_play_quiz_with_invalid_previous_questions(self):
+        """
+        Test case to play quiz with non-integer previous questions.
+
+        :param self:
+        :return:
+        """
+        quiz_data = dict(self.quiz_data, previous_questions=['x'])
+        response = self.client().post(
+            '/quizzes', json=quiz_data, headers=self.user_header)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+        self.assertEqual(data.get('success'), False)
+
+        quiz_data = dict(self.quiz_data, previous_questions=None)
+        response = self.client().post(
+            '/quizzes', json=quiz_data, headers=self.user_header)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+
+    def test_question_index_appends_in_place(self):
+        """
+        Test case to add questions without copying buckets and to forget
+        difficulties whose last question is removed.
+
+        :param self:
+        :return:
+        """
+        index = QuestionIndex()
+        index.add(1, 5, 2)
+        everything = index.ids()
+        index.add(2, 5, 3)
+        index.add(3, 5, 3)
+
+        self.assertIs(index.ids(), everything)
+        self.assertEqual(list(everything), [1, 2, 3])
+        self.assertEqual(index.difficulties(5), (2, 3))
+
+        index.remove(2, 5, 3)
+        self.assertEqual(index.difficulties(5), (2, 3))
+        self.assertEqual(list(everything), [1, 2, 3])
+        index.remove(3, 5, 3)
+        self.assertEqual(index.difficulties(5), (2,))
+        self.assertEqual(index.difficulties(), (2,))
+        self.assertEqual(list(index.ids()), [1])
+
+    def test_periodic_task_runs_on_stop_only_if_asked(self):
+        """
+        Test case to run a background task on stop only with run_on_stop.
+
+        :param self:
+        :return:
+        """
+        runs = []
+        for run_on_stop in (False, True):
+            task = PeriodicTask(
+                self.app, 'test', 3600, lambda: runs.append(run_on_stop),
+                run_on_stop=run_on_stop)
+            task.ensure_started()
+            task.stop()
+
+        self.assertEqual(runs, [True])
+        self.assertTrue(flaskr.scoreboard_flush.run_on_stop)
+        self.assertTrue(flaskr.catalog_sync.run_on_stop)
+        self.assertFalse(flaskr.question_index_check.run_on_stop)
+
+    def test_question_cache_counts_concurrent_lookups(self):
+        """
+        Test case to count every lookup of concurrent request threads.
+
+        :param self:
+        :return:
+        """
+        with self.app.app_context():
+            question = Question.query.first()
+            question_cache.put(question)
+        hits = question_cache.hits
+
+        def lookup():
+            for _ in range(1000):
+                question_cache.get(question.id)
+
+        threads = [threading.Thread(target=lookup) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(question_cache.hits - hits, 4000)
+
+    def test_question_cache_listener_survives_failures(self):
+        """
+        Test case to resubscribe after a lost redis connection, clearing
+        the cache, and to ignore malformed eviction messages.
+
+        :param self:
+        :return:
+        """
+        class Stop(BaseException):
+            pass
+
+        class PubSub:
+            def __init__(self, messages):
+                self.messages = messages
+
+            def subscribe(self, channel):
+                if self.messages is None:
+                    raise ConnectionError('redis is down')
+
+            def listen(self):
+                for data in self.messages:
+                    yield {'data': data}
+                raise Stop
+
+        subscriptions = [
+            PubSub(None), PubSub([b'\xff', b'garbage', b'worker:1 987654'])]
+        client = type('Client', (), {
+            'pubsub': lambda self, **kwargs: subscriptions.pop(0)})()
+        invalidator = RedisInvalidator.__new__(RedisInvalidator)
+        invalidator.client = client
+        invalidator.cache = LRUCache(10)
+        invalidator.cache.set(987653, 'stale')
+        sleeps = []
+        module = importlib.import_module('flaskr.question_cache')
+        self.addCleanup(setattr, module, 'time', module.time)
+        module.time = type('Time', (), {'sleep': staticmethod(sleeps.append)})
+
+        self.assertRaises(Stop, invalidator._listen)
+        counters = metrics.counters()
+
+        self.assertEqual(sleeps, [1])
+        self.assertIsNone(invalidator.cache.get(987653))
+        self.assertEqual(counters.get('question_cache.listener_errors'), 1)
+        self.assertEqual(counters.get('question_cache.bad_messages'), 2)
+        self.assertEqual(counters.get('question_cache.remote_evictions'), 1)
+
+    def test_get_question_successfully(self):
+        """
+        Test case to get a single question.
+
+        :param self:
+        :return:
+        """
+        with self.app.app_context():
+            question = Question(**self.test_question)
+            question.insert()
+            question_id = question.id
+
+        response = self.client().get(f'/questions/{question_id}')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('success'), True)
+        self.assertEqual(data.get('question').get('id'), question_id)
+        self.assertEqual(
+            data.get('question').get('question'),
+            self.test_question['question'])
+
+        with self.app.app_context():
+            Question.query.get(question_id).delete()
+        response = self.client().get(f'/questions/{question_id}')
+
+        self.assertEqual(response.status_code, HTTP_STATUS.NOT_FOUND)
+
+    def test_suggest_questions_successfully(self):
+        """
+        Test case to suggest questions by prefix of their words.
+
+        :param self:
+        :return:
+        """
+        self.client().get('/questions/suggest?q=warmup')
+        with self.app.app_context():
+            question = Question(**dict(
+                self.test_question, question='Which xylophonist plays?'))
+            question.insert()
+            question_id = question.id
+
+        response = self.client().get('/questions/suggest?q=which+xyloph')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('success'), True)
+        self.assertIn(
+            {'id': question_id, 'snippet': 'Which xylophonist plays?'},
+            data.get('questions'))
+
+        with self.app.app_context():
+            Question.query.get(question_id).delete()
+        response = self.client().get('/questions/suggest?q=xyloph')
+        data = json.loads(response.data)
+
+        self.assertEqual(data.get('questions'), [])
+
+    def test_suggest_questions_without_query(self):
+        """
+        Test case to suggest questions without a query.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get('/questions/suggest')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+        self.assertEqual(data.get('success'), False)
+
+    def test_group_commit_writes_questions(self):
+        """
+        Test case to add, edit and delete questions with group commit.
+
+        :param self:
+        :return:
+        """
+        group_committer.enabled = True
+        self.addCleanup(setattr, group_committer, 'enabled', False)
+        with self.app.app_context():
+            question_index.ensure_built()
+            category_stats.ensure_loaded()
+
+        response = self.client().post(
+            '/questions', json=self.test_question, headers=self.admin_header)
+        question_id = json.loads(response.data).get('id')
+        self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+
+        response = self.client().patch(
+            f'/questions/{question_id}', json=self.test_edit_question,
+            headers=self.admin_header)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+        self.assertEqual(data.get('question'), dict(
+            self.test_edit_question, id=question_id))
+        self.assertIn(question_id, question_index.ids(
+            self.test_category, self.test_edit_question['difficulty']))
+
+        response = self.client().delete(
+            f'/questions/{question_id}', headers=self.admin_header)
+        self.assertEqual(response.status_code, HTTP_STATUS.NO_CONTENT)
+        with self.app.app_context():
+            self.assertIsNone(Question.query.get(question_id))
+
+        data = json.loads(self.client().get('/questions/changes').data)
+        self.assertEqual(
+            [change['action'] for change in data.get('changes')],
+            ['insert', 'update', 'delete'])
+        self.assertEqual(self.category_stats_rows(), self.count_questions())
+
+    def test_group_commit_isolates_failing_writes(self):
+        """
+        Test case to commit a group of writes when one of them fails.
+
+        :param self:
+        :return:
+        """
+        def insert(session):
+            return Question._apply(session, None, self.test_question)
+
+        def fail(session):
+            Question._apply(session, None, dict(
+                self.test_question, question='FailedQ'))
+            raise ValueError('failed write')
+
+        group = [(operation, Future()) for operation in (insert, fail, insert)]
+        with self.app.app_context():
+            group_committer.commit(group)
+            first, failed, last = (future for _, future in group)
+
+            self.assertIsInstance(failed.exception(), ValueError)
+            self.assertIsNotNone(Question.query.get(first.result()))
+            self.assertIsNotNone(Question.query.get(last.result()))
+            self.assertIsNone(
+                Question.query.filter_by(question='FailedQ').first())
+
+    def test_catalog_snapshot_matches_database(self):
+        """
+        Test case to read questions and categories of a catalog snapshot.
+
+        :param self:
+        :return:
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'catalog')
+        with self.app.app_context():
+            write_snapshot(path)
+            snapshot = CatalogSnapshot(path)
+            questions = Question.query.order_by(Question.id).all()
+
+            self.assertEqual(len(snapshot), len(questions))
+            for question in questions:
+                self.assertEqual(
+                    snapshot.question(question.id), question.format())
+            self.assertEqual(list(snapshot.rows()), [
+                (question.id, question.category, question.difficulty)
+                for question in questions])
+            self.assertEqual(snapshot.categories(), {
+                category.id: category.type
+                for category in Category.query.all()})
+            self.assertIsNone(snapshot.question(questions[-1].id + 1))
+
+    def test_catalog_swaps_to_new_snapshot(self):
+        """
+        Test case to serve questions from the snapshot until they change.
+
+        :param self:
+        :return:
+        """
+        catalog.path = os.path.join(tempfile.mkdtemp(), 'catalog')
+        self.addCleanup(setattr, catalog, 'path', None)
+        self.addCleanup(setattr, catalog, 'snapshot', None)
+        with self.app.app_context():
+            catalog.load()
+            suggest_index.build(catalog.snapshot)
+            question = Question.query.first()
+            question_id = question.id
+            word = max(question.question.split(), key=len).strip('?')
+        version = catalog.snapshot.version
+        self.assertIn(question_id, dict(
+            suggest_index.search_questions(word, 100)))
+
+        response = self.client().get(f'/questions/{question_id}')
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(metrics.counters().get('catalog.hits'), 1)
+
+        response = self.client().patch(
+            f'/questions/{question_id}', json=self.test_edit_question,
+            headers=self.admin_header)
+        self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+        self.assertIsNone(catalog.question(question_id))
+        self.assertNotIn(question_id, dict(
+            suggest_index.search_questions(word, 100)))
+        self.assertIn(question_id, dict(
+            suggest_index.search_questions('testq1', 100)))
+
+        with self.app.app_context():
+            catalog.sync()
+        self.assertGreaterEqual(catalog.snapshot.version, version)
+        self.assertEqual(catalog.question(question_id), dict(
+            self.test_edit_question, id=question_id))
+
+    def test_catalog_bypasses_changes_of_other_workers(self):
+        """
+        Test case to stop serving questions from the snapshot once another
+        worker changed them.
+
+        :param self:
+        :return:
+        """
+        catalog.path = os.path.join(tempfile.mkdtemp(), 'catalog')
+        self.addCleanup(setattr, catalog, 'path', None)
+        self.addCleanup(setattr, catalog, 'snapshot', None)
+        self.addCleanup(setattr, catalog, '_remote', {})
+        with self.app.app_context():
+            catalog.load()
+            first, second = [question_id for (question_id,) in
+                             db.session.query(Question.id).order_by(
+                                 Question.id).limit(2)]
+            # Written by another worker, which does not notify this one.
+            db.session.execute(Question.__table__.update().where(
+                Question.id == first).values(answer='changed'))
+            log_change(db.session, 'update', first)
+            db.session.commit()
+        self.assertIsNotNone(catalog.question(first))
+
+        with self.app.app_context():
+            catalog.sync()
+        self.assertIsNone(catalog.question(first))
+
+        catalog.mark_changed(second)
+        self.assertIsNone(catalog.question(second))
+
+        with self.app.app_context():
+            catalog.publish()
+            catalog.read_changes()
+        self.assertEqual(catalog.question(first)['answer'], 'changed')
+        self.assertIsNotNone(catalog.question(second))
+
+    def test_get_question_changes_successfully(self):
+        """
+        Test case to sync question changes page by page, with tombstones.
+
+        :param self:
+        :return:
+        """
+        response = self.client().post(
+            '/questions', json=self.test_question, headers=self.admin_header)
+        question_id = json.loads(response.data).get('id')
+        self.client().patch(
+            f'/questions/{question_id}', json=self.test_edit_question,
+            headers=self.admin_header)
+        self.client().delete(
+            f'/questions/{question_id}', headers=self.admin_header)
+
+        response = self.client().get('/questions/changes?since=0&limit=2')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('success'), True)
+        self.assertEqual(data.get('has_more'), True)
+        self.assertEqual(
+            [change['action'] for change in data.get('changes')],
+            ['insert', 'update'])
+        self.assertEqual(data.get('changes')[1].get('question'), dict(
+            self.test_edit_question, id=question_id))
+
+        response = self.client().get(
+            f"/questions/changes?since={data.get('next_since')}")
+        data = json.loads(response.data)
+
+        self.assertEqual(data.get('has_more'), False)
+        self.assertEqual(data.get('changes'), [{
+            'sequence': data.get('next_since'),
+            'action': 'delete',
+            'id': question_id,
+            'question': None
+        }])
+
+    def test_get_question_changes_with_invalid_since(self):
+        """
+        Test case to sync question changes from an invalid sequence.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get('/questions/changes?since=-1')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+        self.assertEqual(data.get('success'), False)
+
+    def test_build_quiz_packs_incrementally(self):
+        """
+        Test case to build quiz packs and rebuild only changed ones.
+
+        :param self:
+        :return:
+        """
+        pack_builder.directory = tempfile.mkdtemp()
+        self.addCleanup(setattr, pack_builder, 'directory', None)
+        with self.app.app_context():
+            categories = Category.query.count()
+            self.assertEqual(len(pack_builder.build()), categories + 1)
+            self.assertEqual(pack_builder.build(), [])
+            manifest = pack_builder.manifest()
+
+        pack = manifest['packs'][f'category-{self.test_category}']
+        response = self.client().get(
+            f"/packs/{pack['file']}", headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(response.data))
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(len(data.get('questions')), pack['questions'])
+        self.assertTrue(all(
+            question['category'] == self.test_category
+            for question in data.get('questions')))
+
+        self.client().post(
+            '/questions', json=self.test_question, headers=self.admin_header)
+        with self.app.app_context():
+            self.assertEqual(pack_builder.build(), [
+                'all', f'category-{self.test_category}'])
+        updated = pack_builder.manifest()
+        self.assertEqual(updated['version'], manifest['version'] + 1)
+        self.assertEqual(
+            updated['packs'][f'category-{self.test_category}']['questions'],
+            pack['questions'] + 1)
+
+        response = self.client().get('/packs/manifest.json')
+        self.assertEqual(json.loads(response.data), updated)
+        response = self.client().get('/packs/category-1.json')
+        self.assertEqual(response.status_code, HTTP_STATUS.NOT_FOUND)
+
+    def busy_request(self, label, stop):
+        """
+        Serve a fake request encoding JSON until stop is set.
+
+        :param label:
+        :param stop:
+        :return:
+        """
+        payload = [self.test_question] * 100
+        profiler.begin_request(label)
+        try:
+            while not stop.is_set():
+                json.dumps(payload, indent=1)
+        finally:
+            profiler.end_request()
+
+    def test_profile_worker_successfully(self):
+        """
+        Test case to profile the requests served by the worker.
+
+        :param self:
+        :return:
+        """
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self.busy_request, args=('GET busy', stop))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+
+        response = self.client().get(
+            '/admin/profile?seconds=0.3', headers=self.admin_header)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('success'), True)
+        self.assertGreater(data['groups']['json']['samples'], 0)
+        self.assertTrue(data['stacks'][0]['stack'].startswith('GET busy;'))
+        self.assertNotIn('warning', data)
+
+        response = self.client().get(
+            '/admin/profile?seconds=0.1&format=collapsed',
+            headers=self.admin_header)
+        lines = response.data.decode('utf-8').splitlines()
+
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertTrue(lines)
+        self.assertTrue(all(
+            line.startswith('GET busy;') and line.rsplit(' ', 1)[1].isdigit()
+            for line in lines))
+
+    def test_profile_worker_without_other_requests(self):
+        """
+        Test case to warn that no request was sampled, as on a worker
+        running a single thread.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get(
+            '/admin/profile?seconds=0.1', headers=self.admin_header)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('samples'), 0)
+        self.assertIn('single thread', data.get('warning'))
+
+        response = self.client().get(
+            '/admin/profile?seconds=0.1&format=collapsed',
+            headers=self.admin_header)
+        self.assertIn('single thread', response.headers.get('Warning'))
+
+    def test_profile_worker_with_invalid_user(self):
+        """
+        Test case to profile the worker without the permission.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get(
+            '/admin/profile?seconds=0.1', headers=self.user_header)
+        self.assertEqual(response.status_code, HTTP_STATUS.FORBIDDEN)
+
+        response = self.client().get(
+            '/admin/profile?seconds=0', headers=self.admin_header)
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+
+        response = self.client().get(
+            f'/admin/profile?seconds={PROFILE_MAX_SECONDS + 1}',
+            headers=self.admin_header)
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+
+    def test_profiler_keeps_slow_requests(self):
+        """
+        Test case to keep samples of requests slower than the threshold.
+
+        :param self:
+        :return:
+        """
+        self.addCleanup(setattr, profiler, 'slow_seconds', None)
+        profiler.slow_seconds = 0.1
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self.busy_request, args=('GET slow', stop))
+        thread.start()
+        time.sleep(0.3)
+        stop.set()
+        thread.join()
+
+        response = self.client().get(
+            '/admin/profile/slow', headers=self.admin_header)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(list(data['routes']), ['GET slow'])
+        self.assertEqual(data['routes']['GET slow']['requests'], 1)
+        self.assertGreater(
+            data['routes']['GET slow']['groups']['json']['samples'], 0)
+
+    def test_audit_question_writes(self):
+        """
+        Test case to audit question writes with the user who made them.
+
+        :param self:
+        :return:
+        """
+        self.addCleanup(setattr, audit_log, 'sink', audit_log.sink)
+        audit_log.sink = DatabaseSink()
+
+        response = self.client().post(
+            '/questions', json=self.test_question, headers=self.admin_header)
+        question_id = json.loads(response.data).get('id')
+        self.client().patch(
+            f'/questions/{question_id}', json=self.test_edit_question,
+            headers=self.admin_header)
+        self.client().delete(
+            f'/questions/{question_id}', headers=self.admin_header)
+        audit_log.flush()
+
+        with self.app.app_context():
+            events = [event.format() for event in AuditEvent.query.filter_by(
+                question_id=question_id).order_by(AuditEvent.id)]
+
+        self.assertEqual([event['action'] for event in events],
+                         ['insert', 'update', 'delete'])
+        self.assertTrue(all(
+            event['user'] == 'test|admin' for event in events))
+        self.assertEqual(events[0]['before'], None)
+        self.assertEqual(events[0]['after']['question'], 'TestQ')
+        self.assertEqual(events[1]['before']['question'], 'TestQ')
+        self.assertEqual(events[1]['after']['question'], 'TestQ1')
+        self.assertEqual(events[2]['before']['question'], 'TestQ1')
+        self.assertEqual(events[2]['after'], None)
+
+    def test_audit_log_drops_events_when_full(self):
+        """
+        Test case to drop audit events instead of blocking when full.
+
+        :param self:
+        :return:
+        """
+        writing, release = threading.Event(), threading.Event()
+
+        class BlockingSink(JsonLinesSink):
+            def write(self, events):
+                writing.set()
+                release.wait()
+                super().write(events)
+
+        path = os.path.join(tempfile.mkdtemp(), 'audit.jsonl')
+        log = AuditLog(BlockingSink(path), capacity=1, batch_size=1,
+                       window=0)
+        token = {'sub': 'test|admin'}
+
+        self.assertTrue(log.record(token, 'delete', 1))
+        writing.wait(5)
+        self.assertTrue(log.record(token, 'delete', 2))
+        self.assertFalse(log.record(token, 'delete', 3))
+        self.assertEqual(metrics.counters().get('audit.dropped'), 1)
+        self.assertEqual(log.high_water, 1)
+
+        release.set()
+        log.stop()
+        with open(path) as audit_file:
+            events = [json.loads(line) for line in audit_file]
+        self.assertEqual([event['question_id'] for event in events], [1, 2])
+        self.assertEqual(log.mean_batch_size(), 1)
+
+    def count_questions(self):
+        """
+        Count questions per category and difficulty.
+
+        :param self:
+        :return:
+        """
+        with self.app.app_context():
+            counts = {}
+            for question in Question.query:
+                key = (question.category, question.difficulty or 0)
+                counts[key] = counts.get(key, 0) + 1
+            return counts
+
+    def category_stats_rows(self):
+        """
+        Get counts of the category_stats table.
+
+        :param self:
+        :return:
+        """
+        with self.app.app_context():
+            return {(row.category, row.difficulty): row.questions
+                    for row in CategoryStat.query if row.questions}
+
+    def test_get_category_stats_successfully(self):
+        """
+        Test case to get question counts and difficulties per category.
+
+        :param self:
+        :return:
+        """
+        expected = self.count_questions()
+        response = self.client().get('/categories/stats')
+        data = json.loads(response.data)
+        stats = {category['id']: category for category in data['categories']}
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(data.get('success'), True)
+        self.assertEqual(data.get('total_questions'), sum(expected.values()))
+        self.assertEqual(stats[self.test_category]['difficulties'], {
+            str(difficulty): count
+            for (category, difficulty), count in expected.items()
+            if category == self.test_category})
+
+        response = self.client().post(
+            '/questions', json=self.test_question, headers=self.admin_header)
+        question_id = json.loads(response.data).get('id')
+        self.client().patch(
+            f'/questions/{question_id}', json=self.test_edit_question,
+            headers=self.admin_header)
+        data = json.loads(self.client().get('/categories/stats').data)
+        updated = {category['id']: category for category in data['categories']}
+
+        self.assertEqual(updated[self.test_category]['questions'],
+                         stats[self.test_category]['questions'] + 1)
+        self.assertEqual(self.category_stats_rows(), self.count_questions())
+
+        with self.app.app_context():
+            CategoryStat.query.delete()
+            self.assertFalse(category_stats.refresh())
+        self.assertEqual(self.category_stats_rows(), self.count_questions())
+
+    def test_get_categories_with_counts(self):
+        """
+        Test case to get categories with their number of questions.
+
+        :param self:
+        :return:
+        """
+        response = self.client().get('/categories?include=counts')
+        data = json.loads(response.data)
+        expected = {}
+        for (category, _), count in self.count_questions().items():
+            expected[str(category)] = expected.get(str(category), 0) + count
+
+        self.assertEqual(response.status_code, HTTP_STATUS.OK)
+        self.assertEqual(set(data.get('counts')), set(data.get('categories')))
+        self.assertEqual(
+            {category: count for category, count in data['counts'].items()
+             if count}, expected)
+
+        response = self.client().get('/categories?include=questions')
+        self.assertEqual(response.status_code, HTTP_STATUS.BAD_REQUEST)
+        response = self.client().get('/categories')
+        self.assertNotIn('counts', json.loads(response.data))
+
+    def test_add_near_duplicate_question(self):
+        """
+        Test case to flag and reject near-duplicates of a question.
+
+        :param self:
+        :return:
+        """
+        near_duplicate = dict(self.test_question, question=(
+            "Whose autobiography is titled 'I know why the caged bird "
+            "sings'?"))
+        response = self.client().post(
+            '/questions', json=near_duplicate, headers=self.admin_header)
+        data = json.loads(response.data)
+
+        flagged_id = data.get('id')
+
+        self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+        self.assertEqual([duplicate['id'] for duplicate in
+                          data.get('duplicates')], [5])
+        self.assertGreaterEqual(data['duplicates'][0]['similarity'], 0.8)
+
+        response = self.client().post(
+            '/questions', json=self.test_question, headers=self.admin_header)
+        self.assertEqual(json.loads(response.data).get('duplicates'), [])
+
+        with self.app.app_context():
+            total = Question.query.count()
+        duplicate_index.mode = 'reject'
+        try:
+            response = self.client().post(
+                '/questions', json=near_duplicate, headers=self.admin_header)
+        finally:
+            duplicate_index.mode = 'flag'
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, HTTP_STATUS.CONFLICT)
+        self.assertEqual(data.get('success'), False)
+        self.assertEqual(
+            [duplicate['id'] for duplicate in data['duplicates']],
+            [flagged_id, 5])
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), total)
+
+    def test_sync_duplicate_index_with_change_log(self):
+        """
+        Test case to index questions written by other workers.
+
+        :param self:
+        :return:
+        """
+        text = 'What boxers original name is Cassius Clay'
+        with self.app.app_context():
+            self.assertEqual(
+                [duplicate['id'] for duplicate in duplicate_index.find(text)],
+                [9])
+            # Written by another worker: only logged, no listener called.
+            question_id = db.session.execute(
+                Question.__table__.insert().values(
+                    question='Which planet is known as the red planet?',
+                    answer='Mars', category=1,
+                    difficulty=1)).inserted_primary_key[0]
+            log_change(db.session, 'insert', question_id, {
+                'question': 'Which planet is known as the red planet?'})
+            db.session.execute(Question.__table__.delete().where(
+                Question.id == 9))
+            log_change(db.session, 'delete', 9)
+            db.session.commit()
+            duplicate_index.sync()
+
+            self.assertEqual(duplicate_index.find(text), [])
+            self.assertEqual(
+                [duplicate['id'] for duplicate in duplicate_index.find(
+                    'Which planet is known as the Red Planet')],
+                [question_id])
+
+    def test_find_duplicate_clusters(self):
+        """
+        Test case to scan questions for clusters of near-duplicates.
+
+        :param self:
+        :return:
+        """
+        rows = [
+            (1, "What boxer's original name is Cassius Clay?"),
+            (2, 'What boxers original name is Cassius Clay'),
+            (3, 'Which planet is known as the red planet?'),
+            (4, 'What is the capital of France?'),
+            (5, 'Which planet is known as the Red Planet?!'),
+            (6, 'WHAT boxer\'s original name is Cassius Clay?'),
+            (7, ''),
+        ]
+
+        self.assertEqual(find_clusters(rows, processes=1),
+                         [[1, 2, 6], [3, 5]])
+        self.assertEqual(find_clusters(rows, processes=2, chunk_size=2),
+                         [[1, 2, 6], [3, 5]])
+        self.assertEqual(find_clusters(rows, processes=1, max_bucket=2),
+                         [[1, 2, 6], [3, 5]])
+
+    def shard_rows(self):
+        """
+        Get (id, category) of the questions of every shard.
+
+        :param self:
+        :return:
+        """
+        with self.app.app_context():
+            return [sorted(session.query(Question.id, Question.category))
+                    for session in shard_router.sessions()]
+
+    def test_shard_questions_by_category(self):
+        """
+        Test case to route questions to shards and merge reads of shards.
+
+        :param self:
+        :return:
+        """
+        directory = tempfile.mkdtemp()
+        shard_router.setup(self.app, [
+            f'sqlite:///{directory}/shard-{shard}.db' for shard in range(2)])
+        reset_app_state()
+        try:
+            ids = {}
+            for category in (1, 2, 4):
+                response = self.client().post('/questions', json=dict(
+                    self.test_question, question=f'Sharded {category}',
+                    category=category), headers=self.admin_header)
+                self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+                ids[category] = json.loads(response.data)['id']
+
+            self.assertEqual(self.shard_rows(), [
+                [(ids[2], 2), (ids[4], 4)], [(ids[1], 1)]])
+
+            data = json.loads(self.client().get(
+                '/categories/2/questions').data)
+            self.assertEqual([question['id'] for question in
+                              data['questions']], [ids[2]])
+
+            pages = [json.loads(self.client().get(
+                f'/questions?limit=2&page={page}&fields=question').data)
+                for page in (1, 2)]
+            self.assertEqual(pages[0]['total_questions'], 3)
+            self.assertEqual(
+                [question for page in pages for question in page['questions']],
+                [{'question': f'Sharded {category}'}
+                 for category in (1, 2, 4)])
+
+            data = json.loads(self.client().post(
+                '/questions/search', json={'searchTerm': 'sharded'}).data)
+            self.assertEqual([question['id'] for question in
+                              data['questions']], sorted(ids.values()))
+
+            # Moving to a category of the other shard moves the row.
+            response = self.client().patch(
+                f'/questions/{ids[1]}', json=dict(
+                    self.test_edit_question, category=2),
+                headers=self.admin_header)
+            self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+            self.assertEqual(self.shard_rows(), [
+                [(ids[1], 2), (ids[2], 2), (ids[4], 4)], []])
+            data = json.loads(self.client().get(
+                f'/questions/{ids[1]}').data)
+            self.assertEqual(data['question']['question'], 'TestQ1')
+
+            # Moving to a category of the same shard updates the row.
+            response = self.client().patch(
+                f'/questions/{ids[1]}', json=dict(
+                    self.test_edit_question, category=4),
+                headers=self.admin_header)
+            self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+            self.assertEqual(self.shard_rows(), [
+                [(ids[1], 4), (ids[2], 2), (ids[4], 4)], []])
+
+            response = self.client().delete(
+                f'/questions/{ids[4]}', headers=self.admin_header)
+            self.assertEqual(response.status_code, HTTP_STATUS.NO_CONTENT)
+            self.assertEqual(self.shard_rows(), [
+                [(ids[1], 4), (ids[2], 2)], []])
+            self.assertEqual(self.client().get(
+                f'/questions/{ids[4]}').status_code, HTTP_STATUS.NOT_FOUND)
+
+            data = json.loads(self.client().post(
+                '/quizzes', json={'quiz_category': {'id': 2},
+                                  'previous_questions': [ids[1]]},
+                headers=self.user_header).data)
+            self.assertEqual(data['question']['id'], ids[2])
+
+            with self.app.app_context():
+                self.assertTrue(category_stats.refresh())
+                self.assertEqual(category_stats.counts()[2], 1)
+                self.assertEqual(category_stats.counts()[4], 1)
+        finally:
+            shard_router.setup(self.app, [])
+            reset_app_state()
+
+    def test_shard_writes_recover_from_failures(self):
+        """
+        Test case to undo a delete whose app database commit fails, and to
+        skip then remove the old row of a move whose removal failed.
+
+        :param self:
+        :return:
+        """
+        directory = tempfile.mkdtemp()
+        shard_router.setup(self.app, [
+            f'sqlite:///{directory}/shard-{shard}.db' for shard in range(2)])
+        reset_app_state()
+
+        def fail(*args):
+            raise RuntimeError('failed')
+
+        try:
+            ids = {}
+            for category in (1, 2):
+                response = self.client().post('/questions', json=dict(
+                    self.test_question, question=f'Sharded {category}',
+                    category=category), headers=self.admin_header)
+                ids[category] = json.loads(response.data)['id']
+
+            with self.app.app_context():
+                question = shard_router.get(ids[2])
+                previous = question.committed_values()
+                session = db.session()
+                session.commit = fail
+                try:
+                    with self.assertRaises(RuntimeError):
+                        shard_router.delete(question, previous)
+                finally:
+                    del session.commit
+                self.assertEqual(
+                    shard_router.get(ids[2]).question, 'Sharded 2')
+
+            shard_router._remove_row = fail
+            try:
+                response = self.client().patch(
+                    f'/questions/{ids[1]}', json=dict(
+                        self.test_edit_question, category=2),
+                    headers=self.admin_header)
+            finally:
+                del shard_router._remove_row
+            self.assertEqual(response.status_code, HTTP_STATUS.CREATED)
+            self.assertEqual(self.shard_rows(), [
+                [(ids[1], 2), (ids[2], 2)], [(ids[1], 1)]])
+            data = json.loads(self.client().get('/questions?fields=id').data)
+            self.assertEqual(data['questions'],
+                             [{'id': ids[1]}, {'id': ids[2]}])
+
+            response = self.client().post('/questions', json=dict(
+                self.test_question, category=4), headers=self.admin_header)
+            question_id = json.loads(response.data)['id']
+            self.assertEqual(self.shard_rows(), [
+                [(ids[1], 2), (ids[2], 2), (question_id, 4)], []])
+        finally:
+            shard_router.setup(self.app, [])
+            reset_app_state()
+
+    def asgi_responses(self, requests):
+        """
+        Serve requests with the ASGI app, on a copy of the test database.
+
+        :param requests: (method, path, json body, headers) tuples
+        :return: (status, json payload) of every request
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'trivia.db')
+        engine = create_engine(f'sqlite:///{path}')
+        with self.app.app_context():
+            category_stats.refresh()
+            db.Model.metadata.create_all(engine)
+            for model in (Category, Question, CategoryStat):
+                rows = [dict(row) for row in
+                        db.session.execute(model.__table__.select())]
+                if rows:
+                    engine.execute(model.__table__.insert(), rows)
+            db.session.commit()
+        engine.dispose()
+        asgi_app = TriviaASGI(Database(f'sqlite:///{path}'), self.app)
+
+        async def serve(method, url, body=None, headers=None):
+            data = b'' if body is None else json.dumps(body).encode('utf-8')
+            messages = [{'type': 'http.request', 'body': data}]
+            sent = []
+
+            async def receive():
+                if messages:
+                    return messages.pop(0)
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            path, _, query = url.partition('?')
+            await asgi_app({
+                'type': 'http',
+                'http_version': '1.1',
+                'method': method,
+                'path': path,
+                'query_string': query.encode('latin-1'),
+                'headers': [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in dict(
+                        headers or {}, **{
+                            'Content-Type': 'application/json',
+                            'Content-Length': str(len(data))}).items()],
+                'client': ('127.0.0.1', 50000),
+            }, receive, send)
+            return sent[0]['status'], json.loads(b''.join(
+                message.get('body', b'') for message in sent[1:]))
+
+        async def serve_all():
+            try:
+                return [await serve(*request) for request in requests]
+            finally:
+                await asgi_app.db.close()
+
+        return asyncio.run(serve_all())
+
+    @unittest.skipIf(TriviaASGI is None, 'needs asgiref and aiosqlite')
+    def test_asgi_routes_match_flask_routes(self):
+        """
+        Test case to serve the same responses from ASGI and Flask routes.
+
+        :param self:
+        :return:
+        """
+        with self.app.app_context():
+            category_ids = [question_id for (question_id,) in db.session.query(
+                Question.id).filter(Question.category == 1).order_by(
+                Question.id)]
+            db.session.commit()
+        requests = [
+            ('GET', '/categories'),
+            ('GET', '/categories?include=counts'),
+            ('GET', '/categories?include=questions'),
+            ('GET', '/questions'),
+            ('GET', '/questions?page=2&limit=5'),
+            ('GET', '/questions?page=1000'),
+            ('GET', '/questions?fields=id,question'),
+            ('GET', '/questions?fields=answer&include=categories'),
+            ('GET', '/questions?include='),
+            ('GET', '/questions?fields=secret'),
+            ('POST', '/questions/search', {'searchTerm': 'title'}),
+            ('POST', '/questions/search?fields=answer',
+             {'searchTerm': 'title'}),
+            ('GET', '/categories/1/questions'),
+            ('GET', '/categories/1/questions?fields=id,difficulty'),
+            ('GET', '/categories/1000/questions'),
+            ('POST', '/quizzes', {'quiz_category': {'id': 1},
+                                  'previous_questions': category_ids[:-1]},
+             self.user_header),
+            ('POST', '/quizzes', {'quiz_category': {'id': 1},
+                                  'previous_questions': category_ids},
+             self.user_header),
+            ('POST', '/quizzes', {'quiz_category': {'id': 1},
+                                  'previous_questions': ['x']},
+             self.user_header),
+            ('POST', '/quizzes', {'quiz_category': {'id': '1'},
+                                  'previous_questions': category_ids[:-1]},
+             self.user_header),
+            ('POST', '/quizzes', {'quiz_category': {'id': 'x'}},
+             self.user_header),
+            ('POST', '/quizzes', {'quiz_category': {'id': 1},
+                                  'previous_questions': category_ids[:-1],
+                                  'difficulty': 0},
+             self.user_header),
+            ('POST', '/quizzes', {'quiz_category': {'id': 1},
+                                  'previous_questions': category_ids[:-1],
+                                  'weights': {'1': 0}},
+             self.user_header),
+            ('POST', '/quizzes', {'quiz_category': {'id': 1},
+                                  'difficulty': True},
+             self.user_header),
+            ('POST', '/quizzes', {'quiz_category': {'id': 1}}),
+        ]
+
+        for request, (status, payload) in zip(
+                requests, self.asgi_responses(requests)):
+            method, url, body, headers = (request + (None, None))[:4]
+            response = self.client().open(
+                url, method=method, json=body, headers=headers)
+            self.assertEqual(
+                (status, payload),
+                (response.status_code, json.loads(response.data)), request)
+
+    @unittest.skipIf(TriviaASGI is None, 'needs asgiref and aiosqlite')
+    def test_asgi_search_rate_limited(self):
+        """
+        Test case to rate limit async search like the Flask route.
+
+        :param self:
+        :return:
+        """
+        rate, burst, concurrency = RATE_LIMITS['search_questions']
+        search = {'searchTerm': 'no question matches this'}
+        responses = self.asgi_responses(
+            [('POST', '/questions/search', search)] * (burst + 1))
+
+        self.assertEqual([status for status, _ in responses],
+                         [HTTP_STATUS.OK] * burst +
+                         [HTTP_STATUS.TOO_MANY_REQUESTS])
+        self.assertEqual(
+            responses[-1][1]['message'],
+            ERROR_MESSAGES[HTTP_STATUS.TOO_MANY_REQUESTS])
+
+    def test_benchmark_percentiles_and_summary(self):
+        """
+        Test case to summarize benchmark latencies by nearest rank.
+
+        :param self:
+        :return:
+        """
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([7], 1), 7)
+        self.assertIsNone(percentile([], 50))
+
+        summary = summarize([0.004, 0.001, 0.003, 0.002], 1, 2.0)
+        self.assertEqual(summary, {
+            'requests': 4, 'errors': 1, 'elapsed': 2.0, 'rps': 2.0,
+            'mean': 2.5, 'p50': 2.0, 'p95': 4.0, 'p99': 4.0, 'max': 4.0})
+        self.assertEqual(summarize([], 0, 0)['rps'], None)
+
+        rows = compare(
+            {'results': {'client': {'GET /': {'rps': 100, 'p50': 2.0}}}},
+            {'results': {'client': {'GET /': {'rps': 150, 'p50': 1.0},
+                                    'GET /new': {'rps': 1}}}})
+        self.assertEqual(rows, [{
+            'target': 'client', 'route': 'GET /', 'rps': (100, 150, 50.0),
+            'p50': (2.0, 1.0, -50.0), 'p95': (None, None, None),
+            'p99': (None, None, None)}])
+
+    def test_replay_request_log(self):
+        """
+        Test case to replay a request log, grouping requests by route.
+
+        :param self:
+        :return:
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'requests.jsonl')
+        with open(path, 'w') as log_file:
+            log_file.write('\n'.join(json.dumps(entry) for entry in [
+                {'ts': 0, 'path': '/questions/1'},
+                {'ts': 0.01, 'method': 'delete', 'path': '/questions/2',
+                 'headers': {'authorization': 'Bearer old'}},
+                {'method': 'GET'},
+                {'ts': 0.02, 'path': '/missing?page=2'},
+            ]) + '\n\n')
+        received = []
+
+        async def handle(reader, writer):
+            head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+            received.append(head)
+            status = 404 if '/missing' in head else 200
+            writer.write(
+                f'HTTP/1.1 {status} X\r\nContent-Length: 0\r\n\r\n'.encode())
+            await writer.drain()
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await replay(
+                    read_log(path), f'http://127.0.0.1:{port}', speed=10,
+                    authorization='Bearer new')
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        report = asyncio.run(run())
+
+        self.assertEqual(sorted(report), [
+            'DELETE /questions/<int>', 'GET /missing', 'GET /questions/<int>'])
+        self.assertEqual(report['GET /missing']['statuses'], {'404': 1})
+        self.assertEqual(report['GET /missing']['errors'], 1)
+        self.assertEqual(report['GET /questions/<int>']['errors'], 0)
+        self.assertEqual(len(received), 3)
+        self.assertIn('authorization: Bearer new', ''.join(received))
+        self.assertNotIn('Bearer old', ''.join(received))
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
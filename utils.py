@@ -1,8 +1,14 @@
 """Utils module for trivia app."""
 
-from flask import jsonify
-from models import Category
-from constants import ERROR_MESSAGES
+import re
+import threading
+from collections import OrderedDict
+
+from flask import jsonify, abort
+from models import Category, Question, shard_router
+from constants import ERROR_MESSAGES, HTTP_STATUS
+
+WORD = re.compile(r'\w+')
 
 
 def get_formatted_categories():
@@ -15,35 +21,251 @@ def get_formatted_categories():
     return {category.id: category.type for category in categories}
 
 
-def paginated_data(request, model, order_by, default_limit):
+def get_requested_fields(args, model):
+    """
+    Get fields requested with ``?fields=``, or None for all fields.
+
+    :param args: query arguments, e.g. request.args
+    :param model:
+    :return:
+    """
+    fields = args.get('fields')
+    if fields is None:
+        return None
+
+    fields = tuple(name.strip() for name in fields.split(',') if name.strip())
+    if not fields or any(name not in model.FIELDS for name in fields):
+        abort(HTTP_STATUS.BAD_REQUEST)
+    return fields
+
+
+def get_requested_includes(args, allowed, default=()):
+    """
+    Get related payloads requested with ``?include=``.
+
+    Requests using neither ``?include=`` nor ``?fields=`` get the default,
+    so existing clients keep receiving the full payload.
+
+    :param args: query arguments, e.g. request.args
+    :param allowed:
+    :param default:
+    :return:
+    """
+    include = args.get('include')
+    if include is None:
+        return set() if 'fields' in args else set(default)
+
+    includes = {name.strip() for name in include.split(',') if name.strip()}
+    if not includes.issubset(allowed):
+        abort(HTTP_STATUS.BAD_REQUEST)
+    return includes
+
+
+def query_fields(model, fields, session=None):
+    """
+    Get query selecting only the given fields, or whole rows if None.
+
+    :param model:
+    :param fields:
+    :param session: None for the app session
+    :return:
+    """
+    query = model.query if session is None else session.query(model)
+    if fields is None:
+        return query
+    return query.with_entities(*[getattr(model, name) for name in fields])
+
+
+def query_questions(fields, *criterion, category=None, limit=None,
+                    offset=0):
+    """
+    Get formatted questions ordered by id, from the shard of category, or
+    from every shard.
+
+    :param fields: None for all fields
+    :param criterion: filters
+    :param category: None for every category
+    :param limit:
+    :param offset:
+    :return:
+    """
+    # Rows are merged by id, so id is selected even if not requested.
+    selected = fields if fields is None or 'id' in fields \
+        else fields + ('id',)
+    sessions = None if category is None else [
+        shard_router.session_for(category)]
+    rows = shard_router.merged(
+        lambda session: query_fields(Question, selected, session).filter(
+            *criterion).order_by(Question.id),
+        limit, offset, sessions)
+    questions = format_rows(rows, selected)
+    if selected is not fields:
+        for question in questions:
+            del question['id']
+    return questions
+
+
+def format_rows(rows, fields):
+    """
+    Format rows returned by a query_fields query.
+
+    :param rows:
+    :param fields:
+    :return:
+    """
+    if fields is None:
+        return [row.format() for row in rows]
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def words(text):
+    """
+    Get distinct lowercased words of text.
+
+    :param text:
+    :return:
+    """
+    return set(WORD.findall((text or '').lower()))
+
+
+def paginated_data(request, model, order_by, default_limit, total=None):
     """
     Get paginated data.
 
+    Only the columns requested with ``?fields=`` are selected. Questions
+    are merged by id from every shard.
+
     :param request:
     :param queryset:
     :param page_limit:
+    :param total: number of rows if known, counted with a query otherwise
     :return:
     """
     page_limit = request.args.get('limit', default_limit, type=int)
     selected_page = request.args.get('page', 1, type=int)
     index = selected_page - 1
+    fields = get_requested_fields(request.args, model)
 
-    queryset = model.query.order_by(order_by).limit(
+    if model is Question:
+        questions = query_questions(
+            fields, limit=page_limit, offset=page_limit * index)
+        if total is None:
+            total = sum(session.query(Question).count()
+                        for session in shard_router.sessions())
+        return questions, total
+
+    queryset = query_fields(model, fields).order_by(order_by).limit(
         page_limit).offset(page_limit * index).all()
 
-    return [row.format() for row in queryset] \
-        if queryset else [], model.query.count()
+    if total is None:
+        total = model.query.count()
+
+    return format_rows(queryset, fields) if queryset else [], total
 
 
-def error_response(http_status):
+def error_response(http_status, **details):
     """
     Get error response based on http status.
 
     :param http_status:
+    :param details: more fields of the response
     :return:
     """
-    return jsonify({
+    return jsonify(dict({
         "success": False,
         "error": http_status,
         "message": ERROR_MESSAGES[http_status]
-        }), http_status
+        }, **details)), http_status
+
+
+class LRUCache:
+    """Thread safe least recently used cache bounded by entries and bytes."""
+
+    def __init__(self, max_entries, max_bytes=None, sizeof=len):
+        """
+        Init method.
+
+        :param max_entries:
+        :param max_bytes:
+        :param sizeof:
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Get cached value and mark it as recently used.
+
+        :param key:
+        :param default:
+        :return:
+        """
+        with self._lock:
+            try:
+                size, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Cache value, evicting least recently used entries over the bounds.
+
+        :param key:
+        :param value:
+        :return:
+        """
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[0]
+            self._entries[key] = (size, value)
+            self.size += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes and self.size > self.max_bytes):
+                self.size -= self._entries.popitem(last=False)[1][0]
+
+    def delete(self, key):
+        """
+        Evict cached value.
+
+        :param key:
+        :return:
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self.size -= entry[0]
+
+    def clear(self):
+        """
+        Evict all cached values.
+
+        :return:
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def hit_ratio(self):
+        """
+        Get ratio of lookups served from the cache.
+
+        :return:
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None